@@ -32,6 +32,7 @@ desc = bcolors.OKBLUE + "This script will assign the given identity to VMs in VM
 
 parser = argparse.ArgumentParser(description=desc)
 parser.add_argument("--user-assigned-service-identity-id", "-u", help="ARMId of the UserAssignedServiceIdentity \n \n /subscriptions/{subscripton-id}/resourceGroups/{resource-group}/providers/Microsoft.ManagedIdentity/userAssignedIdentities/{identity-name}")
+addExecutionArguments(parser)
 
 requiredNamed = parser.add_argument_group('required arguments')
 requiredNamed.add_argument("--virtual-machine-resource-group", "-v", help=" Virtual machine resource group", required=True)
@@ -39,9 +40,10 @@ requiredNamed.add_argument("--virtual-machine-names", "-m", nargs='+', help="Lis
 requiredNamed.add_argument("--subscription", "-s", help="Subscription Id for the virtual machine containing workload", required=True)
 
 args = parser.parse_args()
+applyExecutionArguments(args)
 UserAssignedServiceIdentityId = args.user_assigned_service_identity_id
 VirtualMachineResourceGroup = args.virtual_machine_resource_group
 VirtualMachineNames = args.virtual_machine_names
 subscription = args.subscription # UserAssignedServiceIdentityId.split("/")[2]
 
-assignIdentityToVMs(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineNames, subscription)
\ No newline at end of file
+assignIdentityToVMs(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineNames, subscription, args.max_parallel)
\ No newline at end of file
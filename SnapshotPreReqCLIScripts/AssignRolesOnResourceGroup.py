@@ -22,12 +22,28 @@
 # SCRIPT
 
 import os
+import sys
+import argparse
 from helpers import *
+from batch import addBatchArguments, runBatch
 
 #Enabling colors in the command prompt
 os.system("color")
 
-print(bcolors.OKBLUE + "This script will assign the required roles to the principal Id on the resource group." + bcolors.ENDC)
+desc = bcolors.OKBLUE + "This script will assign the required roles to the principal Id on the resource group." + bcolors.ENDC
+
+parser = argparse.ArgumentParser(description=desc)
+addBatchArguments(parser, "principalId, resourceGroup, role and optionally subscription")
+addExecutionArguments(parser)
+
+args = parser.parse_args()
+applyExecutionArguments(args)
+
+if args.file is not None:
+    runBatch(args.file, args.result, args.subscription, args.max_parallel)
+    sys.exit()
+
+print(desc)
 
 #Taking inputs
 PrincipalId = input("Please input the PrincipalId of the identity: ")
@@ -0,0 +1,76 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import os
+import sys
+import argparse
+import traceback
+from collections import OrderedDict
+from helpers import *
+from manifest import ManifestEntry, MANIFEST_FIELDS, readManifest
+from audit import OPERATIONS, FINDINGS_EXIT_CODE, FAILED_EXIT_CODE, runAudit
+
+#Enabling colors in the command prompt
+os.system("color")
+
+desc = bcolors.OKBLUE + "This script checks, without changing anything, that virtual machines have the identity and roles granted by SetWorkloadSnapshotBackupPermissions.py and SetWorkloadSnapshotRestorePermissions.py. \n \n Virtual machine identities are read with Azure Resource Graph and role assignments with one listing per subscription. Uses the current az login." + bcolors.ENDC
+
+parser = argparse.ArgumentParser(description=desc)
+parser.add_argument("--identity-id", "-u", help="User assigned identity id")
+parser.add_argument("--operations", nargs='+', choices=OPERATIONS, default=OPERATIONS, help="Permissions to check, those of backup, restore or both (default)")
+parser.add_argument("--manifest", metavar="MANIFEST_FILE", help="CSV or JSON lines file with one virtual machine per row (" + ", ".join(MANIFEST_FIELDS) + "). Command line values are used for empty columns")
+parser.add_argument("--report", metavar="REPORT_FILE", help="Write one JSON line per missing permission to REPORT_FILE instead of printing it")
+parser.add_argument("--save-state", metavar="STATE_FILE", help="Save the identities and role assignments read from Azure to STATE_FILE")
+parser.add_argument("--replay", metavar="STATE_FILE", help="Audit the state saved earlier with --save-state instead of reading Azure")
+parser.add_argument("--max-parallel", "-p", type=int, default=DEFAULT_MAX_PARALLEL, help="Maximum number of subscriptions read in parallel")
+addConnectionArguments(parser)
+
+requiredNamed = parser.add_argument_group('required arguments')
+requiredNamed.add_argument("--subscription", "-s", help="Subscription Id for the virtual machine containing workload")
+requiredNamed.add_argument("--vm-resource-group", "-v", help="Resource group for the virtual machine containing workload")
+requiredNamed.add_argument("--vm-names", "-m", nargs='+', help="Virtual machine names containing workload")
+requiredNamed.add_argument("--disk-resource-groups", "-d", nargs='+', help="Resource group which contains the data disks")
+requiredNamed.add_argument("--snapshot-resource-group", "-n", help="Target resource group for disk snapshots")
+
+args = parser.parse_args()
+applyConnectionArguments(args)
+
+if args.manifest is not None:
+    entries = lambda: readManifest(args.manifest, args)
+else:
+    requireArguments(parser, args, ["subscription", "vm_resource_group", "vm_names", "disk_resource_groups", "snapshot_resource_group"])
+    entries = lambda: (ManifestEntry(args.subscription, args.vm_resource_group, vm_name, args.disk_resource_groups, args.snapshot_resource_group, args.identity_id) for vm_name in OrderedDict.fromkeys(args.vm_names))
+
+# A non-zero exit code lets a pipeline stop before the backup window. A run that could not read
+# Azure must never pass as compliant, so every failure, including the exits of the shared helpers,
+# ends with FAILED_EXIT_CODE instead of the code for findings.
+try:
+    findings = runAudit(entries, args.operations, args.report, args.save_state, args.replay, args.max_parallel)
+except SystemExit:
+    sys.exit(FAILED_EXIT_CODE)
+except Exception:
+    traceback.print_exc()
+    print(bcolors.FAIL + "The audit failed, the permissions were not checked" + bcolors.ENDC)
+    sys.exit(FAILED_EXIT_CODE)
+
+sys.exit(FINDINGS_EXIT_CODE if findings else 0)
@@ -22,11 +22,11 @@
 # SCRIPT
 
 import os
-import fileinput
 import sys
 import argparse
-import time
 from helpers import *
+from planner import *
+from manifest import *
 
 #Enabling colors in the command prompt
 os.system("color")
@@ -35,62 +35,58 @@ desc = bcolors.OKBLUE + "This script will assign the required roles for the sour
 
 parser = argparse.ArgumentParser(description=desc)
 parser.add_argument("--identity-id", "-u", help="User assigned identity id")
+addExecutionArguments(parser)
+addPlanArguments(parser)
+addManifestArguments(parser)
 
 requiredNamed = parser.add_argument_group('required arguments')
-requiredNamed.add_argument("--subscription", "-s", help="Subscription Id for the virtual machine containing workload", required=True)
-requiredNamed.add_argument("--vm-resource-group", "-v", help="Resource group for the virtual machine containing workload", required=True)
-requiredNamed.add_argument("--vm-names", "-m", nargs='+' , help="Virtual machine names containing workload", required=True)
-requiredNamed.add_argument("--disk-resource-groups", "-d", nargs='+', help="Resource group which contains the data disks", required=True)
-requiredNamed.add_argument("--snapshot-resource-group", "-n", help="Target resource group for disk snapshots", required=True)
+requiredNamed.add_argument("--subscription", "-s", help="Subscription Id for the virtual machine containing workload")
+requiredNamed.add_argument("--vm-resource-group", "-v", help="Resource group for the virtual machine containing workload")
+requiredNamed.add_argument("--vm-names", "-m", nargs='+' , help="Virtual machine names containing workload")
+requiredNamed.add_argument("--disk-resource-groups", "-d", nargs='+', help="Resource group which contains the data disks")
+requiredNamed.add_argument("--snapshot-resource-group", "-n", help="Target resource group for disk snapshots")
 
 args = parser.parse_args()
-subscription = args.subscription
-vm_resource_group = args.vm_resource_group
-vm_names = args.vm_names
-disk_resource_groups = args.disk_resource_groups
-snapshot_resource_group = args.snapshot_resource_group
+applyExecutionArguments(args)
 
 diskBackupReaderRoleName = "Disk Backup Reader"
 diskSnapshotContributorRoleName = "Disk Snapshot Contributor"
 
-output = os.system("az login -o tsv --only-show-errors > login.txt")
-output = os.system("az account set -s {} -o tsv --only-show-errors > context.txt".format(subscription))
+backup_service_principalId = None
 
-if output == 0:
-    print(bcolors.OKGREEN + "Successfully logged in to subscription " + subscription + "." + bcolors.ENDC)
-    pass
-else:
-    print(bcolors.FAIL + "Script failed with unexpected error ... " + bcolors.ENDC)
-    sys.exit()
+def roleTemplatesFor(DiskResourceGroups, SnapshotResourceGroup):
+    global backup_service_principalId
 
-if os.path.isfile('backupMgmtPrincipalId.txt'):
-    os.remove('backupMgmtPrincipalId.txt')
+    if backup_service_principalId is None:
+        backup_service_principalId = getServicePrincipalIdByDisplayName("Backup Management Service")
 
-output = os.system('(az ad sp list --display-name "Backup Management Service" --query "[].{Id:objectId}" --output tsv) > backupMgmtPrincipalId.txt')
+    roleTemplates = [RoleTemplate(diskBackupReaderRoleName, resourceGroupScope(disk_resource_group)) for disk_resource_group in DiskResourceGroups]
+    roleTemplates.append(RoleTemplate(diskSnapshotContributorRoleName, resourceGroupScope(SnapshotResourceGroup)))
+    roleTemplates.append(RoleTemplate(diskSnapshotContributorRoleName, resourceGroupScope(SnapshotResourceGroup), backup_service_principalId))
+    return roleTemplates
 
-if output == 0:
-    print(bcolors.OKGREEN + "Successfully fetched Backup Management Service Principal Id" + bcolors.ENDC)
-    pass
-else:
-    print(bcolors.FAIL + "Failed to get Backup Management Service Principal Id" + bcolors.ENDC)
+if args.apply is not None:
+    applyPlanFile(args.apply, args.max_parallel)
     sys.exit()
 
-with open('backupMgmtPrincipalId.txt',mode='r') as principalIdFile:
-    backup_service_principalId = principalIdFile.read()
-
-principalIds = assignIdentityToVMs(args.identity_id, vm_resource_group, vm_names, subscription)
+if args.manifest is not None:
+    runManifest(args, roleTemplatesFor)
+    sys.exit()
 
-for service_principal_id in principalIds:
-    print(bcolors.OKGREEN + "Assigning permissions to " + service_principal_id + bcolors.ENDC)
+requireArguments(parser, args, ["subscription", "vm_resource_group", "vm_names", "disk_resource_groups", "snapshot_resource_group"])
+subscription = args.subscription
+vm_resource_group = args.vm_resource_group
+vm_names = args.vm_names
+disk_resource_groups = args.disk_resource_groups
+snapshot_resource_group = args.snapshot_resource_group
 
-    # Assign permissions for disk resource groups
-    for disk_resource_group in disk_resource_groups:
-        assignRoleOnResourceGroup(service_principal_id, disk_resource_group, diskBackupReaderRoleName)        
+setSubscriptionContext(subscription)
 
-    # Assign permissions for snapshot resource groups to VM Identity
-    assignRoleOnResourceGroup(service_principal_id, snapshot_resource_group, diskSnapshotContributorRoleName)
+if args.plan is not None:
+    writePlanFile(args.plan, buildPlan(args.identity_id, vm_resource_group, vm_names, subscription, roleTemplatesFor(disk_resource_groups, snapshot_resource_group), args.max_parallel))
+    sys.exit()
 
-# Assign permissions for snapshot resource groups to Backup Management Service
-assignRoleOnResourceGroup(backup_service_principalId, snapshot_resource_group, diskSnapshotContributorRoleName)        
+# Each VM's roles are assigned as soon as its identity is ready, see runPermissionPipeline
+runPermissionPipeline(args.identity_id, vm_resource_group, vm_names, subscription, roleTemplatesFor(disk_resource_groups, snapshot_resource_group), args.max_parallel)
 
 print(bcolors.OKGREEN + "Script Execution completed" + bcolors.ENDC)
\ No newline at end of file
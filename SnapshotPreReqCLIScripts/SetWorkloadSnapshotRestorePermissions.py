@@ -22,11 +22,11 @@
 # SCRIPT
 
 import os
-import fileinput
 import sys
 import argparse
-import time
 from helpers import *
+from planner import *
+from manifest import *
 
 #Enabling colors in the command prompt
 os.system("color")
@@ -35,54 +35,52 @@ desc = bcolors.OKBLUE + "This script will assign the required roles for the sour
 
 parser = argparse.ArgumentParser(description=desc)
 parser.add_argument("--identity-id", "-u", help="User assigned identity id")
+addExecutionArguments(parser)
+addPlanArguments(parser)
+addManifestArguments(parser)
 
 requiredNamed = parser.add_argument_group('required arguments')
-requiredNamed.add_argument("--subscription", "-s", help="Subscription Id for the virtual machine containing workload", required=True)
-requiredNamed.add_argument("--vm-resource-group", "-v", help="Resource group for the virtual machine containing workload", required=True)
-requiredNamed.add_argument("--vm-names", "-m", nargs='+', help="Virtual machine name containing workload", required=True)
-requiredNamed.add_argument("--disk-resource-groups", "-d", nargs='+', help="Resource group which contains the exisiting data disks or where new data disks are created", required=True)
-requiredNamed.add_argument("--snapshot-resource-group", "-n", help="Target resource group for disk snapshots", required=True)
+requiredNamed.add_argument("--subscription", "-s", help="Subscription Id for the virtual machine containing workload")
+requiredNamed.add_argument("--vm-resource-group", "-v", help="Resource group for the virtual machine containing workload")
+requiredNamed.add_argument("--vm-names", "-m", nargs='+', help="Virtual machine name containing workload")
+requiredNamed.add_argument("--disk-resource-groups", "-d", nargs='+', help="Resource group which contains the exisiting data disks or where new data disks are created")
+requiredNamed.add_argument("--snapshot-resource-group", "-n", help="Target resource group for disk snapshots")
 
 args = parser.parse_args()
-subscription = args.subscription
-vm_resource_group = args.vm_resource_group
-vm_names = args.vm_names
-disk_resource_groups = args.disk_resource_groups
-snapshot_resource_group = args.snapshot_resource_group
+applyExecutionArguments(args)
 
 diskSnapshotContributorRoleName = "Disk Snapshot Contributor"
 vmContributorRoleName = "Virtual Machine Contributor"
 diskRestoreOperatorRoleName = "Disk Restore operator"
 
-output = os.system("az login -o tsv --only-show-errors > login.txt")
-output = os.system("az account set -s {} -o tsv --only-show-errors > context.txt".format(subscription))
+def roleTemplatesFor(DiskResourceGroups, SnapshotResourceGroup):
+    roleTemplates = [RoleTemplate(diskRestoreOperatorRoleName, resourceGroupScope(disk_resource_group)) for disk_resource_group in DiskResourceGroups]
+    roleTemplates.append(RoleTemplate(diskSnapshotContributorRoleName, resourceGroupScope(SnapshotResourceGroup)))
+    roleTemplates.append(RoleTemplate(vmContributorRoleName, VM_SCOPE))
+    return roleTemplates
 
-if output == 0:
-    print(bcolors.OKGREEN + "Successfully logged in to subscription " + subscription + "." + bcolors.ENDC)    
-else:
-    print(bcolors.FAIL + "Script failed with unexpected error ... " + bcolors.ENDC)
+if args.apply is not None:
+    applyPlanFile(args.apply, args.max_parallel)
     sys.exit()
 
-principalIds = assignIdentityToVMs(args.identity_id, vm_resource_group, vm_names, subscription)
-
-for service_principal_id in principalIds:
-
-    print(bcolors.OKGREEN + "Assigning permissions to " + service_principal_id + bcolors.ENDC)
-
-    # Assign permissions for disk resource groups
-    for disk_resource_group in disk_resource_groups:
-        assignRoleOnResourceGroup(service_principal_id, disk_resource_group, diskRestoreOperatorRoleName)        
-
-    # Assign permissions for snapshot resource groups
-    assignRoleOnResourceGroup(service_principal_id, snapshot_resource_group, diskSnapshotContributorRoleName)        
+if args.manifest is not None:
+    runManifest(args, roleTemplatesFor)
+    sys.exit()
 
+requireArguments(parser, args, ["subscription", "vm_resource_group", "vm_names", "disk_resource_groups", "snapshot_resource_group"])
+subscription = args.subscription
+vm_resource_group = args.vm_resource_group
+vm_names = args.vm_names
+disk_resource_groups = args.disk_resource_groups
+snapshot_resource_group = args.snapshot_resource_group
 
-# Assign permission on virtual machines
-for vm_name in vm_names:
+setSubscriptionContext(subscription)
 
-    output = os.system("az vm show -n {} -g {} --subscription {} --query id  -o tsv --only-show-errors > vmId.txt".format(vm_name, vm_resource_group, subscription))
-    vm_id = [line[:-1] for line in fileinput.input(files='vmId.txt')][0] #[1:-1]
+if args.plan is not None:
+    writePlanFile(args.plan, buildPlan(args.identity_id, vm_resource_group, vm_names, subscription, roleTemplatesFor(disk_resource_groups, snapshot_resource_group), args.max_parallel))
+    sys.exit()
 
-    assignRoleOnScope(service_principal_id, vmContributorRoleName, vm_id)
+# Each VM's roles are assigned as soon as its identity is ready, see runPermissionPipeline
+runPermissionPipeline(args.identity_id, vm_resource_group, vm_names, subscription, roleTemplatesFor(disk_resource_groups, snapshot_resource_group), args.max_parallel)
 
 print(bcolors.OKGREEN + "Script Execution completed" + bcolors.ENDC)
\ No newline at end of file
@@ -0,0 +1,319 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import json
+import sys
+import time
+from collections import Counter, OrderedDict
+
+import helpers
+import tracing
+from azcli import AzCommandError
+from backends import vmResourceId
+from helpers import bcolors, normalizeScope, parentScopes, roleAssignmentKey, runParallel, getUserAssignedPrincipalId, getServicePrincipalIdByDisplayName, DEFAULT_MAX_PARALLEL
+from models import RoleAssignment, VmIdentity, VmMetadata
+
+AUDIT_STATE_VERSION = 1
+
+BACKUP = "backup"
+RESTORE = "restore"
+OPERATIONS = [BACKUP, RESTORE]
+
+# Exit codes of the audit: permissions are missing, or Azure could not be read and nothing is known
+FINDINGS_EXIT_CODE = 1
+FAILED_EXIT_CODE = 2
+
+BACKUP_MANAGEMENT_SERVICE = "Backup Management Service"
+
+# Scopes of REQUIRED_ROLES
+DISK_RESOURCE_GROUPS = "diskResourceGroups"
+SNAPSHOT_RESOURCE_GROUP = "snapshotResourceGroup"
+VIRTUAL_MACHINE_SCOPE = "virtualMachine"
+# Principals of REQUIRED_ROLES
+VM_PRINCIPAL = "virtualMachineIdentity"
+BACKUP_MANAGEMENT_SERVICE_PRINCIPAL = "backupManagementService"
+
+# (operation, role, scope, principal) granted by SetWorkloadSnapshotBackupPermissions.py and
+# SetWorkloadSnapshotRestorePermissions.py
+REQUIRED_ROLES = [
+    (BACKUP, "Disk Backup Reader", DISK_RESOURCE_GROUPS, VM_PRINCIPAL),
+    (BACKUP, "Disk Snapshot Contributor", SNAPSHOT_RESOURCE_GROUP, VM_PRINCIPAL),
+    (BACKUP, "Disk Snapshot Contributor", SNAPSHOT_RESOURCE_GROUP, BACKUP_MANAGEMENT_SERVICE_PRINCIPAL),
+    (RESTORE, "Disk Restore operator", DISK_RESOURCE_GROUPS, VM_PRINCIPAL),
+    (RESTORE, "Disk Snapshot Contributor", SNAPSHOT_RESOURCE_GROUP, VM_PRINCIPAL),
+    (RESTORE, "Virtual Machine Contributor", VIRTUAL_MACHINE_SCOPE, VM_PRINCIPAL),
+]
+
+# Findings
+VM_NOT_FOUND = "virtualMachineNotFound"
+IDENTITY_NOT_ENABLED = "identityNotEnabled"
+ROLE_MISSING = "roleMissing"
+
+VIRTUAL_MACHINE_QUERY = "Resources | where type =~ 'microsoft.compute/virtualmachines' | project id, name, resourceGroup, subscriptionId, identity | order by id asc"
+
+def resourceGroupId(Subscription, ResourceGroup):
+    return "/subscriptions/{}/resourceGroups/{}".format(Subscription, ResourceGroup)
+
+class AuditState:
+    # Everything the audit evaluates. It is gathered with a few bulk queries, or loaded from a
+    # file saved by an earlier run so the evaluation can be repeated offline.
+    def __init__(self):
+        # lower case resource id -> VmMetadata
+        self.virtualMachines = {}
+        # Assignments of the audited principals in every audited subscription
+        self.roleAssignments = []
+        self.backupManagementServicePrincipalId = None
+        # lower case identity id -> principal id
+        self.userAssignedPrincipals = {}
+
+    def toJson(self):
+        return OrderedDict([
+            ("version", AUDIT_STATE_VERSION),
+            ("recordedAt", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+            ("backupManagementServicePrincipalId", self.backupManagementServicePrincipalId),
+            ("userAssignedPrincipals", self.userAssignedPrincipals),
+            ("virtualMachines", [vm.toJson() for vm in self.virtualMachines.values()]),
+            ("roleAssignments", [assignment.toJson() for assignment in self.roleAssignments]),
+        ])
+
+    def save(self, Path):
+        with open(Path, mode='w') as stateFile:
+            json.dump(self.toJson(), stateFile)
+
+    @staticmethod
+    def load(Path):
+        with open(Path, mode='r') as stateFile:
+            data = json.load(stateFile)
+        if data.get("version") != AUDIT_STATE_VERSION:
+            raise ValueError("Unsupported audit state version " + str(data.get("version")))
+
+        state = AuditState()
+        state.backupManagementServicePrincipalId = data.get("backupManagementServicePrincipalId")
+        state.userAssignedPrincipals = data.get("userAssignedPrincipals") or {}
+        for item in data["virtualMachines"]:
+            state.addVirtualMachine(VmMetadata.fromJson(item))
+        state.roleAssignments = [RoleAssignment.fromJson(item) for item in data["roleAssignments"]]
+        return state
+
+    def addVirtualMachine(self, Vm):
+        self.virtualMachines[Vm.id.lower()] = Vm
+
+    def principalIds(self):
+        # Principals whose role assignments the audit needs
+        principalIds = set(principalId.lower() for principalId in self.userAssignedPrincipals.values() if principalId)
+        principalIds.update(vm.identity.principalId.lower() for vm in self.virtualMachines.values() if vm.identity.principalId)
+        if self.backupManagementServicePrincipalId is not None:
+            principalIds.add(self.backupManagementServicePrincipalId.lower())
+        return principalIds
+
+class EffectiveRoleIndex:
+    # Answers "does the principal hold the role at this scope" from the listed assignments, counting
+    # assignments on the scope itself and on every parent scope
+    def __init__(self, Assignments):
+        self.keys = set()
+        for assignment in Assignments:
+            if assignment.principalId and assignment.scope and assignment.roleDefinitionName:
+                self.keys.add(roleAssignmentKey(assignment.principalId, assignment.scope, assignment.roleDefinitionName))
+
+    def isEffective(self, PrincipalId, Scope, RoleName):
+        return any(roleAssignmentKey(PrincipalId, scope, RoleName) in self.keys for scope in parentScopes(Scope))
+
+def listSubscriptionRoleAssignments(Subscription, PrincipalIds):
+    # One bulk listing per subscription, only the assignments of PrincipalIds are kept. Management
+    # group and root assignments are only returned when they apply to the subscription, so they
+    # are kept as if made on the subscription.
+    with tracing.span("listAllRoleAssignments", subscription=Subscription) as span:
+        assignments = helpers.getBackend().listAllRoleAssignments(Subscription)
+        span.tag(count=len(assignments))
+
+    kept = []
+    for assignment in assignments:
+        if assignment.principalId is None or assignment.principalId.lower() not in PrincipalIds:
+            continue
+        if not normalizeScope(assignment.scope).startswith("/subscriptions/"):
+            assignment.scope = "/subscriptions/" + Subscription
+        kept.append(assignment)
+    return kept
+
+def gatherAuditState(Entries, Operations, MaxParallel=DEFAULT_MAX_PARALLEL):
+    # Reads the identities of the audited VMs with one paged Resource Graph query and the role
+    # assignments with one listing per subscription. Entries is iterated once.
+    subscriptions = OrderedDict()
+    resourceGroups = set()
+    identityIds = OrderedDict()
+    for entry in Entries:
+        subscriptions.setdefault(entry.subscription.lower(), entry.subscription)
+        resourceGroups.add((entry.subscription.lower(), entry.vmResourceGroup.lower()))
+        if entry.identityId:
+            identityIds.setdefault(entry.identityId.lower(), entry.identityId)
+
+    state = AuditState()
+    if BACKUP in Operations:
+        state.backupManagementServicePrincipalId = getServicePrincipalIdByDisplayName(BACKUP_MANAGEMENT_SERVICE)
+    for key, identityId in identityIds.items():
+        state.userAssignedPrincipals[key] = getUserAssignedPrincipalId(identityId)
+
+    print(bcolors.OKBLUE + "Querying virtual machines in " + str(len(subscriptions)) + " subscriptions" + bcolors.ENDC)
+    try:
+        with tracing.span("queryVirtualMachines", subscriptions=len(subscriptions)) as span:
+            for row in helpers.getBackend().queryResourceGraph(VIRTUAL_MACHINE_QUERY, list(subscriptions.values())):
+                # Resource Graph returns resource group names in lower case
+                if (row["subscriptionId"].lower(), row["resourceGroup"].lower()) in resourceGroups:
+                    state.addVirtualMachine(VmMetadata(row["id"], row["name"], row["resourceGroup"], VmIdentity.fromJson(row.get("identity") or None)))
+            span.tag(count=len(state.virtualMachines))
+
+        principalIds = state.principalIds()
+        print(bcolors.OKBLUE + "Listing role assignments of " + str(len(principalIds)) + " principals in " + str(len(subscriptions)) + " subscriptions" + bcolors.ENDC)
+        for assignments in runParallel(list(subscriptions.values()), lambda Subscription: listSubscriptionRoleAssignments(Subscription, principalIds), MaxParallel):
+            state.roleAssignments.extend(assignments)
+    except AzCommandError as e:
+        print(bcolors.FAIL + "Script failed with unexpected error ... " + str(e) + bcolors.ENDC)
+        helpers.printRerunHint()
+        sys.exit(FAILED_EXIT_CODE)
+
+    return state
+
+def finding(Entry, Issue, Operation=None, PrincipalId=None, RoleName=None, Scope=None):
+    return OrderedDict([
+        ("subscription", Entry.subscription),
+        ("resourceGroup", Entry.vmResourceGroup),
+        ("virtualMachineName", Entry.vmName),
+        ("issue", Issue),
+        ("operation", Operation),
+        ("principalId", PrincipalId),
+        ("roleName", RoleName),
+        ("scope", Scope),
+    ])
+
+class ComplianceAudit:
+    # Evaluates manifest entries against an AuditState without calling Azure
+    def __init__(self, State, Operations):
+        self.state = State
+        self.operations = Operations
+        self.index = EffectiveRoleIndex(State.roleAssignments)
+        # Assignments of fixed principals are shared by many VMs and reported once
+        self.reportedShared = set()
+        self.totals = Counter()
+
+    def auditEntry(self, Entry):
+        # Returns the findings of one VM, an empty list when it is compliant
+        self.totals["virtualMachines"] += 1
+        vm = self.state.virtualMachines.get(vmResourceId(Entry.subscription, Entry.vmResourceGroup, Entry.vmName).lower())
+        if vm is None:
+            return self.count([finding(Entry, VM_NOT_FOUND)])
+
+        findings = []
+        # Roles needed by both operations, such as Disk Snapshot Contributor, are reported once
+        missingRoles = {}
+        if Entry.identityId:
+            enabled = vm.identity.hasUserAssigned(Entry.identityId)
+            principalId = self.state.userAssignedPrincipals.get(Entry.identityId.lower())
+        else:
+            enabled = vm.identity.hasSystemAssigned and vm.identity.principalId is not None
+            principalId = vm.identity.principalId if enabled else None
+
+        if not enabled:
+            findings.append(finding(Entry, IDENTITY_NOT_ENABLED, PrincipalId=principalId))
+
+        for operation, roleName, scopeKind, principalKind in REQUIRED_ROLES:
+            if operation not in self.operations:
+                continue
+
+            if scopeKind == DISK_RESOURCE_GROUPS:
+                scopes = [resourceGroupId(Entry.subscription, group) for group in Entry.diskResourceGroups]
+            elif scopeKind == SNAPSHOT_RESOURCE_GROUP:
+                scopes = [resourceGroupId(Entry.subscription, Entry.snapshotResourceGroup)]
+            else:
+                scopes = [vm.id]
+
+            for scope in scopes:
+                if principalKind == BACKUP_MANAGEMENT_SERVICE_PRINCIPAL:
+                    rolePrincipalId = self.state.backupManagementServicePrincipalId
+                    key = roleAssignmentKey(rolePrincipalId, scope, roleName)
+                    if key in self.reportedShared:
+                        continue
+                    self.reportedShared.add(key)
+                else:
+                    rolePrincipalId = principalId
+
+                # A VM without its identity cannot hold any role yet
+                if rolePrincipalId is None or not self.index.isEffective(rolePrincipalId, scope, roleName):
+                    key = roleAssignmentKey(rolePrincipalId or "", scope, roleName)
+                    if key in missingRoles:
+                        missingRoles[key]["operation"] += ", " + operation
+                        continue
+                    missingRoles[key] = finding(Entry, ROLE_MISSING, operation, rolePrincipalId, roleName, scope)
+                    findings.append(missingRoles[key])
+
+        return self.count(findings)
+
+    def count(self, Findings):
+        self.totals.update(item["issue"] for item in Findings)
+        self.totals["compliant" if not len(Findings) else "nonCompliant"] += 1
+        return Findings
+
+def printFinding(Finding):
+    vm = Finding["virtualMachineName"] + " (" + Finding["resourceGroup"] + ")"
+    if Finding["issue"] == VM_NOT_FOUND:
+        print(bcolors.FAIL + vm + ": virtual machine not found" + bcolors.ENDC)
+    elif Finding["issue"] == IDENTITY_NOT_ENABLED:
+        print(bcolors.FAIL + vm + ": identity not enabled" + bcolors.ENDC)
+    else:
+        principal = Finding["principalId"] or "<identity of " + Finding["virtualMachineName"] + ">"
+        print(bcolors.FAIL + vm + ": " + Finding["operation"] + " needs " + Finding["roleName"] + " for " + principal + " on " + Finding["scope"] + bcolors.ENDC)
+
+def runAudit(EntriesFactory, Operations, ReportPath=None, StatePath=None, ReplayPath=None, MaxParallel=DEFAULT_MAX_PARALLEL):
+    # EntriesFactory returns a new iterator over the audited ManifestEntry objects, it is called
+    # once to gather the state and once to evaluate it, so a manifest is streamed twice instead of
+    # held in memory. With ReplayPath the state is loaded from a file saved with StatePath and no
+    # Azure call is made. Returns the number of findings.
+    if ReplayPath is not None:
+        state = AuditState.load(ReplayPath)
+        print(bcolors.OKBLUE + "Auditing recorded state " + ReplayPath + bcolors.ENDC)
+    else:
+        state = gatherAuditState(EntriesFactory(), Operations, MaxParallel)
+        if StatePath is not None:
+            state.save(StatePath)
+            print(bcolors.OKGREEN + "Audit state saved to " + StatePath + bcolors.ENDC)
+
+    audit = ComplianceAudit(state, Operations)
+    count = 0
+    reportFile = open(ReportPath, mode='w') if ReportPath is not None else None
+    try:
+        for entry in EntriesFactory():
+            for item in audit.auditEntry(entry):
+                count += 1
+                if reportFile is not None:
+                    reportFile.write(json.dumps(item) + "\n")
+                else:
+                    printFinding(item)
+    finally:
+        if reportFile is not None:
+            reportFile.close()
+
+    totals = audit.totals
+    color = bcolors.OKGREEN if count == 0 else bcolors.FAIL
+    print(color + "Audited " + str(totals["virtualMachines"]) + " virtual machines for " + " and ".join(Operations) + ": " + str(totals["compliant"]) + " compliant, " + str(totals[VM_NOT_FOUND]) + " not found, " + str(totals[IDENTITY_NOT_ENABLED]) + " without identity, " + str(totals[ROLE_MISSING]) + " missing role assignments" + bcolors.ENDC)
+    if reportFile is not None:
+        print(bcolors.OKGREEN + "Report written to " + ReportPath + bcolors.ENDC)
+    return count
@@ -0,0 +1,106 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import json
+import shutil
+import subprocess
+import time
+
+import retry
+import tracing
+
+class AzCommandError(Exception):
+    def __init__(self, Message, Result=None):
+        Exception.__init__(self, Message)
+        self.result = Result
+
+class CommandResult:
+    def __init__(self, Args, ReturnCode, Stdout, Stderr, Duration, StatusCode=None, RetryAfter=None):
+        self.args = Args
+        self.returnCode = ReturnCode
+        self.stdout = Stdout
+        self.stderr = Stderr
+        self.duration = Duration
+        # HTTP status code for calls made by the REST backend, None for az commands
+        self.statusCode = StatusCode
+        # Seconds from the Retry-After header of a throttled or unavailable response
+        self.retryAfter = RetryAfter
+
+    @property
+    def succeeded(self):
+        return self.returnCode == 0
+
+    def json(self):
+        # az prints nothing for commands such as 'vm identity show' on a VM without identity
+        return json.loads(self.stdout) if self.stdout.strip() else None
+
+    def errorText(self):
+        return self.stderr.strip() or ("exit code " + str(self.returnCode))
+
+def azExecutable():
+    # Resolved from PATH on every call so a different az (for example a test double) can be swapped in
+    return shutil.which("az") or "az"
+
+def runAz(Args, Interactive=False):
+    # Runs one az command with JSON output captured in memory. Never raises on a non-zero exit code,
+    # the CommandResult carries the exit code, output and duration. Throttled and transient failures
+    # are retried under the shared retry policy. Interactive commands such as 'az login' run once and
+    # keep stderr attached to the console so prompts stay visible.
+    if Interactive:
+        return runAzOnce(Args, Interactive)
+
+    return retry.getRetryPolicy().run(lambda: runAzOnce(Args))
+
+def azOperationName(Args):
+    # 'az role assignment list' for ["role", "assignment", "list", "--assignee", ...]
+    words = []
+    for arg in Args:
+        if arg.startswith("-"):
+            break
+        words.append(arg)
+    return " ".join(["az"] + words)
+
+def runAzOnce(Args, Interactive=False):
+    command = [azExecutable()] + list(Args) + ["-o", "json", "--only-show-errors"]
+    started = time.time()
+
+    with tracing.span(azOperationName(Args), tracing.CALL) as span:
+        try:
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=None if Interactive else subprocess.PIPE, universal_newlines=True)
+        except OSError as e:
+            span.setOutcome("error")
+            return CommandResult(command, 127, "", str(e), time.time() - started)
+
+        if process.returncode != 0:
+            span.setOutcome("exit " + str(process.returncode))
+
+    return CommandResult(command, process.returncode, process.stdout or "", process.stderr or "", time.time() - started)
+
+def invokeAz(Args, ErrorMessage):
+    # Runs an az command and returns its parsed JSON output, raising AzCommandError on failure
+    result = runAz(Args)
+
+    if not result.succeeded:
+        raise AzCommandError(ErrorMessage + ": " + result.errorText(), result)
+
+    return result.json()
@@ -0,0 +1,379 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import http.client
+import json
+import re
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit, quote
+
+import retry
+import tracing
+from lookupcache import cachedLookup, getLookupCache, ROLE_DEFINITIONS
+from azcli import AzCommandError, CommandResult, runAz, invokeAz
+from models import RoleAssignment, VmIdentity, VmMetadata, ManagedIdentity, servicePrincipalObjectId
+
+ARM_ENDPOINT = "https://management.azure.com"
+GRAPH_ENDPOINT = "https://graph.microsoft.com"
+ARM_RESOURCE = "https://management.azure.com/"
+GRAPH_RESOURCE = "https://graph.microsoft.com/"
+
+COMPUTE_API_VERSION = "2023-03-01"
+AUTHORIZATION_API_VERSION = "2022-04-01"
+MANAGED_IDENTITY_API_VERSION = "2023-01-31"
+RESOURCE_GRAPH_API_VERSION = "2021-03-01"
+
+# Service limits of a Resource Graph query: rows per page and subscriptions per request
+RESOURCE_GRAPH_PAGE_SIZE = 1000
+RESOURCE_GRAPH_MAX_SUBSCRIPTIONS = 1000
+
+# az ad sp show output for a service principal Graph does not know (yet)
+SERVICE_PRINCIPAL_NOT_FOUND_PATTERN = re.compile(r"Request_ResourceNotFound|Resource '[^']*' does not exist", re.IGNORECASE)
+
+def vmResourceId(Subscription, ResourceGroup, VirtualMachineName):
+    return "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines/{}".format(Subscription, ResourceGroup, VirtualMachineName)
+
+def resourceTypeOf(Path):
+    # Last resource type in an ARM or Graph path, 'roleAssignments' for
+    # /subscriptions/{id}/providers/Microsoft.Authorization/roleAssignments/{name}
+    segments = [segment for segment in Path.split('?')[0].split('/') if segment]
+    if len(segments) and segments[0].lower() in ("v1.0", "beta"):
+        segments = segments[1:]
+
+    resourceType = None
+    index = 0
+    while index < len(segments):
+        if segments[index].lower() == "providers":
+            index += 2
+            continue
+        resourceType = segments[index]
+        index += 2
+    return resourceType or "root"
+
+def armErrorCode(Result):
+    # The code of an ARM error response, {"error": {"code": ..., "message": ...}}, or None
+    try:
+        return ((Result.json() or {}).get("error") or {}).get("code")
+    except (ValueError, AttributeError):
+        return None
+
+def chunks(Items, Size):
+    for start in range(0, len(Items), Size):
+        yield Items[start:start + Size]
+
+def mergeIdentityType(Identity, SystemAssigned, UserAssigned):
+    # Identity type after enabling the requested kind while keeping what the VM already has
+    systemAssigned = SystemAssigned or Identity.hasSystemAssigned
+    userAssigned = UserAssigned or len(Identity.userAssignedIdentities) > 0
+    if systemAssigned and userAssigned:
+        return "SystemAssigned, UserAssigned"
+    return "SystemAssigned" if systemAssigned else "UserAssigned"
+
+class AzCliBackend:
+    # Every operation is one az process. Operations raise AzCommandError on failure.
+    name = "cli"
+
+    def getSubscriptionId(self):
+        return invokeAz(["account", "show"], "Failed to read the current subscription context")["id"]
+
+    def showManagedIdentity(self, IdentityId):
+        return ManagedIdentity.fromJson(invokeAz(["identity", "show", "--ids", IdentityId], "Given user assigned identity is not found"))
+
+    def showVirtualMachine(self, Subscription, ResourceGroup, VirtualMachineName):
+        return invokeAz(["vm", "show", "-n", VirtualMachineName, "-g", ResourceGroup, "--subscription", Subscription], "Failed to get virtual machine " + VirtualMachineName)
+
+    def listVirtualMachines(self, Subscription, ResourceGroup):
+        return [VmMetadata.fromJson(item) for item in invokeAz(["vm", "list", "-g", ResourceGroup, "--subscription", Subscription], "Failed to list virtual machines in resource group " + ResourceGroup) or []]
+
+    def showVmIdentity(self, Subscription, ResourceGroup, VirtualMachineName):
+        return VmIdentity.fromJson(invokeAz(["vm", "identity", "show", "-n", VirtualMachineName, "-g", ResourceGroup, "--subscription", Subscription], "Failed to read identity of virtual machine " + VirtualMachineName))
+
+    def assignVmIdentity(self, Subscription, ResourceGroup, VirtualMachineName, UserAssignedIdentityId=None):
+        args = ["vm", "identity", "assign", "-n", VirtualMachineName, "-g", ResourceGroup, "--subscription", Subscription]
+        if UserAssignedIdentityId is not None:
+            args += ["--identities", UserAssignedIdentityId]
+        invokeAz(args, "Failed to assign identity to virtual machine " + VirtualMachineName)
+
+    def listRoleAssignments(self, PrincipalId, Subscription):
+        # --include-inherited adds assignments on the management groups above the subscription
+        data = invokeAz(["role", "assignment", "list", "--all", "--include-inherited", "--assignee", PrincipalId, "--subscription", Subscription], "Failed to list role assignments of " + PrincipalId)
+        return [RoleAssignment.fromJson(item) for item in data or []]
+
+    def listAllRoleAssignments(self, Subscription):
+        # Every assignment in the subscription, including inherited ones. Principal names are not
+        # needed and resolving them would cost a Graph lookup per principal.
+        data = invokeAz(["role", "assignment", "list", "--all", "--include-inherited", "--fill-principal-name", "false", "--subscription", Subscription], "Failed to list role assignments in subscription " + Subscription)
+        return [RoleAssignment.fromJson(item) for item in data or []]
+
+    def queryResourceGraph(self, Query, Subscriptions):
+        # Yields the rows of a Resource Graph query page by page, needs the resource-graph az extension
+        for subscriptions in chunks(list(Subscriptions), RESOURCE_GRAPH_MAX_SUBSCRIPTIONS):
+            skipToken = None
+            while True:
+                args = ["graph", "query", "-q", Query, "--first", str(RESOURCE_GRAPH_PAGE_SIZE), "--subscriptions"] + subscriptions
+                if skipToken is not None:
+                    args += ["--skip-token", skipToken]
+                page = invokeAz(args, "Failed to query Azure Resource Graph") or {}
+                for row in page.get("data", []):
+                    yield row
+                skipToken = page.get("skip_token")
+                if not skipToken:
+                    break
+
+    def getRoleDefinitionId(self, Subscription, RoleName):
+        # az resolves a role name again on every 'role assignment create', a resolved id skips that
+        def lookup():
+            data = invokeAz(["role", "definition", "list", "--name", RoleName, "--subscription", Subscription], "Failed to read role definition " + RoleName) or []
+            return data[0]["id"] if len(data) else None
+        return cachedLookup(Subscription, ROLE_DEFINITIONS, RoleName, lookup)
+
+    def createRoleAssignment(self, PrincipalId, RoleName, Scope, RoleDefinitionId=None):
+        try:
+            return RoleAssignment.fromJson(invokeAz(["role", "assignment", "create", "--assignee", PrincipalId, "--role", RoleDefinitionId or RoleName, "--scope", Scope], "Failed to assign role " + RoleName + " to " + PrincipalId + " on " + Scope))
+        except AzCommandError as e:
+            # Another run created the same assignment after it was last listed
+            if "RoleAssignmentExists" in str(e) or "already exists" in str(e):
+                return RoleAssignment(PrincipalId, Scope, RoleName)
+            raise
+
+    def findServicePrincipalIds(self, DisplayName):
+        return [servicePrincipalObjectId(item) for item in invokeAz(["ad", "sp", "list", "--display-name", DisplayName], "Failed to get " + DisplayName + " Principal Id") or []]
+
+    def servicePrincipalExists(self, PrincipalId):
+        # Only a principal that is not found yet is still propagating, any other failure is raised
+        result = runAz(["ad", "sp", "show", "--id", PrincipalId])
+        if result.succeeded:
+            return True
+        if SERVICE_PRINCIPAL_NOT_FOUND_PATTERN.search(result.stderr):
+            return False
+        raise AzCommandError("Failed to read service principal " + PrincipalId + ": " + result.errorText(), result)
+
+class ArmRestBackend:
+    # Calls Azure Resource Manager and Microsoft Graph directly. Connections are kept alive and
+    # pooled per worker thread, and one access token per resource is reused until it nears expiry.
+    name = "rest"
+
+    def __init__(self, ArmEndpoint=None, GraphEndpoint=None, Timeout=60):
+        self.armEndpoint = (ArmEndpoint or ARM_ENDPOINT).rstrip('/')
+        self.graphEndpoint = (GraphEndpoint or GRAPH_ENDPOINT).rstrip('/')
+        self.timeout = Timeout
+        self.local = threading.local()
+        self.tokenLock = threading.Lock()
+        self.tokens = {}
+        self.roleDefinitionLock = threading.Lock()
+        self.roleDefinitions = {}
+
+    def getAccessToken(self, Resource):
+        with self.tokenLock:
+            token = self.tokens.get(Resource)
+            if token is None or token[1] - time.time() < 300:
+                data = invokeAz(["account", "get-access-token", "--resource", Resource], "Failed to get an access token for " + Resource)
+                # 'expires_on' (epoch seconds) is only returned by newer az versions
+                expiresOn = float(data["expires_on"]) if data.get("expires_on") else time.time() + 1800
+                token = (data["accessToken"], expiresOn)
+                self.tokens[Resource] = token
+            return token[0]
+
+    def getConnection(self, Scheme, Host):
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+
+        connection = connections.get((Scheme, Host))
+        if connection is None:
+            connectionClass = http.client.HTTPSConnection if Scheme == "https" else http.client.HTTPConnection
+            connection = connections[(Scheme, Host)] = connectionClass(Host, timeout=self.timeout)
+        return connection
+
+    def dropConnection(self, Scheme, Host):
+        connection = self.local.connections.pop((Scheme, Host), None)
+        if connection is not None:
+            connection.close()
+
+    def send(self, Method, Url, Resource, Body=None):
+        # Sends one request under the shared retry policy and returns a CommandResult with the HTTP status in statusCode
+        return retry.getRetryPolicy().run(lambda: self.sendOnce(Method, Url, Resource, Body))
+
+    def sendOnce(self, Method, Url, Resource, Body=None):
+        # A request on a pooled connection the server already closed is repeated once on a new one
+        parts = urlsplit(Url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = {"Authorization": "Bearer " + self.getAccessToken(Resource), "Accept": "application/json"}
+        payload = None
+        if Body is not None:
+            payload = json.dumps(Body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        started = time.time()
+        with tracing.span("rest " + Method + " " + resourceTypeOf(parts.path), tracing.CALL) as span:
+            for attempt in range(2):
+                connection = self.getConnection(parts.scheme, parts.netloc)
+                try:
+                    connection.request(Method, path, body=payload, headers=headers)
+                    response = connection.getresponse()
+                    text = response.read().decode("utf-8")
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    self.dropConnection(parts.scheme, parts.netloc)
+                    if attempt == 1:
+                        span.setOutcome("error")
+                        return CommandResult([Method, Url], retry.TRANSPORT_FAILURE, "", "Request " + Method + " " + Url + " failed: " + str(e), time.time() - started)
+
+            span.setOutcome("HTTP " + str(response.status))
+
+        succeeded = 200 <= response.status < 300
+        return CommandResult([Method, Url], 0 if succeeded else response.status, text, "" if succeeded else "HTTP " + str(response.status) + " " + text, time.time() - started, response.status, retry.parseRetryAfter(response.getheader("Retry-After")))
+
+    def request(self, Method, Url, Resource, ErrorMessage, Body=None, AllowedStatus=()):
+        result = self.send(Method, Url, Resource, Body)
+        if not result.succeeded and result.statusCode not in AllowedStatus:
+            raise AzCommandError(ErrorMessage + ": " + result.errorText(), result)
+        return result
+
+    def arm(self, Method, Path, ApiVersion, ErrorMessage, Body=None, AllowedStatus=()):
+        separator = "&" if "?" in Path else "?"
+        return self.request(Method, self.armEndpoint + Path + separator + "api-version=" + ApiVersion, ARM_RESOURCE, ErrorMessage, Body, AllowedStatus)
+
+    def armList(self, Path, ApiVersion, ErrorMessage):
+        items = []
+        result = self.arm("GET", Path, ApiVersion, ErrorMessage)
+        while True:
+            page = result.json() or {}
+            items.extend(page.get("value", []))
+            if not page.get("nextLink"):
+                return items
+            result = self.request("GET", page["nextLink"], ARM_RESOURCE, ErrorMessage)
+
+    def graph(self, Path, ErrorMessage, AllowedStatus=()):
+        return self.request("GET", self.graphEndpoint + Path, GRAPH_RESOURCE, ErrorMessage, AllowedStatus=AllowedStatus)
+
+    def fetchRoleDefinitions(self, Subscription):
+        byId = {}
+        byName = {}
+        for item in self.armList("/subscriptions/{}/providers/Microsoft.Authorization/roleDefinitions".format(Subscription), AUTHORIZATION_API_VERSION, "Failed to list role definitions"):
+            roleName = item["properties"]["roleName"]
+            byId[item["name"].lower()] = roleName
+            byName[roleName.lower()] = item["id"]
+        return {"byId": byId, "byName": byName}
+
+    def loadRoleDefinitions(self, Subscription, Refresh=False):
+        # Role definition id <-> name maps for the subscription, fetched once and kept in the lookup cache
+        with self.roleDefinitionLock:
+            definitions = self.roleDefinitions.get(Subscription.lower())
+            if definitions is None or Refresh:
+                if Refresh and getLookupCache() is not None:
+                    getLookupCache().invalidate(Subscription, ROLE_DEFINITIONS)
+                data = cachedLookup(Subscription, ROLE_DEFINITIONS, Subscription, lambda: self.fetchRoleDefinitions(Subscription))
+                definitions = self.roleDefinitions[Subscription.lower()] = (data["byId"], data["byName"])
+            return definitions
+
+    def getSubscriptionId(self):
+        return invokeAz(["account", "show"], "Failed to read the current subscription context")["id"]
+
+    def showManagedIdentity(self, IdentityId):
+        data = self.arm("GET", IdentityId, MANAGED_IDENTITY_API_VERSION, "Given user assigned identity is not found").json()
+        properties = data.get("properties", {})
+        return ManagedIdentity(data.get("id"), data.get("name"), properties.get("principalId"), properties.get("clientId"))
+
+    def showVirtualMachine(self, Subscription, ResourceGroup, VirtualMachineName):
+        return self.arm("GET", vmResourceId(Subscription, ResourceGroup, VirtualMachineName), COMPUTE_API_VERSION, "Failed to get virtual machine " + VirtualMachineName).json()
+
+    def listVirtualMachines(self, Subscription, ResourceGroup):
+        path = "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines".format(Subscription, ResourceGroup)
+        return [VmMetadata.fromJson(item) for item in self.armList(path, COMPUTE_API_VERSION, "Failed to list virtual machines in resource group " + ResourceGroup)]
+
+    def showVmIdentity(self, Subscription, ResourceGroup, VirtualMachineName):
+        return VmIdentity.fromJson(self.showVirtualMachine(Subscription, ResourceGroup, VirtualMachineName).get("identity"))
+
+    def assignVmIdentity(self, Subscription, ResourceGroup, VirtualMachineName, UserAssignedIdentityId=None):
+        identity = self.showVmIdentity(Subscription, ResourceGroup, VirtualMachineName)
+        body = {"identity": {"type": mergeIdentityType(identity, UserAssignedIdentityId is None, UserAssignedIdentityId is not None)}}
+        if UserAssignedIdentityId is not None:
+            body["identity"]["userAssignedIdentities"] = {UserAssignedIdentityId: {}}
+        self.arm("PATCH", vmResourceId(Subscription, ResourceGroup, VirtualMachineName), COMPUTE_API_VERSION, "Failed to assign identity to virtual machine " + VirtualMachineName, body)
+
+    def fetchRoleAssignments(self, Subscription, Path, ErrorMessage):
+        byId = self.loadRoleDefinitions(Subscription)[0]
+        assignments = []
+        for item in self.armList(Path, AUTHORIZATION_API_VERSION, ErrorMessage):
+            properties = item["properties"]
+            roleDefinitionId = properties["roleDefinitionId"]
+            assignments.append(RoleAssignment(properties["principalId"], properties["scope"], byId.get(roleDefinitionId.split('/')[-1].lower()), roleDefinitionId, item["id"]))
+        return assignments
+
+    def listRoleAssignments(self, PrincipalId, Subscription):
+        # The principalId filter returns the assignments at, above and below the subscription
+        path = "/subscriptions/{}/providers/Microsoft.Authorization/roleAssignments?$filter={}".format(Subscription, quote("principalId eq '{}'".format(PrincipalId)))
+        return self.fetchRoleAssignments(Subscription, path, "Failed to list role assignments of " + PrincipalId)
+
+    def listAllRoleAssignments(self, Subscription):
+        path = "/subscriptions/{}/providers/Microsoft.Authorization/roleAssignments".format(Subscription)
+        return self.fetchRoleAssignments(Subscription, path, "Failed to list role assignments in subscription " + Subscription)
+
+    def queryResourceGraph(self, Query, Subscriptions):
+        # Yields the rows of a Resource Graph query page by page
+        for subscriptions in chunks(list(Subscriptions), RESOURCE_GRAPH_MAX_SUBSCRIPTIONS):
+            body = {"subscriptions": subscriptions, "query": Query, "options": {"$top": RESOURCE_GRAPH_PAGE_SIZE, "resultFormat": "objectArray"}}
+            while True:
+                page = self.arm("POST", "/providers/Microsoft.ResourceGraph/resources", RESOURCE_GRAPH_API_VERSION, "Failed to query Azure Resource Graph", body).json() or {}
+                for row in page.get("data", []):
+                    yield row
+                if not page.get("$skipToken"):
+                    break
+                body["options"]["$skipToken"] = page["$skipToken"]
+
+    def getRoleDefinitionId(self, Subscription, RoleName):
+        roleDefinitionId = self.loadRoleDefinitions(Subscription)[1].get(RoleName.lower())
+        if roleDefinitionId is None:
+            # The role may have been defined after the role definitions were cached
+            roleDefinitionId = self.loadRoleDefinitions(Subscription, Refresh=True)[1].get(RoleName.lower())
+        return roleDefinitionId
+
+    def createRoleAssignment(self, PrincipalId, RoleName, Scope, RoleDefinitionId=None):
+        subscription = Scope.split('/')[2]
+        roleDefinitionId = RoleDefinitionId or self.getRoleDefinitionId(subscription, RoleName)
+        if roleDefinitionId is None:
+            raise AzCommandError("Role " + RoleName + " is not defined in subscription " + subscription)
+
+        path = Scope.rstrip('/') + "/providers/Microsoft.Authorization/roleAssignments/" + str(uuid.uuid4())
+        body = {"properties": {"roleDefinitionId": roleDefinitionId, "principalId": PrincipalId}}
+        errorMessage = "Failed to assign role " + RoleName + " to " + PrincipalId + " on " + Scope
+        result = self.arm("PUT", path, AUTHORIZATION_API_VERSION, errorMessage, body, AllowedStatus=(409,))
+        # RoleAssignmentExists means another run created the same assignment first, other conflicts are failures
+        if not result.succeeded and armErrorCode(result) != "RoleAssignmentExists":
+            raise AzCommandError(errorMessage + ": " + result.errorText(), result)
+        return RoleAssignment(PrincipalId, Scope, RoleName, roleDefinitionId)
+
+    def findServicePrincipalIds(self, DisplayName):
+        path = "/v1.0/servicePrincipals?$filter=" + quote("displayName eq '{}'".format(DisplayName))
+        return [item["id"] for item in self.graph(path, "Failed to get " + DisplayName + " Principal Id").json().get("value", [])]
+
+    def servicePrincipalExists(self, PrincipalId):
+        return self.graph("/v1.0/servicePrincipals/" + PrincipalId, "Failed to read service principal " + PrincipalId, AllowedStatus=(404,)).succeeded
+
+def createBackend(Name, ArmEndpoint=None, GraphEndpoint=None):
+    if Name == ArmRestBackend.name:
+        return ArmRestBackend(ArmEndpoint, GraphEndpoint)
+    return AzCliBackend()
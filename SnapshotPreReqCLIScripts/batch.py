@@ -0,0 +1,213 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import csv
+import json
+import os
+import sys
+from collections import Counter, OrderedDict
+
+import helpers
+from azcli import AzCommandError
+from helpers import bcolors, normalizeScope, roleAssignmentKey, getCurrentSubscriptionId, setSubscriptionContext, prefetchPrincipals, findEffectiveAssignment, isRoleJournaled, recordRoleAssignment, createRoleAssignment, getRoleDefinitionId, resetRoleAssignmentIndex, runParallel, printRerunHint
+
+# Batch file columns (CSV header) or keys (JSON lines). A row names either a scope, or a
+# resourceGroup in the given subscription (the --subscription argument or the current one).
+BATCH_FIELDS = ["principalId", "role", "scope", "resourceGroup", "subscription"]
+
+# Row results
+CREATED = "created"
+EXISTS = "exists"
+INHERITED = "inherited"
+FAILED = "failed"
+INVALID = "invalid"
+
+class BatchRow:
+    def __init__(self, Number, PrincipalId, RoleName, Scope, Error=None):
+        self.number = Number
+        self.principalId = PrincipalId
+        self.roleName = RoleName
+        self.scope = Scope
+        self.status = INVALID if Error is not None else None
+        self.error = Error
+        # Scope of the existing assignment that grants the role, for exists and inherited
+        self.coveredBy = None
+        # Number of the first row asking for the same assignment, which is the one processed
+        self.duplicateOf = None
+
+    @property
+    def subscription(self):
+        segments = self.scope.strip('/').split('/')
+        return segments[1] if len(segments) > 1 and segments[0].lower() == "subscriptions" else None
+
+    def key(self):
+        return roleAssignmentKey(self.principalId, self.scope, self.roleName)
+
+    def toJson(self):
+        return OrderedDict([
+            ("row", self.number),
+            ("principalId", self.principalId),
+            ("role", self.roleName),
+            ("scope", self.scope),
+            ("status", self.status),
+            ("coveredBy", self.coveredBy),
+            ("duplicateOf", self.duplicateOf),
+            ("error", self.error),
+        ])
+
+def parseBatchLine(Line):
+    # The record of a JSON lines row, or the error text for a line that holds no JSON object
+    try:
+        record = json.loads(Line)
+    except ValueError as e:
+        return "Not valid JSON: " + str(e)
+    return record if isinstance(record, dict) else "Not a JSON object"
+
+def readBatchRows(Path, Subscription=None):
+    # Returns one BatchRow per row of a CSV or JSON lines batch file, rows that cannot be read are INVALID
+    with open(Path, mode='r', newline='') as batchFile:
+        if Path.lower().endswith(".csv"):
+            records = list(csv.DictReader(batchFile))
+        else:
+            records = [parseBatchLine(line) for line in batchFile if line.strip()]
+
+    rows = []
+    for number, record in enumerate(records, 1):
+        if not isinstance(record, dict):
+            rows.append(BatchRow(number, "", "", "", record))
+            continue
+
+        principalId = (record.get("principalId") or "").strip()
+        roleName = (record.get("role") or record.get("roleName") or "").strip()
+        scope = (record.get("scope") or "").strip().rstrip('/')
+        resourceGroup = (record.get("resourceGroup") or "").strip()
+
+        if not scope and resourceGroup:
+            scope = "/subscriptions/{}/resourceGroups/{}".format((record.get("subscription") or "").strip() or Subscription or getCurrentSubscriptionId(), resourceGroup)
+
+        missing = [name for name, value in [("principalId", principalId), ("role", roleName), ("scope or resourceGroup", scope)] if not value]
+        rows.append(BatchRow(number, principalId, roleName, scope, "Missing " + ", ".join(missing) if len(missing) else None))
+    return rows
+
+def resolveRoleDefinitions(RoleNames, Subscription, MaxParallel):
+    # Role name -> definition id, or None for a role the subscription does not define
+    roleNames = list(OrderedDict.fromkeys(RoleNames))
+    try:
+        return dict(zip(roleNames, runParallel(roleNames, lambda roleName: getRoleDefinitionId(Subscription, roleName), MaxParallel)))
+    except AzCommandError as e:
+        print(bcolors.FAIL + "Script failed with unexpected error ... " + str(e) + bcolors.ENDC)
+        printRerunHint()
+        sys.exit(1)
+
+def applySubscriptionRows(Rows, MaxParallel):
+    # Checks the rows of the current subscription against one bulk fetch of the existing
+    # assignments and creates the missing ones in parallel
+    roleDefinitionIds = resolveRoleDefinitions([row.roleName for row in Rows], getCurrentSubscriptionId(), MaxParallel)
+    rows = []
+    for row in Rows:
+        if roleDefinitionIds[row.roleName] is None:
+            row.status = INVALID
+            row.error = "Role " + row.roleName + " is not defined in subscription " + getCurrentSubscriptionId()
+        else:
+            rows.append(row)
+
+    prefetchPrincipals([row.principalId for row in rows if not isRoleJournaled(row.principalId, row.scope, row.roleName)], MaxParallel)
+
+    missing = []
+    for row in rows:
+        if isRoleJournaled(row.principalId, row.scope, row.roleName):
+            row.status = EXISTS
+            continue
+
+        assignment = findEffectiveAssignment(row.principalId, row.scope, row.roleName)
+        if assignment is None:
+            missing.append(row)
+            continue
+
+        row.coveredBy = assignment.scope
+        row.status = EXISTS if normalizeScope(assignment.scope) == normalizeScope(row.scope) else INHERITED
+        recordRoleAssignment(row.principalId, row.scope, row.roleName)
+
+    print(bcolors.OKBLUE + "Assigning " + str(len(missing)) + " missing roles in subscription " + getCurrentSubscriptionId() + ", " + str(len(rows) - len(missing)) + " already granted" + bcolors.ENDC)
+    errors = runParallel(missing, lambda row: createRoleAssignment(row.principalId, row.roleName, row.scope, roleDefinitionIds[row.roleName]), MaxParallel)
+
+    for row, error in zip(missing, errors):
+        if error is None:
+            row.status = CREATED
+            recordRoleAssignment(row.principalId, row.scope, row.roleName)
+        else:
+            row.status = FAILED
+            row.error = error
+            print(bcolors.FAIL + "Row " + str(row.number) + ": " + error + bcolors.ENDC)
+
+def runBatch(Path, ResultPath=None, Subscription=None, MaxParallel=helpers.DEFAULT_MAX_PARALLEL):
+    # Assigns the roles listed in a batch file. Rows asking for the same assignment are processed
+    # once, rows are grouped by subscription, role names are resolved once per subscription and
+    # existing assignments are read in bulk before only the missing ones are created. Writes one
+    # JSON line per row to ResultPath, by default next to the batch file.
+    rows = readBatchRows(Path, Subscription)
+    resultPath = ResultPath or os.path.splitext(Path)[0] + ".result.jsonl"
+
+    unique = OrderedDict()
+    for row in rows:
+        if row.status == INVALID:
+            continue
+        if row.key() in unique:
+            row.duplicateOf = unique[row.key()].number
+        else:
+            unique[row.key()] = row
+
+    # Scopes outside a subscription, such as management groups, are checked in the current one
+    groups = OrderedDict()
+    for row in unique.values():
+        groups.setdefault((row.subscription or getCurrentSubscriptionId()).lower(), []).append(row)
+    print(bcolors.OKBLUE + "Read " + str(len(rows)) + " rows with " + str(len(unique)) + " distinct role assignments in " + str(len(groups)) + " subscriptions from " + Path + bcolors.ENDC)
+
+    for subscription, group in groups.items():
+        if subscription != getCurrentSubscriptionId().lower():
+            setSubscriptionContext(group[0].subscription, Login=False)
+        applySubscriptionRows(group, MaxParallel)
+        resetRoleAssignmentIndex()
+
+    for row in rows:
+        if row.duplicateOf is not None:
+            first = unique[row.key()]
+            row.status, row.coveredBy, row.error = first.status, first.coveredBy, first.error
+
+    with open(resultPath, mode='w') as resultFile:
+        for row in rows:
+            resultFile.write(json.dumps(row.toJson()) + "\n")
+
+    statuses = Counter(row.status for row in rows)
+    color = bcolors.FAIL if statuses[FAILED] or statuses[INVALID] else bcolors.OKGREEN
+    print(color + "Batch " + Path + ": " + ", ".join(str(statuses[status]) + " " + status for status in [CREATED, EXISTS, INHERITED, FAILED, INVALID]) + ". Results written to " + resultPath + bcolors.ENDC)
+
+    if statuses[FAILED]:
+        printRerunHint()
+    if statuses[FAILED] or statuses[INVALID]:
+        sys.exit(1)
+
+def addBatchArguments(Parser, Columns):
+    Parser.add_argument("--file", "-f", metavar="BATCH_FILE", help="Assign the roles listed in a CSV or JSON lines file with one role assignment per row (" + Columns + ") instead of asking for one")
+    Parser.add_argument("--result", metavar="RESULT_FILE", help="File receiving one JSON line with the outcome of each batch row (default <BATCH_FILE without extension>.result.jsonl)")
+    Parser.add_argument("--subscription", "-s", help="Subscription of batch rows that name a resource group without a subscription (default the current subscription)")
@@ -0,0 +1,263 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+# Runs the permission scripts end to end against a simulated Azure, either the fake az CLI in
+# fakeaz/ or the mock ARM endpoint in mockarm.py, over a matrix of virtual machine counts and disk
+# resource group counts, and reports wall time, Azure call counts and calls per second. Every run
+# starts from a freshly seeded state in its own directory and is checked for completeness. The
+# read-only audit is checked instead for reporting exactly the permissions the state is missing.
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import simulator
+from mockarm import MockArmServer
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+FAKE_AZ_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, "fakeaz")
+
+SCRIPTS = {
+    "backup": "SetWorkloadSnapshotBackupPermissions.py",
+    "restore": "SetWorkloadSnapshotRestorePermissions.py",
+    "identity": "AssignIdentity.py",
+    "audit": "AuditWorkloadSnapshotPermissions.py",
+}
+
+VM_RESOURCE_GROUP = "workload"
+SNAPSHOT_RESOURCE_GROUP = "snapshots"
+
+def diskResourceGroupsFor(Count):
+    return ["disks" + str(index) for index in range(Count)]
+
+def scriptArguments(Script, VmNames, DiskResourceGroups, IdentityId):
+    if Script == "identity":
+        args = ["--subscription", simulator.SUBSCRIPTION_ID, "--virtual-machine-resource-group", VM_RESOURCE_GROUP, "--virtual-machine-names"] + VmNames
+        return args + (["--user-assigned-service-identity-id", IdentityId] if IdentityId else [])
+
+    args = ["--subscription", simulator.SUBSCRIPTION_ID, "--vm-resource-group", VM_RESOURCE_GROUP, "--vm-names"] + VmNames + ["--disk-resource-groups"] + DiskResourceGroups + ["--snapshot-resource-group", SNAPSHOT_RESOURCE_GROUP]
+    return args + (["--identity-id", IdentityId] if IdentityId else [])
+
+def expectedPermissions(Script, State, VmNames, DiskResourceGroups, IdentityId):
+    # Role assignments the script should leave in place and the number of VMs without the identity.
+    # The roles of a user assigned identity are expected even on VMs it is not attached to.
+    subscription = State["subscription"]
+    snapshotScope = simulator.resourceGroupScope(subscription, SNAPSHOT_RESOURCE_GROUP)
+    diskScopes = [simulator.resourceGroupScope(subscription, diskResourceGroup) for diskResourceGroup in DiskResourceGroups]
+    identityPrincipalId = State["userAssignedIdentities"][IdentityId.lower()]["principalId"] if IdentityId else None
+    expected = []
+    withoutIdentity = 0
+
+    for name in VmNames:
+        vm = State["vms"][(VM_RESOURCE_GROUP + "/" + name).lower()]
+        identity = vm.get("identity") or {}
+        if IdentityId:
+            principalId = identityPrincipalId
+            enabled = IdentityId.lower() in [key.lower() for key in (identity.get("userAssignedIdentities") or {})]
+        else:
+            principalId = identity.get("principalId")
+            enabled = principalId is not None
+
+        if not enabled:
+            withoutIdentity += 1
+        if principalId is None:
+            continue
+
+        if Script == "backup":
+            expected += [(principalId, scope, "Disk Backup Reader") for scope in diskScopes]
+            expected.append((principalId, snapshotScope, "Disk Snapshot Contributor"))
+        elif Script == "restore":
+            expected += [(principalId, scope, "Disk Restore Operator") for scope in diskScopes]
+            expected.append((principalId, snapshotScope, "Disk Snapshot Contributor"))
+            expected.append((principalId, vm["id"], "Virtual Machine Contributor"))
+
+    if Script == "backup":
+        expected.append((simulator.BACKUP_MANAGEMENT_SERVICE_PRINCIPAL_ID, snapshotScope, "Disk Snapshot Contributor"))
+
+    return set(expected), withoutIdentity
+
+def missingPermissions(Script, State, VmNames, DiskResourceGroups, IdentityId):
+    # Number of identities and role assignments the script should have left in place but did not
+    expected, withoutIdentity = expectedPermissions(Script, State, VmNames, DiskResourceGroups, IdentityId)
+    roles = simulator.EffectiveRoles(State)
+    return withoutIdentity + len([permission for permission in expected if not roles.isEffective(*permission)])
+
+def auditDisagreements(State, ReportPath, VmNames, DiskResourceGroups, IdentityId):
+    # Number of permissions the state is missing but the audit report does not list, plus findings
+    # in the report the state does not confirm
+    roles = simulator.EffectiveRoles(State)
+    missing = set()
+    for script in ("backup", "restore"):
+        expected, withoutIdentity = expectedPermissions(script, State, VmNames, DiskResourceGroups, IdentityId)
+        missing.update((principalId.lower(), scope.lower(), roleName.lower()) for principalId, scope, roleName in expected if not roles.isEffective(principalId, scope, roleName))
+
+    reported = set()
+    reportedWithoutIdentity = 0
+    if os.path.isfile(ReportPath):
+        with open(ReportPath, mode='r') as reportFile:
+            for line in reportFile:
+                finding = json.loads(line)
+                if finding["issue"] == "identityNotEnabled":
+                    reportedWithoutIdentity += 1
+                elif finding["principalId"] is not None:
+                    reported.add((finding["principalId"].lower(), finding["scope"].lower(), finding["roleName"].lower()))
+    return len(missing ^ reported) + abs(withoutIdentity - reportedWithoutIdentity)
+
+def readCallLog(Path):
+    # Counter of az commands and of their outcomes from the fake az log
+    commands = Counter()
+    outcomes = Counter()
+    if os.path.isfile(Path):
+        with open(Path, mode='r') as logFile:
+            for line in logFile:
+                command, _, outcome = line.rstrip("\n").partition("\t")
+                commands["az " + command] += 1
+                outcomes[outcome] += 1
+    return commands, outcomes
+
+def runOnce(Args, Script, Backend, VmCount, DiskResourceGroupCount):
+    workDirectory = tempfile.mkdtemp(prefix="snapshot-benchmark-")
+    statePath = os.path.join(workDirectory, "state.json")
+    logPath = os.path.join(workDirectory, "az.log")
+    diskResourceGroups = diskResourceGroupsFor(DiskResourceGroupCount)
+    settings = simulator.Settings(Args.latency, Args.failure_rate, Args.throttle_rate, Args.propagation)
+
+    vmNames, identityId = simulator.seedState(statePath, VM_RESOURCE_GROUP, VmCount, Args.prepared, diskResourceGroups, SNAPSHOT_RESOURCE_GROUP, Args.extra_assignments, Args.prepared_at_subscription)
+    identityId = identityId if Args.user_assigned else None
+
+    reportPath = os.path.join(workDirectory, "report.jsonl")
+    command = [sys.executable, os.path.join(SCRIPT_DIRECTORY, SCRIPTS[Script])] + scriptArguments(Script, vmNames, diskResourceGroups, identityId)
+    command += ["--max-parallel", str(Args.max_parallel), "--cache-file", os.path.join(workDirectory, "cache.json")]
+    command += ["--report", reportPath] if Script == "audit" else ["--journal", os.path.join(workDirectory, "journal.jsonl")]
+    command += shlex.split(Args.script_args)
+
+    environment = dict(os.environ)
+    environment.update(settings.toEnvironment())
+    environment.update({"PATH": FAKE_AZ_DIRECTORY + os.pathsep + environment.get("PATH", ""), "FAKE_AZ_STATE": statePath, "FAKE_AZ_LOG": logPath})
+
+    server = None
+    if Backend == "rest":
+        server = MockArmServer(statePath, settings).start()
+        command += ["--backend", "rest", "--arm-endpoint", server.endpoint, "--graph-endpoint", server.endpoint]
+
+    started = time.perf_counter()
+    with open(os.path.join(workDirectory, "output.log"), mode='w') as output:
+        returnCode = subprocess.call(command, cwd=workDirectory, env=environment, stdout=output, stderr=subprocess.STDOUT, timeout=Args.timeout)
+    wall = time.perf_counter() - started
+
+    requests = Counter()
+    httpOutcomes = Counter()
+    if server is not None:
+        server.stop()
+        requests = Counter(dict(("rest " + key, count) for key, count in server.requests.items()))
+        httpOutcomes = server.outcomes
+
+    commands, azOutcomes = readCallLog(logPath)
+    if Script == "audit":
+        missing = auditDisagreements(simulator.loadState(statePath), reportPath, vmNames, diskResourceGroups, identityId)
+    else:
+        missing = missingPermissions(Script, simulator.loadState(statePath), vmNames, diskResourceGroups, identityId)
+    calls = sum(commands.values()) + sum(requests.values())
+
+    result = {
+        "script": Script,
+        "backend": Backend,
+        "vms": VmCount,
+        "diskResourceGroups": DiskResourceGroupCount if Script != "identity" else 0,
+        "wallSeconds": round(wall, 3),
+        "azCalls": sum(commands.values()),
+        "httpRequests": sum(requests.values()),
+        "callsPerSecond": round(calls / wall, 2) if wall > 0 else 0,
+        "throttled": azOutcomes["TooManyRequests"] + httpOutcomes[429],
+        "failed": azOutcomes["ServiceUnavailable"] + httpOutcomes[503],
+        "missing": missing,
+        "returnCode": returnCode,
+        "calls": dict(commands + requests),
+        "workDirectory": workDirectory,
+    }
+
+    if Args.keep or missing:
+        print("  kept " + workDirectory + (" (" + str(missing) + " permissions missing, see output.log)" if missing else ""))
+    else:
+        shutil.rmtree(workDirectory, ignore_errors=True)
+    return result
+
+def median(Results):
+    ordered = sorted(Results, key=lambda result: result["wallSeconds"])
+    return ordered[len(ordered) // 2]
+
+def printRow(Values):
+    print("{:<9} {:<8} {:>6} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}".format(*Values))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the snapshot permission scripts end to end against a simulated Azure")
+    parser.add_argument("--scripts", nargs='+', choices=sorted(SCRIPTS), default=["backup", "restore", "identity", "audit"])
+    parser.add_argument("--backends", nargs='+', choices=["cli", "rest"], default=["cli"], help="cli runs against the fake az, rest against the mock ARM endpoint")
+    parser.add_argument("--vm-counts", nargs='+', type=int, default=[10, 50])
+    parser.add_argument("--disk-rg-counts", nargs='+', type=int, default=[1, 3])
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every az command or request (default 0.05)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of calls failing transiently")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls throttled")
+    parser.add_argument("--propagation", type=float, default=0.0, help="Seconds before a new system assigned identity resolves in Graph")
+    parser.add_argument("--prepared", type=float, default=0.0, help="Fraction of virtual machines that already have an identity and the backup roles")
+    parser.add_argument("--prepared-at-subscription", action="store_true", help="Grant the roles of the prepared virtual machines and the Backup Management Service on the subscription")
+    parser.add_argument("--extra-assignments", type=int, default=0, help="Unrelated role assignments seeded for every principal")
+    parser.add_argument("--user-assigned", action="store_true", help="Use the seeded user assigned identity instead of system assigned identities")
+    parser.add_argument("--max-parallel", type=int, default=8)
+    parser.add_argument("--script-args", default="", help="Extra arguments passed to every script, for example \"--requests-per-second 0\"")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per cell, the run with the median wall time is reported")
+    parser.add_argument("--timeout", type=float, default=3600, help="Seconds after which a run is aborted")
+    parser.add_argument("--output", help="Write one JSON line per cell, including calls per command, to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory of every run")
+    args = parser.parse_args()
+
+    if args.throttle_rate + args.failure_rate >= 1:
+        parser.error("--throttle-rate and --failure-rate must leave some calls succeeding")
+
+    output = open(args.output, mode='w') if args.output else None
+    printRow(["script", "backend", "vms", "diskRGs", "wall s", "az calls", "http reqs", "calls/s", "throttled", "failed", "missing"])
+
+    for script in args.scripts:
+        for backend in args.backends:
+            for vmCount in args.vm_counts:
+                # AssignIdentity.py has no disk resource groups, one cell per VM count is enough
+                for diskResourceGroupCount in (args.disk_rg_counts if script != "identity" else [0]):
+                    result = median([runOnce(args, script, backend, vmCount, diskResourceGroupCount) for _ in range(args.repeat)])
+                    printRow([script, backend, vmCount, result["diskResourceGroups"], "{:.2f}".format(result["wallSeconds"]), result["azCalls"], result["httpRequests"], "{:.1f}".format(result["callsPerSecond"]), result["throttled"], result["failed"], result["missing"]])
+                    if output is not None:
+                        output.write(json.dumps(result) + "\n")
+                        output.flush()
+
+    if output is not None:
+        output.close()
+
+if __name__ == "__main__":
+    main()
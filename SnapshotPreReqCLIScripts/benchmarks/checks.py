@@ -0,0 +1,222 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+# Regression checks of script behaviour that the benchmark does not measure, run against the fake
+# az in fakeaz/. Every check seeds a fresh state in its own directory.
+#
+#   python checks.py
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import traceback
+
+import benchmark
+import simulator
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+FAKE_AZ_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, "fakeaz")
+
+VM_RESOURCE_GROUP = "workload"
+DISK_RESOURCE_GROUPS = ["disks0"]
+SNAPSHOT_RESOURCE_GROUP = "snapshots"
+
+CHECKS = []
+
+def check(Function):
+    CHECKS.append(Function)
+    return Function
+
+class CheckFailed(Exception):
+    pass
+
+def expect(Condition, Message):
+    if not Condition:
+        raise CheckFailed(Message)
+
+class Workspace:
+    # A seeded state and a working directory the scripts run in
+    def __init__(self, Directory, VmCount=4, PreparedFraction=0.0):
+        self.directory = Directory
+        self.statePath = os.path.join(Directory, "state.json")
+        # Private az CLI configuration directory, the fake az keeps its login there
+        os.makedirs(os.path.join(Directory, "azure"))
+        self.vmNames, self.identityId = simulator.seedState(self.statePath, VM_RESOURCE_GROUP, VmCount, PreparedFraction, DISK_RESOURCE_GROUPS, SNAPSHOT_RESOURCE_GROUP)
+
+    def path(self, Name):
+        return os.path.join(self.directory, Name)
+
+    def environment(self):
+        environment = dict(os.environ)
+        environment.update({"PATH": FAKE_AZ_DIRECTORY + os.pathsep + environment.get("PATH", ""), "FAKE_AZ_STATE": self.statePath, "AZURE_CONFIG_DIR": self.path("azure")})
+        return environment
+
+    def login(self):
+        # Scripts that use the current login, such as the audit, expect it in place
+        subprocess.check_call([os.path.join(FAKE_AZ_DIRECTORY, "az"), "login"], cwd=self.directory, env=self.environment(), stdout=subprocess.DEVNULL)
+
+    def run(self, Script, Args, Input=None):
+        # Returns (exit code, output) of one script run
+        process = subprocess.run([sys.executable, os.path.join(SCRIPT_DIRECTORY, Script)] + Args + ["--cache-file", self.path("cache.json")], cwd=self.directory, env=self.environment(), input=Input, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=300)
+        return process.returncode, process.stdout
+
+    def backupArguments(self, VmNames=None):
+        return ["--subscription", simulator.SUBSCRIPTION_ID, "--vm-resource-group", VM_RESOURCE_GROUP, "--vm-names"] + (VmNames or self.vmNames) + ["--disk-resource-groups"] + DISK_RESOURCE_GROUPS + ["--snapshot-resource-group", SNAPSHOT_RESOURCE_GROUP]
+
+def readText(Path):
+    with open(Path, mode='r') as textFile:
+        return textFile.read()
+
+@check
+def planKeepsJournal(Workspace):
+    # A --plan run resolves the user assigned principal but must not rewrite the journal
+    journal = Workspace.path("journal.jsonl")
+    arguments = Workspace.backupArguments() + ["--identity-id", Workspace.identityId, "--journal", journal]
+    returnCode, output = Workspace.run("SetWorkloadSnapshotBackupPermissions.py", arguments)
+    expect(os.path.isfile(journal), "the backup run wrote no journal:\n" + output)
+    before = readText(journal)
+
+    Workspace.run("SetWorkloadSnapshotBackupPermissions.py", arguments + ["--plan", Workspace.path("plan.json")])
+    expect(readText(journal) == before, "--plan changed the journal")
+
+@check
+def scriptsKeepSeparateJournals(Workspace):
+    # Each script defaults to its own journal, so assigning identities keeps the backup journal
+    backupJournal = Workspace.path("SetWorkloadSnapshotBackupPermissions.journal.jsonl")
+    half = len(Workspace.vmNames) // 2
+    Workspace.run("SetWorkloadSnapshotBackupPermissions.py", Workspace.backupArguments(Workspace.vmNames[:half]))
+    expect(os.path.isfile(backupJournal), "the backup run wrote no journal named after the script")
+    before = readText(backupJournal)
+
+    returnCode, output = Workspace.run("AssignIdentity.py", ["--subscription", simulator.SUBSCRIPTION_ID, "--virtual-machine-resource-group", VM_RESOURCE_GROUP, "--virtual-machine-names"] + Workspace.vmNames[half:])
+    expect(returnCode == 0, "AssignIdentity failed:\n" + output)
+    expect(os.path.isfile(Workspace.path("AssignIdentity.journal.jsonl")), "AssignIdentity wrote no journal named after the script")
+    expect(readText(backupJournal) == before, "AssignIdentity changed the backup journal")
+
+@check
+def missingVirtualMachineIsSkipped(Workspace):
+    # A VM missing from the listing fails on its own, the rest of the manifest is still planned and applied
+    manifest = Workspace.path("manifest.csv")
+    with open(manifest, mode='w') as manifestFile:
+        manifestFile.write("vmName\n" + "\n".join(Workspace.vmNames + ["retired"]) + "\n")
+    arguments = Workspace.backupArguments()[:4] + ["--disk-resource-groups"] + DISK_RESOURCE_GROUPS + ["--snapshot-resource-group", SNAPSHOT_RESOURCE_GROUP, "--manifest", manifest]
+
+    plan = Workspace.path("plan.jsonl")
+    returnCode, output = Workspace.run("SetWorkloadSnapshotBackupPermissions.py", arguments + ["--plan", plan])
+    expect(returnCode == 1, "planning exited with " + str(returnCode) + ":\n" + output)
+    failures = [failure["virtualMachineName"] for line in readText(plan).splitlines() for failure in json.loads(line)["failures"]]
+    expect(failures == ["retired"], "the plan records the failures " + str(failures))
+
+    returnCode, output = Workspace.run("SetWorkloadSnapshotBackupPermissions.py", arguments)
+    expect(returnCode == 1, "applying exited with " + str(returnCode) + ":\n" + output)
+    missing = benchmark.missingPermissions("backup", simulator.loadState(Workspace.statePath), Workspace.vmNames, DISK_RESOURCE_GROUPS, None)
+    expect(missing == 0, str(missing) + " permissions of the other virtual machines are missing")
+
+    returnCode, output = Workspace.run("SetWorkloadSnapshotBackupPermissions.py", arguments + ["--shards", "2", "--shard-directory", Workspace.path("shards")])
+    expect(returnCode == 1, "the sharded run exited with " + str(returnCode) + ":\n" + output)
+    report = json.loads(readText(os.path.join(Workspace.path("shards"), "report.json")))
+    expect(report["succeeded"] and report["totals"]["failures"] == 1, "the shard report holds " + json.dumps(report["totals"]))
+
+@check
+def auditFailureIsNotCompliance(Workspace):
+    # An audit that cannot read Azure must exit with its own code, never 0 or the findings code 1
+    arguments = Workspace.backupArguments()
+    Workspace.login()
+    returnCode, output = Workspace.run("AuditWorkloadSnapshotPermissions.py", arguments)
+    expect(returnCode == 1, "the audit of an unprepared fleet exited with " + str(returnCode) + ":\n" + output)
+
+    with open(Workspace.statePath, mode='w') as stateFile:
+        stateFile.write("not a state")
+    returnCode, output = Workspace.run("AuditWorkloadSnapshotPermissions.py", arguments)
+    expect(returnCode == 2, "the audit against a broken az exited with " + str(returnCode) + ":\n" + output)
+
+@check
+def identityFailureExitsNonZero(Workspace):
+    # A VM whose identity cannot be enabled fails the run after the other VMs are done
+    Workspace.login()
+    returnCode, output = Workspace.run("AssignIdentity.py", ["--subscription", simulator.SUBSCRIPTION_ID, "--virtual-machine-resource-group", VM_RESOURCE_GROUP, "--virtual-machine-names", Workspace.vmNames[0], "ghost"])
+    expect(returnCode == 1, "AssignIdentity exited with " + str(returnCode) + ":\n" + output)
+    expect(benchmark.missingPermissions("identity", simulator.loadState(Workspace.statePath), Workspace.vmNames[:1], DISK_RESOURCE_GROUPS, None) == 0, "the identity of " + Workspace.vmNames[0] + " was not enabled")
+
+@check
+def invalidManifestRowIsSkipped(Workspace):
+    # An invalid manifest row fails on its own, the rows around it are still applied
+    manifest = Workspace.path("manifest.jsonl")
+    with open(manifest, mode='w') as manifestFile:
+        manifestFile.write(json.dumps({"vmName": Workspace.vmNames[0]}) + "\n{not json\n" + json.dumps({"vmName": ""}) + "\n")
+        manifestFile.write("".join(json.dumps({"vmName": name}) + "\n" for name in Workspace.vmNames[1:]))
+    arguments = Workspace.backupArguments()[:4] + ["--disk-resource-groups"] + DISK_RESOURCE_GROUPS + ["--snapshot-resource-group", SNAPSHOT_RESOURCE_GROUP, "--manifest", manifest]
+
+    for extra in [[], ["--shards", "2", "--shard-directory", Workspace.path("shards")]]:
+        returnCode, output = Workspace.run("SetWorkloadSnapshotBackupPermissions.py", arguments + extra)
+        expect(returnCode == 1, "the run with " + str(extra) + " exited with " + str(returnCode) + ":\n" + output)
+        expect(output.count("Manifest " + manifest + " entry") == 2, "the run with " + str(extra) + " did not report both invalid rows:\n" + output)
+        missing = benchmark.missingPermissions("backup", simulator.loadState(Workspace.statePath), Workspace.vmNames, DISK_RESOURCE_GROUPS, None)
+        expect(missing == 0, str(missing) + " permissions of the valid rows are missing after the run with " + str(extra))
+
+@check
+def malformedBatchLineIsInvalid(Workspace):
+    # Lines of a batch file that hold no JSON object become INVALID rows, the others are still assigned
+    scope = "/subscriptions/{}/resourceGroups/{}".format(simulator.SUBSCRIPTION_ID, SNAPSHOT_RESOURCE_GROUP)
+    principalId = simulator.loadState(Workspace.statePath)["userAssignedIdentities"][Workspace.identityId.lower()]["principalId"]
+    batchFile = Workspace.path("batch.jsonl")
+    with open(batchFile, mode='w') as batchLines:
+        batchLines.write("{broken\n[1, 2]\n" + json.dumps({"principalId": principalId, "role": "Disk Snapshot Contributor", "scope": scope}) + "\n")
+
+    Workspace.login()
+    returnCode, output = Workspace.run("AssignRoleOnScope.py", ["--file", batchFile])
+    expect(returnCode == 1, "the batch exited with " + str(returnCode) + ":\n" + output)
+    statuses = [json.loads(line)["status"] for line in readText(Workspace.path("batch.result.jsonl")).splitlines()]
+    expect(statuses == ["invalid", "invalid", "created"], "the batch rows ended as " + str(statuses))
+
+@check
+def sharedRoleIsReportedOnce(Workspace):
+    # A role both backup and restore need on the same scope is one finding per VM, not one per operation
+    Workspace.login()
+    report = Workspace.path("report.jsonl")
+    Workspace.run("AuditWorkloadSnapshotPermissions.py", Workspace.backupArguments() + ["--identity-id", Workspace.identityId, "--report", report])
+    findings = [json.loads(line) for line in readText(report).splitlines()]
+    keys = [(item["virtualMachineName"], item["principalId"], item["scope"].lower(), item["roleName"].lower()) for item in findings if item["issue"] == "roleMissing"]
+    expect(len(keys) and len(keys) == len(set(keys)), "the report repeats missing roles: " + str(len(keys)) + " findings, " + str(len(set(keys))) + " distinct")
+
+def main():
+    failed = 0
+    for function in CHECKS:
+        directory = tempfile.mkdtemp(prefix="snapshot-check-")
+        try:
+            function(Workspace(directory))
+            print("ok      " + function.__name__)
+            shutil.rmtree(directory, ignore_errors=True)
+        except Exception as e:
+            failed += 1
+            print("FAILED  " + function.__name__ + ": " + (str(e) if isinstance(e, CheckFailed) else traceback.format_exc()) + " (kept " + directory + ")")
+
+    print(str(len(CHECKS) - failed) + " of " + str(len(CHECKS)) + " checks passed")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
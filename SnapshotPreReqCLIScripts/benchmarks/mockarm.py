@@ -0,0 +1,216 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+# Local stand-in for Azure Resource Manager and Microsoft Graph, serving the simulated state for
+# the rest backend. Run it next to the fake az, which still provides login and access tokens:
+#
+#   python mockarm.py --state state.json --port 8443
+#   python SetWorkloadSnapshotBackupPermissions.py --backend rest --arm-endpoint http://127.0.0.1:8443 --graph-endpoint http://127.0.0.1:8443 ...
+
+import argparse
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import simulator
+from backends import resourceTypeOf
+
+FILTER_PATTERN = re.compile(r"(principalId|displayName) eq '([^']*)'")
+
+class MockArmServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, StatePath, Settings, Port=0):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", Port), MockArmHandler)
+        self.statePath = StatePath
+        self.state = simulator.loadState(StatePath)
+        self.settings = Settings
+        self.lock = threading.Lock()
+        # Requests by "<method> <resource type>" and outcome
+        self.requests = Counter()
+        self.outcomes = Counter()
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        # Stops serving and writes the state back, so a run can be checked the same way for both backends
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            simulator.saveState(self.statePath, self.state)
+
+class MockArmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, Format, *Args):
+        pass
+
+    def reply(self, Status, Body, Headers=None):
+        payload = json.dumps(Body).encode("utf-8")
+        self.send_response(Status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (Headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        return Status
+
+    def error(self, Status, Code, Message=""):
+        return self.reply(Status, {"error": {"code": Code, "message": Message}})
+
+    def handle_request(self, Method):
+        server = self.server
+        parts = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length).decode("utf-8")) if length else None
+        time.sleep(server.settings.latency)
+
+        fault = server.settings.injectFault()
+        if fault == "throttled":
+            status = self.reply(429, {"error": {"code": "TooManyRequests"}}, {"Retry-After": "1"})
+        elif fault == "failed":
+            status = self.error(503, "ServiceUnavailable")
+        else:
+            with server.lock:
+                status = self.route(Method, parts.path, parse_qs(parts.query), body)
+
+        with server.lock:
+            server.requests[Method + " " + resourceTypeOf(parts.path)] += 1
+            server.outcomes[status] += 1
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def route(self, Method, Path, Query, Body):
+        state = self.server.state
+        lowerPath = Path.lower()
+
+        if lowerPath == "/providers/microsoft.resourcegraph/resources" and Method == "POST":
+            options = Body.get("options") or {}
+            rows, skipToken = simulator.resourceGraphPage(state, int(options.get("$skipToken") or 0), int(options.get("$top") or 100))
+            page = {"totalRecords": len(state["vms"]), "count": len(rows), "data": rows}
+            if skipToken is not None:
+                page["$skipToken"] = skipToken
+            return self.reply(200, page)
+        if lowerPath.startswith("/v1.0/serviceprincipals"):
+            return self.servicePrincipals(state, Path, Query)
+        if lowerPath.endswith("/providers/microsoft.authorization/roledefinitions"):
+            return self.reply(200, {"value": [{"id": "/subscriptions/{}/providers/Microsoft.Authorization/roleDefinitions/{}".format(state["subscription"], roleId), "name": roleId, "properties": {"roleName": name}} for name, roleId in simulator.ROLE_DEFINITIONS.items()]})
+        if lowerPath.endswith("/providers/microsoft.authorization/roleassignments"):
+            match = FILTER_PATTERN.search(Query.get("$filter", [""])[0])
+            principalId = match.group(2) if match else None
+            return self.reply(200, {"value": [armRoleAssignment(assignment) for assignment in state["roleAssignments"] if principalId is None or assignment["principalId"] == principalId]})
+        if "/providers/microsoft.authorization/roleassignments/" in lowerPath and Method == "PUT":
+            return self.createRoleAssignment(state, Path, Body)
+        if lowerPath.endswith("/providers/microsoft.compute/virtualmachines"):
+            group = Path.split("/")[4].lower()
+            return self.reply(200, {"value": [vm for key, vm in sorted(state["vms"].items()) if key.split("/")[0] == group]})
+        if "/providers/microsoft.compute/virtualmachines/" in lowerPath:
+            return self.virtualMachine(state, Method, Path, Body)
+        if "/providers/microsoft.managedidentity/userassignedidentities/" in lowerPath:
+            identity = state["userAssignedIdentities"].get(lowerPath)
+            if identity is None:
+                return self.error(404, "ResourceNotFound")
+            return self.reply(200, {"id": identity["id"], "name": identity["name"], "properties": {"principalId": identity["principalId"], "clientId": identity["clientId"], "tenantId": identity["tenantId"]}})
+        return self.error(400, "UnsupportedRequest", Method + " " + Path)
+
+    def servicePrincipals(self, State, Path, Query):
+        segments = Path.rstrip('/').split('/')
+        if len(segments) == 3:
+            match = FILTER_PATTERN.search(Query.get("$filter", [""])[0])
+            displayName = match.group(2) if match else None
+            return self.reply(200, {"value": [{"id": principalId, "displayName": principal["displayName"]} for principalId, principal in State["servicePrincipals"].items() if principal["displayName"] == displayName]})
+
+        principal = State["servicePrincipals"].get(segments[3])
+        if principal is None or principal["visibleAt"] > time.time():
+            return self.error(404, "Request_ResourceNotFound")
+        return self.reply(200, {"id": segments[3], "displayName": principal["displayName"]})
+
+    def createRoleAssignment(self, State, Path, Body):
+        scope, name = Path.split("/providers/Microsoft.Authorization/roleAssignments/")
+        properties = Body["properties"]
+        roleId = properties["roleDefinitionId"].split('/')[-1]
+        roleNames = [roleName for roleName, definitionId in simulator.ROLE_DEFINITIONS.items() if definitionId == roleId]
+        if not len(roleNames):
+            return self.error(400, "RoleDefinitionDoesNotExist")
+        if properties["principalId"] not in State["servicePrincipals"]:
+            return self.error(400, "PrincipalNotFound")
+        if simulator.findRoleAssignment(State, properties["principalId"], scope, roleNames[0]) is not None:
+            return self.error(409, "RoleAssignmentExists")
+        return self.reply(201, armRoleAssignment(simulator.addRoleAssignment(State, properties["principalId"], scope, roleNames[0], name)))
+
+    def virtualMachine(self, State, Method, Path, Body):
+        segments = Path.split("/")
+        vm = State["vms"].get((segments[4] + "/" + segments[-1]).lower())
+        if vm is None:
+            return self.error(404, "ResourceNotFound")
+
+        if Method == "PATCH":
+            identity = Body.get("identity", {})
+            for identityId in (identity.get("userAssignedIdentities") or {}):
+                simulator.enableUserAssignedIdentity(State, vm, identityId)
+            if "systemassigned" in identity.get("type", "").lower():
+                simulator.enableSystemAssignedIdentity(State, vm, time.time() + self.server.settings.propagation)
+        return self.reply(200, vm)
+
+def armRoleAssignment(Assignment):
+    return {"id": Assignment["id"], "name": Assignment["id"].split('/')[-1], "type": "Microsoft.Authorization/roleAssignments", "properties": {"principalId": Assignment["principalId"], "scope": Assignment["scope"], "roleDefinitionId": Assignment["roleDefinitionId"]}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a simulated subscription over the Azure Resource Manager and Microsoft Graph REST APIs")
+    parser.add_argument("--state", required=True, help="State file written by simulator.seedState, updated when the server stops")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests failing with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests throttled with 429")
+    parser.add_argument("--propagation", type=float, default=0.0, help="Seconds before a new system assigned identity is visible in Graph")
+    args = parser.parse_args()
+
+    server = MockArmServer(args.state, simulator.Settings(args.latency, args.failure_rate, args.throttle_rate, args.propagation), args.port)
+    print("Serving " + server.endpoint)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        simulator.saveState(args.state, server.state)
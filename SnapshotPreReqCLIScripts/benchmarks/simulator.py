@@ -0,0 +1,224 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+# Simulated Azure shared by the fake az CLI (fakeaz/az) and the mock ARM endpoint (mockarm.py).
+# The state is one JSON document:
+#   vms                  - "resourcegroup/name" -> virtual machine as returned by 'az vm list'
+#   roleAssignments      - list of {"id", "principalId", "scope", "roleDefinitionName"}
+#   servicePrincipals    - principal id -> {"displayName", "visibleAt"}, visibleAt models the
+#                          delay before a new managed identity can be resolved
+#   userAssignedIdentities - lower case resource id -> identity as returned by 'az identity show'
+
+import json
+import os
+import random
+import sys
+import uuid
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lookupcache import lockedFile
+
+SUBSCRIPTION_ID = "00000000-0000-0000-0000-000000000001"
+TENANT_ID = "00000000-0000-0000-0000-0000000000aa"
+BACKUP_MANAGEMENT_SERVICE = "Backup Management Service"
+BACKUP_MANAGEMENT_SERVICE_PRINCIPAL_ID = "00000000-0000-0000-0000-0000000000bb"
+
+# Built-in role definition names and ids
+ROLE_DEFINITIONS = {
+    "Disk Backup Reader": "3e5e47e6-65f7-47ef-90b5-e5dd4d455f24",
+    "Disk Snapshot Contributor": "7efff54f-a5b4-42b5-a1c5-5411624893ce",
+    "Disk Restore Operator": "b50d9833-a0cb-478e-945f-707fcc997c13",
+    "Virtual Machine Contributor": "9980e02c-c2be-4d73-94e8-173b1dc7cf3c",
+}
+
+# Errors in the format az prints them, matched by the retry policy
+THROTTLED_ERROR = "ERROR: (TooManyRequests) The request is being throttled. Retry after 1 seconds."
+TRANSIENT_ERROR = "ERROR: (ServiceUnavailable) The service is temporarily unavailable."
+
+class Settings:
+    # Behaviour of the simulated service, read from FAKE_AZ_* environment variables so the fake az
+    # processes started by the scripts pick it up
+    def __init__(self, Latency=0.0, FailureRate=0.0, ThrottleRate=0.0, Propagation=0.0):
+        self.latency = Latency
+        self.failureRate = FailureRate
+        self.throttleRate = ThrottleRate
+        self.propagation = Propagation
+
+    @staticmethod
+    def fromEnvironment():
+        return Settings(float(os.environ.get("FAKE_AZ_LATENCY", 0)), float(os.environ.get("FAKE_AZ_FAILURE_RATE", 0)), float(os.environ.get("FAKE_AZ_THROTTLE_RATE", 0)), float(os.environ.get("FAKE_AZ_PROPAGATION", 0)))
+
+    def toEnvironment(self):
+        return {"FAKE_AZ_LATENCY": str(self.latency), "FAKE_AZ_FAILURE_RATE": str(self.failureRate), "FAKE_AZ_THROTTLE_RATE": str(self.throttleRate), "FAKE_AZ_PROPAGATION": str(self.propagation)}
+
+    def injectFault(self):
+        # Returns "throttled", "failed" or None for one call
+        draw = random.random()
+        if draw < self.throttleRate:
+            return "throttled"
+        if draw < self.throttleRate + self.failureRate:
+            return "failed"
+        return None
+
+def vmResourceId(Subscription, ResourceGroup, Name):
+    return "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines/{}".format(Subscription, ResourceGroup, Name)
+
+def resourceGroupScope(Subscription, ResourceGroup):
+    return "/subscriptions/{}/resourceGroups/{}".format(Subscription, ResourceGroup)
+
+def userAssignedIdentityId(Subscription, ResourceGroup, Name):
+    return "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.ManagedIdentity/userAssignedIdentities/{}".format(Subscription, ResourceGroup, Name)
+
+def newState():
+    state = {"subscription": SUBSCRIPTION_ID, "tenant": TENANT_ID, "vms": {}, "roleAssignments": [], "servicePrincipals": {}, "userAssignedIdentities": {}}
+    state["servicePrincipals"][BACKUP_MANAGEMENT_SERVICE_PRINCIPAL_ID] = {"displayName": BACKUP_MANAGEMENT_SERVICE, "visibleAt": 0}
+    return state
+
+def addVirtualMachine(State, ResourceGroup, Name):
+    State["vms"][(ResourceGroup + "/" + Name).lower()] = {"id": vmResourceId(State["subscription"], ResourceGroup, Name), "name": Name, "resourceGroup": ResourceGroup, "location": "westus", "identity": None}
+
+def addUserAssignedIdentity(State, ResourceGroup, Name):
+    identityId = userAssignedIdentityId(State["subscription"], ResourceGroup, Name)
+    principalId = str(uuid.uuid4())
+    State["userAssignedIdentities"][identityId.lower()] = {"id": identityId, "name": Name, "resourceGroup": ResourceGroup, "principalId": principalId, "clientId": str(uuid.uuid4()), "tenantId": State["tenant"]}
+    State["servicePrincipals"][principalId] = {"displayName": Name, "visibleAt": 0}
+    return identityId
+
+def enableSystemAssignedIdentity(State, Vm, VisibleAt=0):
+    identity = Vm.get("identity") or {"type": "None", "principalId": None, "tenantId": State["tenant"], "userAssignedIdentities": None}
+    if not identity.get("principalId"):
+        identity["principalId"] = str(uuid.uuid4())
+        State["servicePrincipals"][identity["principalId"]] = {"displayName": Vm["name"], "visibleAt": VisibleAt}
+    identity["type"] = "SystemAssigned, UserAssigned" if identity.get("userAssignedIdentities") else "SystemAssigned"
+    Vm["identity"] = identity
+    return identity
+
+def enableUserAssignedIdentity(State, Vm, IdentityId):
+    identity = Vm.get("identity") or {"type": "None", "principalId": None, "tenantId": State["tenant"], "userAssignedIdentities": None}
+    userAssigned = State["userAssignedIdentities"][IdentityId.lower()]
+    identity["userAssignedIdentities"] = dict(identity.get("userAssignedIdentities") or {}, **{userAssigned["id"]: {"principalId": userAssigned["principalId"], "clientId": userAssigned["clientId"]}})
+    identity["type"] = "SystemAssigned, UserAssigned" if identity.get("principalId") else "UserAssigned"
+    Vm["identity"] = identity
+    return identity
+
+def roleDefinitionName(RoleName):
+    # Canonical name of a built-in role, None for an unknown role. Names match case-insensitively as in Azure.
+    for name in ROLE_DEFINITIONS:
+        if name.lower() == RoleName.lower():
+            return name
+    return None
+
+def roleDefinitionId(Subscription, RoleName):
+    return "/subscriptions/{}/providers/Microsoft.Authorization/roleDefinitions/{}".format(Subscription, ROLE_DEFINITIONS[RoleName])
+
+def roleNameOf(Role):
+    # Canonical role name for a role given by name or by definition id as accepted by az, or None
+    for name, definitionId in ROLE_DEFINITIONS.items():
+        if Role.rstrip('/').split('/')[-1].lower() == definitionId:
+            return name
+    return roleDefinitionName(Role)
+
+def findRoleAssignment(State, PrincipalId, Scope, RoleName):
+    for assignment in State["roleAssignments"]:
+        if assignment["principalId"] == PrincipalId and assignment["scope"].lower() == Scope.rstrip('/').lower() and assignment["roleDefinitionName"].lower() == RoleName.lower():
+            return assignment
+    return None
+
+def resourceGraphPage(State, Skip, Top):
+    # One page of the virtual machine query made by the audit, as (rows, skip token of the next page)
+    rows = []
+    for key, vm in sorted(State["vms"].items())[Skip:Skip + Top]:
+        rows.append({"id": vm["id"], "name": vm["name"], "resourceGroup": vm["resourceGroup"].lower(), "subscriptionId": State["subscription"], "identity": vm.get("identity")})
+    return rows, str(Skip + Top) if Skip + Top < len(State["vms"]) else None
+
+class EffectiveRoles:
+    # Answers whether a role is assigned on a scope or on a scope above it, with one set lookup per
+    # parent scope so large states can be checked quickly
+    def __init__(self, State):
+        self.keys = set((assignment["principalId"], assignment["scope"].lower(), assignment["roleDefinitionName"].lower()) for assignment in State["roleAssignments"])
+
+    def isEffective(self, PrincipalId, Scope, RoleName):
+        segments = Scope.rstrip('/').lower().split('/')
+        return any((PrincipalId, "/".join(segments[:length]), RoleName.lower()) in self.keys for length in range(len(segments), 1, -1))
+
+def addRoleAssignment(State, PrincipalId, Scope, RoleName, Name=None):
+    RoleName = roleDefinitionName(RoleName)
+    assignment = {"id": Scope.rstrip('/') + "/providers/Microsoft.Authorization/roleAssignments/" + (Name or str(uuid.uuid4())), "principalId": PrincipalId, "principalType": "ServicePrincipal", "scope": Scope.rstrip('/'), "roleDefinitionName": RoleName, "roleDefinitionId": roleDefinitionId(SUBSCRIPTION_ID, RoleName)}
+    State["roleAssignments"].append(assignment)
+    return assignment
+
+def seedState(Path, VmResourceGroup, VmCount, PreparedFraction=0.0, DiskResourceGroups=(), SnapshotResourceGroup=None, ExtraAssignments=0, PreparedAtSubscription=False):
+    # Writes a state with VmCount virtual machines vm0..vmN-1 and one user assigned identity. The
+    # first PreparedFraction of the virtual machines already have a system assigned identity holding
+    # the backup roles, and every principal holds ExtraAssignments unrelated assignments, so a run
+    # sees a realistic mix of existing and missing permissions. With PreparedAtSubscription the
+    # backup roles of the prepared virtual machines and of the Backup Management Service are
+    # granted once on the subscription instead. Returns (vm names, identity id).
+    state = newState()
+    subscription = state["subscription"]
+    identityId = addUserAssignedIdentity(state, "identities", "snapshot-identity")
+    names = ["vm" + str(index) for index in range(VmCount)]
+
+    for index, name in enumerate(names):
+        addVirtualMachine(state, VmResourceGroup, name)
+        if index < int(VmCount * PreparedFraction):
+            principalId = enableSystemAssignedIdentity(state, state["vms"][(VmResourceGroup + "/" + name).lower()])["principalId"]
+            if PreparedAtSubscription:
+                addRoleAssignment(state, principalId, "/subscriptions/" + subscription, "Disk Backup Reader")
+                addRoleAssignment(state, principalId, "/subscriptions/" + subscription, "Disk Snapshot Contributor")
+                continue
+            for diskResourceGroup in DiskResourceGroups:
+                addRoleAssignment(state, principalId, resourceGroupScope(subscription, diskResourceGroup), "Disk Backup Reader")
+            if SnapshotResourceGroup is not None:
+                addRoleAssignment(state, principalId, resourceGroupScope(subscription, SnapshotResourceGroup), "Disk Snapshot Contributor")
+
+    if PreparedAtSubscription:
+        addRoleAssignment(state, BACKUP_MANAGEMENT_SERVICE_PRINCIPAL_ID, "/subscriptions/" + subscription, "Disk Snapshot Contributor")
+
+    for principalId in list(state["servicePrincipals"]):
+        for index in range(ExtraAssignments):
+            addRoleAssignment(state, principalId, resourceGroupScope(subscription, "unrelated" + str(index)), "Virtual Machine Contributor")
+
+    saveState(Path, state)
+    return names, identityId
+
+def loadState(Path):
+    with open(Path, mode='r') as stateFile:
+        return json.load(stateFile)
+
+def saveState(Path, State):
+    temporaryPath = Path + ".tmp"
+    with open(temporaryPath, mode='w') as stateFile:
+        json.dump(State, stateFile)
+    os.replace(temporaryPath, Path)
+
+@contextmanager
+def lockedState(Path):
+    # Yields the state for one fake az command and saves it afterwards, serialising the commands
+    # that the scripts run in parallel
+    with lockedFile(Path):
+        state = loadState(Path)
+        yield state
+        saveState(Path, state)
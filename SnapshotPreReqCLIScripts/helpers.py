@@ -21,139 +21,591 @@
 # OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
 # SCRIPT
 
-import os
-import fileinput
+import atexit
+import random
 import sys
+import threading
 import time
-
-def assignRoleOnResourceGroup(PrincipalId, ResourceGroup, RoleName):
-    PrincipalId = PrincipalId.strip()
-    print(bcolors.OKBLUE + "Fetching assigned role " + str(RoleName) + " for " + str(PrincipalId) + " on resource group " + str(ResourceGroup) + bcolors.ENDC)
-
-    if os.path.isfile('roleGet.txt'):
-        os.remove('roleGet.txt')
-
-    output = os.system('az role assignment list -g {} --assignee {} --role {} -o tsv --only-show-errors > roleGet.txt'.format(ResourceGroup, PrincipalId, "\"" + RoleName + "\"")) 
-
-    #Error handling
-    if output != 0:
-        print(bcolors.FAIL + "Script failed with unexpected error ... " + bcolors.ENDC)
-        print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
-        sys.exit()
-
-    print(bcolors.OKGREEN + "Role assignment with role  " + RoleName + " for " + PrincipalId + " on resource group " + ResourceGroup + " fetched successfully " + bcolors.ENDC)
-
-    role = [line[:-1] for line in fileinput.input(files='roleGet.txt')] if os.path.isfile('roleGet.txt') else ""
-
-    if len(role):
-        print(bcolors.OKBLUE + "Already assigned " + RoleName + " role on resource group " + ResourceGroup + " to "+ PrincipalId + bcolors.ENDC)
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+from azcli import AzCommandError, runAz
+from backends import AzCliBackend, ArmRestBackend, createBackend
+from journal import Journal, defaultJournalFile
+from lookupcache import configureLookupCache, cachedLookup, DEFAULT_CACHE_FILE, DEFAULT_CACHE_TTL, SERVICE_PRINCIPAL, MANAGED_IDENTITY
+from retry import configureRetryPolicy, DEFAULT_MAX_RETRIES, DEFAULT_REQUESTS_PER_SECOND
+from models import RoleAssignment, VmIdentity, ManagedIdentity
+
+# Default number of virtual machines processed concurrently
+DEFAULT_MAX_PARALLEL = 8
+
+# Backend used for all Azure operations, see configureBackend
+backend = AzCliBackend()
+
+def configureBackend(Name, ArmEndpoint=None, GraphEndpoint=None):
+    global backend
+    backend = createBackend(Name, ArmEndpoint, GraphEndpoint)
+
+def getBackend():
+    return backend
+
+# Journal of completed steps, see configureJournal
+journal = None
+
+def configureJournal(Path, Resume=False, ReadOnly=False):
+    global journal
+    journal = Journal(Path, Resume, ReadOnly)
+
+    if Resume:
+        print(bcolors.OKBLUE + "Resuming from journal " + Path + " with " + str(journal.stepCount()) + " completed steps" + bcolors.ENDC)
+
+def printRerunHint():
+    print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
+
+    if journal is not None:
+        print(bcolors.FAIL + "Add --resume to skip the steps recorded in " + journal.path + "." + bcolors.ENDC)
+
+def addExecutionArguments(Parser):
+    # Options shared by the scripts that enable identities and assign roles
+    Parser.add_argument("--max-parallel", "-p", type=int, default=DEFAULT_MAX_PARALLEL, help="Maximum number of virtual machines processed in parallel")
+    Parser.add_argument("--journal", default=defaultJournalFile(), help="File recording the completed steps of this run (default " + defaultJournalFile() + ")")
+    Parser.add_argument("--resume", action="store_true", help="Skip the steps recorded in the journal by a previous run")
+    addConnectionArguments(Parser)
+
+def addConnectionArguments(Parser):
+    # Options of every script that calls Azure, including the read-only audit
+    Parser.add_argument("--backend", choices=[AzCliBackend.name, ArmRestBackend.name], default=AzCliBackend.name, help="Run operations through the az CLI (default) or call Azure Resource Manager and Microsoft Graph directly over pooled HTTPS connections")
+    Parser.add_argument("--arm-endpoint", help="Azure Resource Manager endpoint used by the rest backend")
+    Parser.add_argument("--graph-endpoint", help="Microsoft Graph endpoint used by the rest backend")
+    Parser.add_argument("--max-retries", type=int, default=DEFAULT_MAX_RETRIES, help="Retries of a throttled or transiently failing Azure call (default " + str(DEFAULT_MAX_RETRIES) + ")")
+    Parser.add_argument("--requests-per-second", type=float, default=DEFAULT_REQUESTS_PER_SECOND, help="Rate limit shared by all parallel workers, 0 disables it (default " + str(int(DEFAULT_REQUESTS_PER_SECOND)) + ")")
+    Parser.add_argument("--cache-file", default=DEFAULT_CACHE_FILE, help="File caching service principal, user assigned identity and role definition lookups between runs (default " + DEFAULT_CACHE_FILE + ")")
+    Parser.add_argument("--cache-ttl", type=int, default=DEFAULT_CACHE_TTL, help="Seconds a cached lookup stays valid, 0 disables the cache (default " + str(DEFAULT_CACHE_TTL) + ")")
+    Parser.add_argument("--refresh-cache", action="store_true", help="Ignore the cached lookups and replace them with fresh ones")
+    Parser.add_argument("--trace", metavar="TRACE_FILE", help="Time every Azure call and write one JSON line per call to TRACE_FILE, plus a Chrome trace next to it, and print latency percentiles per operation at the end")
+
+def configureTracing(Path):
+    if tracing.configureTracer(Path) is not None:
+        # Registered at exit so runs that stop on an error are summarised as well
+        atexit.register(finishTracing)
+
+def finishTracing():
+    tracer = tracing.getTracer()
+    tracer.close()
+
+    print(bcolors.OKBLUE + "{:<9} {:<36} {:>6} {:>9} {:>8} {:>8} {:>8}".format("category", "operation", "count", "total s", "p50 s", "p95 s", "max s") + bcolors.ENDC)
+    for category, operation, count, total, p50, p95, maximum in tracer.summary():
+        print("{:<9} {:<36} {:>6} {:>9.2f} {:>8.3f} {:>8.3f} {:>8.3f}".format(category, operation, count, total, p50, p95, maximum))
+    print(bcolors.OKGREEN + "Trace written to " + tracer.path + " and " + tracer.chromePath + bcolors.ENDC)
+
+def applyExecutionArguments(Args):
+    applyConnectionArguments(Args)
+    # --plan only reads Azure, so it must not replace the journal a failed run left for --resume
+    configureJournal(Args.journal, Args.resume, ReadOnly=getattr(Args, "plan", None) is not None)
+
+def applyConnectionArguments(Args):
+    configureTracing(Args.trace)
+    configureRetryPolicy(Args.max_retries, Args.requests_per_second)
+    configureLookupCache(Args.cache_file, Args.cache_ttl, Args.refresh_cache)
+    configureBackend(Args.backend, Args.arm_endpoint, Args.graph_endpoint)
+
+# Existing role assignments keyed by (principalId, scope, roleDefinitionName). Each principal
+# is listed once per subscription with a single bulk call including inherited assignments, later
+# checks are dictionary lookups of the scope and its parent scopes.
+roleAssignmentIndex = {}
+indexedPrincipals = set()
+currentSubscriptionId = None
+
+def normalizeScope(Scope):
+    return Scope.strip().rstrip('/').lower()
+
+def roleAssignmentKey(PrincipalId, Scope, RoleName):
+    return (PrincipalId.strip().lower(), normalizeScope(Scope), RoleName.strip().lower())
+
+def parentScopes(Scope):
+    # The scope and every scope above it, most specific first. For
+    # /subscriptions/{s}/resourceGroups/{rg}/providers/{namespace}/{type}/{name} that is the resource,
+    # the resource group and the subscription; '/providers/{namespace}' on its own is not a scope.
+    segments = normalizeScope(Scope).strip('/').split('/')
+    scopes = []
+    for length in range(len(segments) - len(segments) % 2, 0, -2):
+        if segments[length - 2] != "providers":
+            scopes.append("/" + "/".join(segments[:length]))
+    return scopes
+
+def getCurrentSubscriptionId():
+    global currentSubscriptionId
+
+    if currentSubscriptionId is None:
+        try:
+            with tracing.span("getSubscriptionId"):
+                currentSubscriptionId = backend.getSubscriptionId()
+        except AzCommandError as e:
+            print(bcolors.FAIL + str(e) + bcolors.ENDC)
+            printRerunHint()
+            sys.exit(1)
+
+    return currentSubscriptionId
+
+def setSubscriptionContext(Subscription, Login=True):
+    global currentSubscriptionId
+
+    if Login:
+        with tracing.span("login"):
+            runAz(["login"], Interactive=True)
+    with tracing.span("setSubscription", subscription=Subscription) as span:
+        result = runAz(["account", "set", "-s", Subscription])
+        span.setOutcome("ok" if result.succeeded else "error")
+
+    if result.succeeded:
+        currentSubscriptionId = Subscription
+        print(bcolors.OKGREEN + "Successfully logged in to subscription " + Subscription + "." + bcolors.ENDC)
     else:
-        print(bcolors.OKBLUE + "Assigning role " + RoleName + " to " + PrincipalId + " on resource group " + ResourceGroup + bcolors.ENDC)
-        output = os.system('az role assignment create -g {} --assignee {} --role {} -o tsv --only-show-errors'.format(ResourceGroup, PrincipalId, "\"" + RoleName + "\""))
+        print(bcolors.FAIL + "Script failed with unexpected error ... " + result.errorText() + bcolors.ENDC)
+        sys.exit(1)
 
-        if output != 0:
-            print(bcolors.OKBLUE + "Exception caught while assigning role" + bcolors.ENDC)
-            print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
-            sys.exit()
-        else:
-            print(bcolors.OKBLUE + "Assigned " + RoleName + " role on resource group " + ResourceGroup + " to " + PrincipalId + " successfully." + bcolors.ENDC)    
+def resourceGroupScope(ResourceGroup):
+    return "/subscriptions/{}/resourceGroups/{}".format(getCurrentSubscriptionId(), ResourceGroup)
 
-def assignRoleOnScope(PrincipalId, RoleName, Scope):
-    print(bcolors.OKBLUE + "Fetching assigned role " + RoleName + " for " + PrincipalId + " on scope " + Scope + bcolors.ENDC)
+# One lock per (subscription, principal) so concurrent checks for a principal list it only once
+prefetchLocks = {}
+prefetchLocksLock = threading.Lock()
 
-    if os.path.isfile('roleGetScope.txt'):
-        os.remove('roleGetScope.txt')
+def prefetchRoleAssignments(PrincipalId):
+    PrincipalId = PrincipalId.strip()
+    indexKey = (getCurrentSubscriptionId().lower(), PrincipalId.lower())
+    if indexKey in indexedPrincipals:
+        return
+
+    with prefetchLocksLock:
+        principalLock = prefetchLocks.setdefault(indexKey, threading.Lock())
+
+    with principalLock:
+        if indexKey in indexedPrincipals:
+            return
+
+        print(bcolors.OKBLUE + "Fetching all role assignments for " + PrincipalId + bcolors.ENDC)
+
+        try:
+            with tracing.span("listRoleAssignments", principalId=PrincipalId) as span:
+                assignments = backend.listRoleAssignments(PrincipalId, getCurrentSubscriptionId())
+                span.tag(count=len(assignments))
+        except AzCommandError as e:
+            #Error handling
+            print(bcolors.FAIL + "Script failed with unexpected error ... " + str(e) + bcolors.ENDC)
+            printRerunHint()
+            sys.exit(1)
+
+        indexRoleAssignments(assignments, PrincipalId)
+        indexedPrincipals.add(indexKey)
+
+def indexRoleAssignments(Assignments, PrincipalId=None):
+    # Adds listed assignments to the index, under PrincipalId when the listing was for one principal
+    subscriptionScope = "/subscriptions/" + getCurrentSubscriptionId()
+    for assignment in Assignments:
+        if assignment.roleDefinitionName is None or (PrincipalId or assignment.principalId) is None:
+            continue
+        # Management group and root assignments are only returned when they apply to this
+        # subscription, so they are indexed as effective at the subscription
+        scope = assignment.scope if normalizeScope(assignment.scope).startswith("/subscriptions/") else subscriptionScope
+        roleAssignmentIndex[roleAssignmentKey(PrincipalId or assignment.principalId, scope, assignment.roleDefinitionName)] = assignment
+
+# Above this many principals, one listing of every assignment in the subscription is cheaper than
+# one listing per principal
+BULK_LISTING_THRESHOLD = 20
+
+def prefetchPrincipals(PrincipalIds, MaxParallel=DEFAULT_MAX_PARALLEL):
+    # Indexes the role assignments of all PrincipalIds in the current subscription
+    subscription = getCurrentSubscriptionId().lower()
+    pending = [principalId for principalId in OrderedDict.fromkeys(principalId.strip() for principalId in PrincipalIds) if (subscription, principalId.lower()) not in indexedPrincipals]
+
+    if len(pending) <= BULK_LISTING_THRESHOLD:
+        runParallel(pending, prefetchRoleAssignments, MaxParallel)
+        return
+
+    print(bcolors.OKBLUE + "Fetching all role assignments in subscription " + getCurrentSubscriptionId() + " for " + str(len(pending)) + " principals" + bcolors.ENDC)
+    try:
+        with tracing.span("listAllRoleAssignments", subscription=getCurrentSubscriptionId()) as span:
+            assignments = backend.listAllRoleAssignments(getCurrentSubscriptionId())
+            span.tag(count=len(assignments))
+    except AzCommandError as e:
+        print(bcolors.FAIL + "Script failed with unexpected error ... " + str(e) + bcolors.ENDC)
+        printRerunHint()
+        sys.exit(1)
+
+    principals = set(principalId.lower() for principalId in pending)
+    indexRoleAssignments([assignment for assignment in assignments if assignment.principalId is not None and assignment.principalId.lower() in principals])
+    indexedPrincipals.update((subscription, principalId) for principalId in principals)
+
+def getRoleDefinitionId(Subscription, RoleName):
+    # Resource id of the role definition, None when the role is not defined in the subscription
+    with tracing.span("getRoleDefinitionId", roleName=RoleName):
+        return backend.getRoleDefinitionId(Subscription, RoleName)
+
+def resetRoleAssignmentIndex(KeepPrincipals=()):
+    # Drops indexed assignments so memory stays bounded when many batches are processed
+    keep = set(principalId.lower() for principalId in KeepPrincipals)
+
+    for key in [key for key in roleAssignmentIndex if key[0] not in keep]:
+        del roleAssignmentIndex[key]
+    for key in [key for key in indexedPrincipals if key[1] not in keep]:
+        indexedPrincipals.discard(key)
+
+def isRoleJournaled(PrincipalId, Scope, RoleName):
+    return journal is not None and journal.hasRole(PrincipalId, Scope, RoleName)
+
+def findEffectiveAssignment(PrincipalId, Scope, RoleName):
+    # Returns the indexed assignment granting RoleName at Scope, either on Scope itself or
+    # inherited from a parent scope, or None
+    for scope in parentScopes(Scope):
+        assignment = roleAssignmentIndex.get(roleAssignmentKey(PrincipalId, scope, RoleName))
+        if assignment is not None:
+            return assignment
+    return None
+
+def isRoleAssigned(PrincipalId, Scope, RoleName):
+    # True when RoleName is effective for the principal at Scope, a parent scope assignment counts
+    if isRoleJournaled(PrincipalId, Scope, RoleName):
+        return True
+
+    prefetchRoleAssignments(PrincipalId)
+    return findEffectiveAssignment(PrincipalId, Scope, RoleName) is not None
+
+def recordRoleAssignment(PrincipalId, Scope, RoleName, Completed=True):
+    # Completed is False for assignments that are only planned, they are indexed but not journaled
+    roleAssignmentIndex[roleAssignmentKey(PrincipalId, Scope, RoleName)] = RoleAssignment(PrincipalId, Scope, RoleName)
+
+    if Completed and journal is not None:
+        journal.recordRole(PrincipalId, Scope, RoleName)
+
+def createRoleAssignment(PrincipalId, RoleName, Scope, RoleDefinitionId=None):
+    # Returns None on success or the error message
+    try:
+        with tracing.span("createRoleAssignment", principalId=PrincipalId, roleName=RoleName, scope=Scope):
+            backend.createRoleAssignment(PrincipalId, RoleName, Scope, RoleDefinitionId)
+    except AzCommandError as e:
+        return str(e)
+    return None
+
+def ensureRoleAssignment(PrincipalId, RoleName, Scope, ScopeDescription=None):
+    # Creates the assignment unless it exists, returns None on success or the error message
+    PrincipalId = PrincipalId.strip()
+    description = ScopeDescription or "scope " + Scope
+    print(bcolors.OKBLUE + "Fetching assigned role " + RoleName + " for " + PrincipalId + " on " + description + bcolors.ENDC)
 
-    output = os.system('az role assignment list --assignee {} --role {} --scope {} -o tsv --only-show-errors > roleGetScope.txt'.format( PrincipalId, "\"" + RoleName + "\"", Scope)) 
+    if isRoleAssigned(PrincipalId, Scope, RoleName):
+        inherited = findEffectiveAssignment(PrincipalId, Scope, RoleName)
+        if inherited is not None and normalizeScope(inherited.scope) != normalizeScope(Scope):
+            print(bcolors.OKBLUE + "Already granted " + RoleName + " role on " + description + " to " + PrincipalId + ", inherited from " + inherited.scope + bcolors.ENDC)
+        else:
+            print(bcolors.OKBLUE + "Already assigned " + RoleName + " role on " + description + " to " + PrincipalId + bcolors.ENDC)
+        recordRoleAssignment(PrincipalId, Scope, RoleName)
+        return None
 
-    #Error handling
-    if output != 0:
-        print(bcolors.FAIL + "Script failed with unexpected error ... " + bcolors.ENDC)
-        print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
-        sys.exit()
+    print(bcolors.OKBLUE + "Assigning role " + RoleName + " to " + PrincipalId + " on " + description + bcolors.ENDC)
+    error = createRoleAssignment(PrincipalId, RoleName, Scope)
 
-    print(bcolors.OKGREEN + "Role assignment with role" + RoleName + " for " + PrincipalId + " on scope " + Scope + " fetched successfully " + bcolors.ENDC)
+    if error is None:
+        recordRoleAssignment(PrincipalId, Scope, RoleName)
+        print(bcolors.OKBLUE + "Assigned " + RoleName + " role on " + description + " to " + PrincipalId + " successfully." + bcolors.ENDC)
+    return error
 
-    role = [line[:-1] for line in fileinput.input(files='roleGetScope.txt')]
+def exitOnRoleError(Error):
+    if Error is not None:
+        print(bcolors.FAIL + "Exception caught while assigning role: " + Error + bcolors.ENDC)
+        printRerunHint()
+        sys.exit(1)
 
-    if len(role):
-        print(bcolors.OKBLUE + "Already assigned " + RoleName + " role on scope " + Scope + " to " + PrincipalId + bcolors.ENDC)
-    else:
-        print(bcolors.OKBLUE + "Assigning role " + RoleName + " to " + PrincipalId + " on scope " + Scope + bcolors.ENDC)
-        output = os.system('az role assignment create --assignee {} --role {} --scope {} -o tsv --only-show-errors'.format(PrincipalId, "\"" + RoleName + "\"", Scope))
+def assignRoleOnResourceGroup(PrincipalId, ResourceGroup, RoleName):
+    exitOnRoleError(ensureRoleAssignment(PrincipalId, RoleName, resourceGroupScope(ResourceGroup), "resource group " + ResourceGroup))
 
-        if output != 0:
-            print(bcolors.FAIL + "Exception caught while assigning role" + bcolors.ENDC)
-            print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
-            sys.exit()
+def assignRoleOnScope(PrincipalId, RoleName, Scope):
+    exitOnRoleError(ensureRoleAssignment(PrincipalId, RoleName, Scope))
+
+# Readiness polling after a system assigned identity is enabled (seconds)
+IDENTITY_WAIT_INITIAL_DELAY = 2
+IDENTITY_WAIT_MAX_DELAY = 20
+IDENTITY_WAIT_TIMEOUT = 300
+
+class VmIdentityResult:
+    def __init__(self, VirtualMachineName):
+        self.virtualMachineName = VirtualMachineName
+        self.principalId = None
+        self.propagationSeconds = None
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+def runParallel(Items, Worker, MaxParallel):
+    # Runs Worker over Items with at most MaxParallel in flight, results keep the order of Items
+    Items = list(Items)
+    if MaxParallel is None or MaxParallel <= 1 or len(Items) <= 1:
+        return [Worker(item) for item in Items]
+
+    with ThreadPoolExecutor(max_workers=min(MaxParallel, len(Items))) as executor:
+        return list(executor.map(Worker, Items))
+
+def enableUserAssignedIdentityOnVM(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineName, Subscription):
+    identity = getVmMetadata(Subscription, VirtualMachineResourceGroup, VirtualMachineName).identity
+
+    if identity.hasUserAssigned(UserAssignedServiceIdentityId):
+        print(bcolors.OKGREEN + "User assigned identity already enabled on virtual machine " + VirtualMachineName + bcolors.ENDC)
+        return
+
+    print(bcolors.OKBLUE + "Enabling user assigned identity on virtual machine " + VirtualMachineName + bcolors.ENDC) 
+    with tracing.span("assignVmIdentity", resourceGroup=VirtualMachineResourceGroup, virtualMachineName=VirtualMachineName, identity="user"):
+        backend.assignVmIdentity(Subscription, VirtualMachineResourceGroup, VirtualMachineName, UserAssignedServiceIdentityId)
+
+    userAssignedIdentities = dict(identity.userAssignedIdentities)
+    userAssignedIdentities[UserAssignedServiceIdentityId] = {}
+    updateVmIdentity(Subscription, VirtualMachineResourceGroup, VirtualMachineName, VmIdentity("SystemAssigned, UserAssigned" if identity.hasSystemAssigned else "UserAssigned", identity.principalId, userAssignedIdentities))
+
+    print(bcolors.OKGREEN + "Enabled user assigned identity on virtual machine " + VirtualMachineName + bcolors.ENDC) 
+
+def pollWithBackoff(Probe, Timeout=IDENTITY_WAIT_TIMEOUT, InitialDelay=IDENTITY_WAIT_INITIAL_DELAY, MaxDelay=IDENTITY_WAIT_MAX_DELAY, Deadline=None):
+    # Calls Probe until it returns something other than None, backing off exponentially with
+    # jitter between attempts. Returns the probe value, raises AzCommandError past the deadline.
+    # Deadline, a time.time() value, replaces Timeout so consecutive polls can share one deadline.
+    started = time.time()
+    deadline = Deadline if Deadline is not None else started + Timeout
+    delay = InitialDelay
+
+    while True:
+        value = Probe()
+        if value is not None:
+            return value
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise AzCommandError("Timed out after " + "{:.0f}".format(time.time() - started) + " seconds")
+
+        with tracing.span("identity poll wait", tracing.WAIT):
+            time.sleep(min(remaining, delay / 2 + random.uniform(0, delay / 2)))
+        delay = min(delay * 2, MaxDelay)
+
+# VmMetadata by (subscription, resource group) and VM name. A resource group is listed once on first
+# use and entries are updated when this run changes an identity, so the identity and role phases
+# share one list call per resource group.
+vmMetadataCache = {}
+# One lock per resource group, so listing one group does not hold up lookups in the others
+vmMetadataLocks = {}
+vmMetadataLocksLock = threading.Lock()
+
+class VirtualMachineNotFoundError(AzCommandError):
+    # The resource group was listed but does not hold the virtual machine
+    pass
+
+def getVmMetadata(Subscription, VirtualMachineResourceGroup, VirtualMachineName):
+    groupKey = (Subscription.lower(), VirtualMachineResourceGroup.lower())
+
+    group = vmMetadataCache.get(groupKey)
+    if group is None:
+        with vmMetadataLocksLock:
+            groupLock = vmMetadataLocks.setdefault(groupKey, threading.Lock())
+
+        with groupLock:
+            group = vmMetadataCache.get(groupKey)
+            if group is None:
+                print(bcolors.OKBLUE + "Listing virtual machines in resource group " + VirtualMachineResourceGroup + bcolors.ENDC)
+                with tracing.span("listVirtualMachines", resourceGroup=VirtualMachineResourceGroup) as span:
+                    group = dict((vm.name.lower(), vm) for vm in backend.listVirtualMachines(Subscription, VirtualMachineResourceGroup))
+                    span.tag(count=len(group))
+                vmMetadataCache[groupKey] = group
+
+    vm = group.get(VirtualMachineName.lower())
+    if vm is None:
+        raise VirtualMachineNotFoundError("Virtual machine " + VirtualMachineName + " not found in resource group " + VirtualMachineResourceGroup)
+    return vm
+
+def updateVmIdentity(Subscription, VirtualMachineResourceGroup, VirtualMachineName, Identity):
+    group = vmMetadataCache.get((Subscription.lower(), VirtualMachineResourceGroup.lower()))
+    if group is not None and VirtualMachineName.lower() in group:
+        group[VirtualMachineName.lower()].identity = Identity
+
+def resetVmMetadataCache():
+    with vmMetadataLocksLock:
+        vmMetadataCache.clear()
+
+def systemAssignedPrincipalId(Identity):
+    return Identity.principalId if Identity.hasSystemAssigned and Identity.principalId else None
+
+def readSystemAssignedPrincipalId(VirtualMachineResourceGroup, VirtualMachineName, Subscription):
+    # Live read used while waiting for propagation, the cached metadata would never change
+    with tracing.span("showVmIdentity", resourceGroup=VirtualMachineResourceGroup, virtualMachineName=VirtualMachineName) as span:
+        principalId = systemAssignedPrincipalId(backend.showVmIdentity(Subscription, VirtualMachineResourceGroup, VirtualMachineName))
+        span.setOutcome("ok" if principalId is not None else "pending")
+    return principalId
+
+def isServicePrincipalVisible(PrincipalId):
+    with tracing.span("servicePrincipalExists", principalId=PrincipalId) as span:
+        visible = backend.servicePrincipalExists(PrincipalId)
+        span.setOutcome("ok" if visible else "pending")
+    return visible
+
+def waitForIdentityReady(VirtualMachineResourceGroup, VirtualMachineName, Subscription):
+    # Waits until the VM reports its system assigned principal and the matching service principal
+    # can be resolved. Returns the principal id and the observed propagation latency in seconds.
+    started = time.time()
+    # Both waits share one deadline
+    deadline = started + IDENTITY_WAIT_TIMEOUT
+
+    with tracing.span("waitForIdentityReady", resourceGroup=VirtualMachineResourceGroup, virtualMachineName=VirtualMachineName) as span:
+        principalId = pollWithBackoff(lambda: readSystemAssignedPrincipalId(VirtualMachineResourceGroup, VirtualMachineName, Subscription), Deadline=deadline)
+        pollWithBackoff(lambda: True if isServicePrincipalVisible(principalId) else None, Deadline=deadline)
+        span.tag(principalId=principalId)
+
+    identity = getVmMetadata(Subscription, VirtualMachineResourceGroup, VirtualMachineName).identity
+    updateVmIdentity(Subscription, VirtualMachineResourceGroup, VirtualMachineName, VmIdentity("SystemAssigned, UserAssigned" if len(identity.userAssignedIdentities) else "SystemAssigned", principalId, identity.userAssignedIdentities))
+
+    return principalId, time.time() - started
+
+def enableSystemAssignedIdentityOnVM(VirtualMachineResourceGroup, VirtualMachineName, Subscription):
+    # Returns the principal id and the propagation latency, which is None when the identity was already enabled
+    principalId = systemAssignedPrincipalId(getVmMetadata(Subscription, VirtualMachineResourceGroup, VirtualMachineName).identity)
+
+    if principalId is not None:
+        print(bcolors.OKGREEN + "System assigned identity already enabled on virtual machine " + VirtualMachineName + bcolors.ENDC) 
+        return principalId, None
+
+    print(bcolors.OKBLUE + "Enabling system assigned identity on virtual machine " + VirtualMachineName + bcolors.ENDC) 
+
+    with tracing.span("assignVmIdentity", resourceGroup=VirtualMachineResourceGroup, virtualMachineName=VirtualMachineName, identity="system"):
+        backend.assignVmIdentity(Subscription, VirtualMachineResourceGroup, VirtualMachineName)
+
+    print(bcolors.OKGREEN + "Successfully assigned system identity to VM " + VirtualMachineName + bcolors.ENDC)
+
+    try:
+        principalId, latency = waitForIdentityReady(VirtualMachineResourceGroup, VirtualMachineName, Subscription)
+    except AzCommandError as e:
+        raise AzCommandError("System assigned identity of virtual machine " + VirtualMachineName + " is not ready: " + str(e))
+
+    print(bcolors.OKGREEN + "System assigned identity of VM " + VirtualMachineName + " ready after " + "{:.1f}".format(latency) + " seconds" + bcolors.ENDC)
+    return principalId, latency
+
+def enableIdentityOnVM(UserAssignedServiceIdentityId, UserAssignedPrincipalId, VirtualMachineResourceGroup, VirtualMachineName, Subscription):
+    # Enables the identity on one VM and returns its VmIdentityResult. A failure is recorded on the
+    # result instead of being raised.
+    result = VmIdentityResult(VirtualMachineName)
+    try:
+        journaledPrincipalId = journal.identityPrincipal(Subscription, VirtualMachineResourceGroup, VirtualMachineName, UserAssignedServiceIdentityId) if journal is not None else None
+
+        if journaledPrincipalId is not None:
+            print(bcolors.OKGREEN + "Identity on virtual machine " + VirtualMachineName + " already enabled by a previous run" + bcolors.ENDC)
+            result.principalId = journaledPrincipalId
+            return result
+
+        if UserAssignedServiceIdentityId is not None:
+            enableUserAssignedIdentityOnVM(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineName, Subscription)
+            result.principalId = UserAssignedPrincipalId
         else:
-            print(bcolors.OKBLUE + "Assigned " + RoleName + " role on scope " + Scope + " to " + PrincipalId + " successfully." + bcolors.ENDC)
-
-def assignIdentityToVMs(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineNames, Subscription):
-    service_principal_id = ""
+            result.principalId, result.propagationSeconds = enableSystemAssignedIdentityOnVM(VirtualMachineResourceGroup, VirtualMachineName, Subscription)
+
+        if journal is not None:
+            journal.recordIdentity(Subscription, VirtualMachineResourceGroup, VirtualMachineName, UserAssignedServiceIdentityId, result.principalId)
+    except Exception as e:
+        result.error = str(e)
+    return result
+
+def enableIdentitiesOnVMs(UserAssignedServiceIdentityId, UserAssignedPrincipalId, VirtualMachineResourceGroup, VirtualMachineNames, Subscription, MaxParallel=DEFAULT_MAX_PARALLEL):
+    # Enables the identity on every VM and returns one VmIdentityResult per VM in input order.
+    # Failures are recorded on the result instead of stopping the remaining VMs.
+    def worker(virtualMachineName):
+        return enableIdentityOnVM(UserAssignedServiceIdentityId, UserAssignedPrincipalId, VirtualMachineResourceGroup, virtualMachineName, Subscription)
+
+    uniqueNames = list(OrderedDict.fromkeys(VirtualMachineNames))
+    return runParallel(uniqueNames, worker, MaxParallel)
+
+def printPropagationSummary(Results):
+    latencies = sorted(result.propagationSeconds for result in Results if result.propagationSeconds is not None)
+
+    if len(latencies):
+        print(bcolors.OKBLUE + "Identity propagation latency over " + str(len(latencies)) + " virtual machines: min {:.1f}s, median {:.1f}s, max {:.1f}s".format(latencies[0], latencies[len(latencies) // 2], latencies[-1]) + bcolors.ENDC)
+
+def getUserAssignedPrincipalId(UserAssignedServiceIdentityId):
+    service_principal_id = journal.userAssignedPrincipal(UserAssignedServiceIdentityId) if journal is not None else None
+
+    if service_principal_id is None:
+        # The identity is cached under the subscription in its resource id
+        subscription = UserAssignedServiceIdentityId.split('/')[2]
+        try:
+            with tracing.span("showManagedIdentity", identityId=UserAssignedServiceIdentityId):
+                service_principal_id = ManagedIdentity.fromJson(cachedLookup(subscription, MANAGED_IDENTITY, UserAssignedServiceIdentityId, lambda: backend.showManagedIdentity(UserAssignedServiceIdentityId).toJson())).principalId
+        except AzCommandError as e:
+            print(bcolors.FAIL + "Given user assigned identity is not found or script failed with unexpected error ... " + str(e) + bcolors.ENDC)
+            printRerunHint()
+            sys.exit(1)
+
+        if journal is not None:
+            journal.recordUserAssignedPrincipal(UserAssignedServiceIdentityId, service_principal_id)
+
+    print(bcolors.OKGREEN + "Using user assigned service identity principal " + service_principal_id + bcolors.ENDC)
+    return service_principal_id
+
+def exitOnIdentityFailures(Results):
+    failures = [result for result in Results if not result.succeeded]
+
+    if len(failures):
+        for result in failures:
+            print(bcolors.FAIL + result.virtualMachineName + ": " + result.error + bcolors.ENDC)
+        print(bcolors.FAIL + "Script failed with unexpected error while assigning identity to " + str(len(failures)) + " of " + str(len(Results)) + " virtual machines ..." + bcolors.ENDC)
+        printRerunHint()
+        sys.exit(1)
+
+def assignIdentityToVMs(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineNames, Subscription, MaxParallel=DEFAULT_MAX_PARALLEL):
+    service_principal_id = None
     principalIds = []
 
-    if os.path.isfile('msiPrincipal.txt'):
-        os.remove('msiPrincipal.txt')
-
     if UserAssignedServiceIdentityId is not None:             
-        output = os.system('az identity show --ids {} -o tsv --only-show-errors > msiPrincipal.txt'.format(UserAssignedServiceIdentityId))
-
-        if output != 0:
-            print(bcolors.FAIL + "Given user assigned identity is not found or script failed with unexpected error ..." + bcolors.ENDC)
-            print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
-            sys.exit()
-
-        identity = [line[:-1] for line in fileinput.input(files='msiPrincipal.txt')]
-        service_principal_id = identity[0].split('\t')[5]
-        
-        print(bcolors.OKGREEN + "Using user assigned service identity principal " + service_principal_id + bcolors.ENDC)
-        principalIds.append(service_principal_id)
-
-        for virtualMachineName in VirtualMachineNames:            
-            identity = "\"" + UserAssignedServiceIdentityId + "\""
-            print(bcolors.OKBLUE + "Enabling user assigned identity on virtual machine " + virtualMachineName + bcolors.ENDC) 
-            output = os.system('az vm identity assign -n {} -g {} --subscription {} --identities {} -o tsv --only-show-errors > identityAssign.txt'.format(virtualMachineName, VirtualMachineResourceGroup, Subscription, identity))
-            
-            if output != 0:
-                print(bcolors.FAIL + "script failed with unexpected error ..." + bcolors.ENDC)
-                print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
-                sys.exit()
-
-            print(bcolors.OKGREEN + "Enabled user assigned identity on virtual machine " + virtualMachineName + bcolors.ENDC) 
+        service_principal_id = getUserAssignedPrincipalId(UserAssignedServiceIdentityId)
 
-    else:
-        
-        for virtualMachineName in VirtualMachineNames:
+    results = enableIdentitiesOnVMs(UserAssignedServiceIdentityId, service_principal_id, VirtualMachineResourceGroup, VirtualMachineNames, Subscription, MaxParallel)
+    printPropagationSummary(results)
+    exitOnIdentityFailures(results)
 
-            output = os.system('az vm identity show -n {} -g {} --subscription {} -o tsv --only-show-errors > identityShow.txt'.format(virtualMachineName, VirtualMachineResourceGroup, Subscription))
+    for result in results:
+        #check - add to the principalIds list 
+        if result.principalId not in principalIds:
+            principalIds.append(result.principalId)
 
-            identity = [line[:-1] for line in fileinput.input(files='identityShow.txt')]
-
-            if len(identity) == 0 or "systemassigned" not in identity[0].lower():
-                print(bcolors.OKBLUE + "Enabling system assigned identity on virtual machine " + virtualMachineName + bcolors.ENDC) 
-
-                output = os.system('az vm identity assign -n {} -g {} --subscription {} -o tsv --only-show-errors > identityAssign.txt'.format(virtualMachineName, VirtualMachineResourceGroup, Subscription))
-
-                if output != 0:
-                    print(bcolors.FAIL + "Script failed with unexpected error while assigning VM identity ..." + bcolors.ENDC)
-                    print(bcolors.FAIL + "Please re-run the script after some time." + bcolors.ENDC)
-                    sys.exit()
-
-                print(bcolors.OKGREEN + "Successfully assigned system identity to VM " + virtualMachineName + bcolors.ENDC)
-                time.sleep(10)
-                
-                output = os.system('az vm identity show -n {} -g {} --subscription {} -o tsv --only-show-errors > identityShow.txt'.format(virtualMachineName, VirtualMachineResourceGroup, Subscription)) 
-            else:
-                print(bcolors.OKGREEN + "System assigned identity already enabled on virtual machine " + virtualMachineName + bcolors.ENDC) 
-            
-            identity = [line[:-1] for line in fileinput.input(files='identityShow.txt')]
-            service_principal_id = identity[0].split("\t")[0] # (identity[1].split('"'))[3]
-
-            #check - add to the principalIds list 
-            principalIds.append(service_principal_id)
     return principalIds
 
+def getServicePrincipalIdByDisplayName(DisplayName):
+    def lookup():
+        principalIds = backend.findServicePrincipalIds(DisplayName)
+        return principalIds[0] if len(principalIds) else None
+
+    try:
+        with tracing.span("findServicePrincipal", displayName=DisplayName):
+            principalId = cachedLookup(getCurrentSubscriptionId(), SERVICE_PRINCIPAL, DisplayName, lookup)
+    except AzCommandError as e:
+        print(bcolors.FAIL + str(e) + bcolors.ENDC)
+        sys.exit(1)
+
+    if principalId is None:
+        print(bcolors.FAIL + "Failed to get " + DisplayName + " Principal Id" + bcolors.ENDC)
+        sys.exit(1)
+
+    print(bcolors.OKGREEN + "Successfully fetched " + DisplayName + " Principal Id" + bcolors.ENDC)
+    return principalId
+
+def requireArguments(Parser, Args, Names):
+    # Validates arguments that are only required in some modes, argparse cannot express that itself
+    missing = ["--" + name.replace('_', '-') for name in Names if getattr(Args, name) is None]
+    if len(missing):
+        Parser.error("the following arguments are required: " + ", ".join(missing))
+
+def getVirtualMachine(VirtualMachineResourceGroup, VirtualMachineName, Subscription):
+    try:
+        return getVmMetadata(Subscription, VirtualMachineResourceGroup, VirtualMachineName)
+    except AzCommandError as e:
+        print(bcolors.FAIL + str(e) + bcolors.ENDC)
+        printRerunHint()
+        sys.exit(1)
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -0,0 +1,123 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import json
+import os
+import sys
+import threading
+import time
+
+JOURNAL_SUFFIX = ".journal.jsonl"
+
+def defaultJournalFile():
+    # Named after the running script, so a run of one script never truncates the journal another
+    # script left for --resume
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] + JOURNAL_SUFFIX
+
+class Journal:
+    # Append-only record of completed steps, one JSON object per line. Steps are
+    #   identity  - identity enabled on a VM, with the resulting principal id
+    #   principal - principal id of a user assigned identity resolved
+    #   role      - role assignment confirmed to exist or created
+    # With Resume the steps of the previous run are loaded so they can be skipped, otherwise the
+    # journal starts empty. A ReadOnly journal keeps the steps of the run in memory only, so
+    # read-only runs such as --plan never change the file.
+    def __init__(self, Path, Resume=False, ReadOnly=False):
+        self.path = Path
+        self.readOnly = ReadOnly
+        self.lock = threading.Lock()
+        self.identities = {}
+        self.principals = {}
+        self.roles = set()
+
+        if Resume and os.path.isfile(Path):
+            self.load()
+
+        # Opened on the first completed step, so runs that complete nothing keep the previous journal
+        self.mode = 'a' if Resume else 'w'
+        self.file = None
+
+    @staticmethod
+    def identityKey(Subscription, ResourceGroup, VirtualMachineName, UserAssignedIdentityId):
+        return (Subscription.lower(), ResourceGroup.lower(), VirtualMachineName.lower(), (UserAssignedIdentityId or "system").lower())
+
+    @staticmethod
+    def roleKey(PrincipalId, Scope, RoleName):
+        return (PrincipalId.strip().lower(), Scope.strip().rstrip('/').lower(), RoleName.strip().lower())
+
+    def load(self):
+        with open(self.path, mode='r') as journalFile:
+            for line in journalFile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A run killed while writing leaves a partial last line
+                    continue
+                self.apply(entry)
+
+    def apply(self, Entry):
+        step = Entry.get("step")
+        if step == "identity":
+            self.identities[Journal.identityKey(Entry["subscription"], Entry["resourceGroup"], Entry["virtualMachineName"], Entry.get("userAssignedIdentityId"))] = Entry["principalId"]
+        elif step == "principal":
+            self.principals[Entry["userAssignedIdentityId"].lower()] = Entry["principalId"]
+        elif step == "role":
+            self.roles.add(Journal.roleKey(Entry["principalId"], Entry["scope"], Entry["roleName"]))
+
+    def append(self, Entry):
+        Entry["time"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        with self.lock:
+            self.apply(Entry)
+            if self.readOnly:
+                return
+            if self.file is None:
+                self.file = open(self.path, mode=self.mode)
+            self.file.write(json.dumps(Entry) + "\n")
+            self.file.flush()
+
+    def identityPrincipal(self, Subscription, ResourceGroup, VirtualMachineName, UserAssignedIdentityId=None):
+        return self.identities.get(Journal.identityKey(Subscription, ResourceGroup, VirtualMachineName, UserAssignedIdentityId))
+
+    def recordIdentity(self, Subscription, ResourceGroup, VirtualMachineName, UserAssignedIdentityId, PrincipalId):
+        self.append({"step": "identity", "subscription": Subscription, "resourceGroup": ResourceGroup, "virtualMachineName": VirtualMachineName, "userAssignedIdentityId": UserAssignedIdentityId, "principalId": PrincipalId})
+
+    def userAssignedPrincipal(self, UserAssignedIdentityId):
+        return self.principals.get(UserAssignedIdentityId.lower())
+
+    def recordUserAssignedPrincipal(self, UserAssignedIdentityId, PrincipalId):
+        self.append({"step": "principal", "userAssignedIdentityId": UserAssignedIdentityId, "principalId": PrincipalId})
+
+    def hasRole(self, PrincipalId, Scope, RoleName):
+        return Journal.roleKey(PrincipalId, Scope, RoleName) in self.roles
+
+    def recordRole(self, PrincipalId, Scope, RoleName):
+        if not self.hasRole(PrincipalId, Scope, RoleName):
+            self.append({"step": "role", "principalId": PrincipalId, "scope": Scope, "roleName": RoleName})
+
+    def stepCount(self):
+        return len(self.identities) + len(self.principals) + len(self.roles)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
@@ -0,0 +1,183 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from azcli import AzCommandError, invokeAz
+
+# Shared by all runs of the scripts for the user, so it is kept outside AZURE_CONFIG_DIR
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".snapshotPermissionsCache.json")
+DEFAULT_CACHE_TTL = 24 * 3600
+
+# Kinds of cached lookups
+SERVICE_PRINCIPAL = "servicePrincipal"
+MANAGED_IDENTITY = "managedIdentity"
+ROLE_DEFINITIONS = "roleDefinitions"
+SUBSCRIPTION_TENANT = "subscriptionTenant"
+
+@contextmanager
+def lockedFile(Path):
+    # Exclusive lock held across processes while the cache file is read and replaced
+    with open(Path + ".lock", mode='a+') as lockFile:
+        if fcntl is not None:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+        else:
+            lockFile.seek(0)
+            msvcrt.locking(lockFile.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+            else:
+                lockFile.seek(0)
+                msvcrt.locking(lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+
+class LookupCache:
+    # Lookups whose answer practically never changes (service principal ids, user assigned
+    # identities, role definitions), kept in a JSON file between runs. Entries are keyed by
+    # tenant, subscription, kind and name and expire Ttl seconds after they were written.
+    # Writers take a file lock and merge with the current file, which is replaced atomically, so
+    # runs sharing a host never lose each other's entries or read a partial file. With Refresh
+    # cached values are ignored and overwritten by fresh lookups.
+    def __init__(self, Path=DEFAULT_CACHE_FILE, Ttl=DEFAULT_CACHE_TTL, Refresh=False, Clock=time.time):
+        self.path = Path
+        self.ttl = Ttl
+        self.refresh = Refresh
+        self.clock = Clock
+        self.lock = threading.Lock()
+        self.entries = self.read()
+
+    @staticmethod
+    def key(TenantId, Subscription, Kind, Name):
+        return "/".join([TenantId.lower(), Subscription.lower(), Kind, Name.lower()])
+
+    def read(self):
+        try:
+            with open(self.path, mode='r') as cacheFile:
+                entries = json.load(cacheFile)
+        except (IOError, ValueError):
+            # No cache yet, or an unreadable one which the next write replaces
+            return {}
+
+        now = self.clock()
+        return dict((key, entry) for key, entry in entries.items() if isinstance(entry, dict) and entry.get("expires", 0) > now)
+
+    def update(self, Change):
+        # Applies Change to the entries on disk under the file lock and keeps the result
+        with self.lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with lockedFile(self.path):
+                entries = self.read()
+                Change(entries)
+
+                handle, temporaryPath = tempfile.mkstemp(dir=directory, prefix=".snapshotPermissionsCache")
+                try:
+                    with os.fdopen(handle, mode='w') as cacheFile:
+                        json.dump(entries, cacheFile)
+                    os.replace(temporaryPath, self.path)
+                except OSError:
+                    os.remove(temporaryPath)
+                    raise
+            self.entries = entries
+
+    def tenantOf(self, Subscription):
+        # 'az account show' reads the local profile, so resolving the tenant needs no network call
+        key = LookupCache.key("", Subscription, SUBSCRIPTION_TENANT, Subscription)
+        entry = self.entries.get(key)
+        if entry is not None and entry["expires"] > self.clock():
+            return entry["value"]
+
+        tenantId = invokeAz(["account", "show", "--subscription", Subscription], "Failed to read the tenant of subscription " + Subscription)["tenantId"]
+        self.store(key, tenantId)
+        return tenantId
+
+    def get(self, Subscription, Kind, Name):
+        if self.refresh:
+            return None
+
+        entry = self.entries.get(LookupCache.key(self.tenantOf(Subscription), Subscription, Kind, Name))
+        return entry["value"] if entry is not None and entry["expires"] > self.clock() else None
+
+    def put(self, Subscription, Kind, Name, Value):
+        self.store(LookupCache.key(self.tenantOf(Subscription), Subscription, Kind, Name), Value)
+
+    def store(self, Key, Value):
+        entry = {"value": Value, "expires": self.clock() + self.ttl}
+
+        def change(entries):
+            entries[Key] = entry
+        self.update(change)
+
+    def invalidate(self, Subscription=None, Kind=None, Name=None):
+        # Removes the matching entries of every tenant, all entries when nothing is given
+        def matches(key):
+            _, subscription, kind, name = key.split("/", 3)
+            return (Subscription is None or subscription == Subscription.lower()) and (Kind is None or kind == Kind) and (Name is None or name == Name.lower())
+
+        def change(entries):
+            for key in [key for key in entries if matches(key)]:
+                del entries[key]
+        self.update(change)
+
+# Cache shared by the helpers and the backends, None when caching is disabled
+lookupCache = None
+
+def configureLookupCache(Path=DEFAULT_CACHE_FILE, Ttl=DEFAULT_CACHE_TTL, Refresh=False):
+    global lookupCache
+    lookupCache = LookupCache(Path, Ttl, Refresh) if Path and Ttl > 0 else None
+
+def getLookupCache():
+    return lookupCache
+
+def cachedLookup(Subscription, Kind, Name, Lookup):
+    # Returns the cached value, or the result of Lookup() which is cached when it is not None.
+    # A cache that cannot be read or written never fails the lookup itself.
+    cache = lookupCache
+    if cache is None:
+        return Lookup()
+
+    try:
+        value = cache.get(Subscription, Kind, Name)
+    except (AzCommandError, OSError):
+        return Lookup()
+
+    if value is None:
+        value = Lookup()
+        if value is not None:
+            try:
+                cache.put(Subscription, Kind, Name, value)
+            except (AzCommandError, OSError):
+                pass
+    return value
@@ -0,0 +1,206 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import argparse
+import csv
+import json
+import sys
+
+import helpers
+from helpers import bcolors, setSubscriptionContext
+from planner import buildPlan, applyPlan, exitOnPlanFailures
+from sharding import runShardedManifest, DEFAULT_SHARD_DIRECTORY
+
+DEFAULT_BATCH_SIZE = 200
+
+# Manifest columns (CSV header) or keys (JSON lines). diskResourceGroups is a list in JSON lines
+# and a ';' separated value in CSV. Empty values fall back to the command line arguments.
+MANIFEST_FIELDS = ["subscription", "vmResourceGroup", "vmName", "diskResourceGroups", "snapshotResourceGroup", "identityId"]
+
+class ManifestEntry:
+    def __init__(self, Subscription, VmResourceGroup, VmName, DiskResourceGroups, SnapshotResourceGroup, IdentityId):
+        self.subscription = Subscription
+        self.vmResourceGroup = VmResourceGroup
+        self.vmName = VmName
+        self.diskResourceGroups = DiskResourceGroups
+        self.snapshotResourceGroup = SnapshotResourceGroup
+        self.identityId = IdentityId
+
+    def groupKey(self):
+        # Entries with the same key share their subscription context, role templates and identity lookups
+        return (self.subscription.lower(), self.vmResourceGroup.lower(), tuple(group.lower() for group in self.diskResourceGroups), self.snapshotResourceGroup.lower(), (self.identityId or "").lower())
+
+    def toJson(self):
+        return {"subscription": self.subscription, "vmResourceGroup": self.vmResourceGroup, "vmName": self.vmName, "diskResourceGroups": self.diskResourceGroups, "snapshotResourceGroup": self.snapshotResourceGroup, "identityId": self.identityId}
+
+class ManifestBatch:
+    def __init__(self, Entry):
+        self.subscription = Entry.subscription
+        self.vmResourceGroup = Entry.vmResourceGroup
+        self.diskResourceGroups = Entry.diskResourceGroups
+        self.snapshotResourceGroup = Entry.snapshotResourceGroup
+        self.identityId = Entry.identityId
+        self.vmNames = []
+
+def splitList(Value):
+    if Value is None:
+        return []
+    if isinstance(Value, list):
+        return [item.strip() for item in Value if item.strip()]
+    return [item.strip() for item in Value.replace(',', ';').split(';') if item.strip()]
+
+def readManifestRows(Path):
+    # Yields one dict per row without reading the whole file into memory, or None for a JSON line
+    # that cannot be parsed
+    with open(Path, mode='r', newline='') as manifestFile:
+        if Path.lower().endswith(".csv"):
+            for row in csv.DictReader(manifestFile):
+                yield row
+            return
+
+        for line in manifestFile:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+def readManifest(Path, Defaults, Failures=None):
+    # Streams ManifestEntry objects from a CSV or JSON lines manifest. Defaults holds the parsed
+    # command line arguments used for values a row leaves empty. Invalid rows are appended to
+    # Failures and skipped, without Failures they stop the run.
+    for number, row in enumerate(readManifestRows(Path), 1):
+        if not isinstance(row, dict):
+            invalidManifestRow(Path, number, "is not a JSON object", Failures)
+            continue
+
+        entry = ManifestEntry(
+            (row.get("subscription") or Defaults.subscription or "").strip(),
+            (row.get("vmResourceGroup") or Defaults.vm_resource_group or "").strip(),
+            (row.get("vmName") or "").strip(),
+            splitList(row.get("diskResourceGroups")) or list(Defaults.disk_resource_groups or []),
+            (row.get("snapshotResourceGroup") or Defaults.snapshot_resource_group or "").strip(),
+            (row.get("identityId") or Defaults.identity_id or "").strip() or None)
+
+        missing = [name for name, value in [("subscription", entry.subscription), ("vmResourceGroup", entry.vmResourceGroup), ("vmName", entry.vmName), ("diskResourceGroups", entry.diskResourceGroups), ("snapshotResourceGroup", entry.snapshotResourceGroup)] if not value]
+        if len(missing):
+            invalidManifestRow(Path, number, "has no " + ", ".join(missing), Failures)
+            continue
+
+        yield entry
+
+def invalidManifestRow(Path, Number, Error, Failures):
+    message = "Manifest " + Path + " entry " + str(Number) + " " + Error
+    print(bcolors.FAIL + message + bcolors.ENDC)
+    if Failures is None:
+        sys.exit(1)
+    Failures.append({"row": Number, "error": message})
+
+def batchManifest(Entries, BatchSize=DEFAULT_BATCH_SIZE):
+    # Groups consecutive entries with the same subscription, resource groups and identity into
+    # batches of at most BatchSize VMs. Only one batch is held in memory at a time, so a manifest
+    # sorted by subscription and resource group gives the fewest and largest batches.
+    batch = None
+    batchKey = None
+
+    for entry in Entries:
+        key = entry.groupKey()
+        if batch is not None and (key != batchKey or len(batch.vmNames) >= BatchSize):
+            yield batch
+            batch = None
+
+        if batch is None:
+            batch = ManifestBatch(entry)
+            batchKey = key
+        batch.vmNames.append(entry.vmName)
+
+    if batch is not None:
+        yield batch
+
+def addManifestArguments(Parser):
+    Parser.add_argument("--manifest", metavar="MANIFEST_FILE", help="CSV or JSON lines file with one virtual machine per row (" + ", ".join(MANIFEST_FIELDS) + "). Command line values are used for empty columns")
+    Parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Maximum number of manifest virtual machines planned and applied together")
+    Parser.add_argument("--shards", type=int, default=1, help="Number of manifest subscriptions processed at the same time, each in its own worker process with a private az CLI configuration directory. The az login is done once and shared")
+    Parser.add_argument("--shard-directory", default=DEFAULT_SHARD_DIRECTORY, help="Directory for the manifest, journal and log of each subscription and the merged report of a sharded run (default " + DEFAULT_SHARD_DIRECTORY + ")")
+    # Set by a sharded run for its workers: skip the login and write the totals to this file
+    Parser.add_argument("--shard-worker", metavar="RESULT_FILE", help=argparse.SUPPRESS)
+
+def runManifest(Args, RoleTemplatesFor):
+    # Processes the manifest batch by batch. RoleTemplatesFor(DiskResourceGroups, SnapshotResourceGroup)
+    # returns the role templates of one batch. With --plan the batch plans are written one per line
+    # to the plan file instead of being applied. With more than one shard the subscriptions are
+    # processed in parallel worker processes, see runShardedManifest.
+    readFailures = []
+    if Args.shards > 1 and Args.shard_worker is None:
+        runShardedManifest(Args, readManifest(Args.manifest, Args, readFailures), readFailures)
+        return
+
+    subscription = None
+    resourceGroup = None
+    planFile = open(Args.plan, mode='w') if Args.plan is not None else None
+    totals = {"batches": 0, "vms": 0, "identities": 0, "roles": 0, "failures": 0}
+
+    try:
+        for batch in batchManifest(readManifest(Args.manifest, Args, readFailures), Args.batch_size):
+            if subscription is None or batch.subscription.lower() != subscription.lower():
+                setSubscriptionContext(batch.subscription, Login=subscription is None and Args.shard_worker is None)
+                subscription = batch.subscription
+                resourceGroup = None
+
+            # Batches of the same resource group share its VM listing
+            if resourceGroup is None or batch.vmResourceGroup.lower() != resourceGroup.lower():
+                helpers.resetVmMetadataCache()
+                resourceGroup = batch.vmResourceGroup
+
+            templates = RoleTemplatesFor(batch.diskResourceGroups, batch.snapshotResourceGroup)
+            plan = buildPlan(batch.identityId, batch.vmResourceGroup, batch.vmNames, batch.subscription, templates, Args.max_parallel, RecordConfirmed=planFile is None)
+
+            if planFile is not None:
+                plan.printSummary()
+                plan.appendTo(planFile)
+                # Later batches treat planned assignments as present so shared ones are planned once
+                for action in plan.roleActions:
+                    if action["principalId"] is not None:
+                        helpers.recordRoleAssignment(action["principalId"], action["scope"], action["roleName"], Completed=False)
+            elif not plan.isEmpty():
+                applyPlan(plan, Args.max_parallel)
+
+            totals["batches"] += 1
+            totals["vms"] += len(batch.vmNames)
+            totals["identities"] += len(plan.identityActions)
+            totals["roles"] += len(plan.roleActions)
+            totals["failures"] += len(plan.failures)
+
+            # Principals shared by every batch, such as the Backup Management Service, stay indexed
+            helpers.resetRoleAssignmentIndex([template.principalId for template in templates if template.principalId])
+    finally:
+        if planFile is not None:
+            planFile.close()
+    totals["failures"] += len(readFailures)
+
+    if Args.shard_worker is not None:
+        with open(Args.shard_worker, mode='w') as resultFile:
+            json.dump(totals, resultFile)
+
+    print(bcolors.OKGREEN + "Manifest " + Args.manifest + ": " + str(totals["vms"]) + " virtual machines in " + str(totals["batches"]) + " batches, " + str(totals["identities"]) + " identity enablements and " + str(totals["roles"]) + " role assignments " + ("planned" if planFile is not None else "applied") + bcolors.ENDC)
+    exitOnPlanFailures(totals["failures"])
@@ -0,0 +1,94 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+class RoleAssignment:
+    def __init__(self, PrincipalId, Scope, RoleDefinitionName, RoleDefinitionId=None, Id=None):
+        self.principalId = PrincipalId
+        self.scope = Scope
+        self.roleDefinitionName = RoleDefinitionName
+        self.roleDefinitionId = RoleDefinitionId
+        self.id = Id
+
+    @staticmethod
+    def fromJson(Data):
+        return RoleAssignment(Data.get("principalId"), Data.get("scope"), Data.get("roleDefinitionName"), Data.get("roleDefinitionId"), Data.get("id"))
+
+    def toJson(self):
+        return {"id": self.id, "principalId": self.principalId, "scope": self.scope, "roleDefinitionName": self.roleDefinitionName, "roleDefinitionId": self.roleDefinitionId}
+
+class VmIdentity:
+    def __init__(self, Type, PrincipalId, UserAssignedIdentities):
+        self.type = Type or "None"
+        self.principalId = PrincipalId
+        self.userAssignedIdentities = UserAssignedIdentities or {}
+
+    @property
+    def hasSystemAssigned(self):
+        return "systemassigned" in self.type.replace(" ", "").lower()
+
+    def hasUserAssigned(self, IdentityId):
+        return IdentityId.lower() in (key.lower() for key in self.userAssignedIdentities)
+
+    @staticmethod
+    def fromJson(Data):
+        # 'az vm identity show' returns no output for a VM without any identity
+        if Data is None:
+            return VmIdentity(None, None, None)
+        return VmIdentity(Data.get("type"), Data.get("principalId"), Data.get("userAssignedIdentities"))
+
+    def toJson(self):
+        return {"type": self.type, "principalId": self.principalId, "userAssignedIdentities": self.userAssignedIdentities}
+
+class ManagedIdentity:
+    def __init__(self, Id, Name, PrincipalId, ClientId):
+        self.id = Id
+        self.name = Name
+        self.principalId = PrincipalId
+        self.clientId = ClientId
+
+    @staticmethod
+    def fromJson(Data):
+        return ManagedIdentity(Data.get("id"), Data.get("name"), Data.get("principalId"), Data.get("clientId"))
+
+    def toJson(self):
+        return {"id": self.id, "name": self.name, "principalId": self.principalId, "clientId": self.clientId}
+
+class VmMetadata:
+    def __init__(self, Id, Name, ResourceGroup, Identity):
+        self.id = Id
+        self.name = Name
+        self.resourceGroup = ResourceGroup
+        self.identity = Identity
+
+    @staticmethod
+    def fromJson(Data):
+        # 'resourceGroup' is added by az, the REST response only carries it inside the id
+        resourceGroup = Data.get("resourceGroup") or Data["id"].split('/')[4]
+        return VmMetadata(Data["id"], Data["name"], resourceGroup, VmIdentity.fromJson(Data.get("identity")))
+
+    def toJson(self):
+        return {"id": self.id, "name": self.name, "resourceGroup": self.resourceGroup, "identity": self.identity.toJson()}
+
+def servicePrincipalObjectId(Data):
+    # Graph based az versions return 'id', older AAD Graph based versions return 'objectId'
+    return Data.get("id") or Data.get("objectId")
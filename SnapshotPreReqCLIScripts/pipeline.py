@@ -0,0 +1,143 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import itertools
+import sys
+import threading
+from queue import PriorityQueue
+
+from helpers import bcolors, printRerunHint, printPropagationSummary, enableIdentityOnVM, ensureRoleAssignment, createRoleAssignment, recordRoleAssignment, roleAssignmentKey, DEFAULT_MAX_PARALLEL
+
+# Stage priorities, a lower value runs first. Shared stages are needed by every VM, role stages
+# finish work whose identity is already ready and identity stages start work on another VM.
+SHARED_STAGE = 0
+ROLE_STAGE = 1
+IDENTITY_STAGE = 2
+
+class PermissionPipeline:
+    # Runs the identity and role assignment stages of many VMs on MaxParallel workers. The role
+    # assignments of a VM are queued as soon as its identity is ready and run ahead of the identity
+    # stages still waiting, so a VM whose identity propagates slowly only delays its own roles.
+    # A role assignment needed by several VMs, for example for a shared user assigned identity,
+    # runs once.
+    def __init__(self, MaxParallel=DEFAULT_MAX_PARALLEL):
+        self.maxParallel = max(1, MaxParallel or 1)
+        self.queue = PriorityQueue()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.roleStages = set()
+        self.identityResults = []
+        self.roleErrors = []
+        self.stageErrors = []
+
+    def submit(self, Priority, Stage, *Args):
+        with self.condition:
+            self.pending += 1
+        # The sequence keeps stages of equal priority in submission order
+        self.queue.put((Priority, next(self.sequence), Stage, Args))
+
+    def work(self):
+        while True:
+            _, _, stage, args = self.queue.get()
+            if stage is None:
+                return
+
+            try:
+                stage(*args)
+            except (Exception, SystemExit) as e:
+                # Helpers that end the script on a fatal error raise SystemExit, the other stages carry on
+                with self.condition:
+                    self.stageErrors.append(str(e) or "stage " + stage.__name__ + " stopped")
+            finally:
+                with self.condition:
+                    self.pending -= 1
+                    if self.pending == 0:
+                        self.condition.notify_all()
+
+    def assignRole(self, PrincipalId, RoleName, Scope, Priority=ROLE_STAGE, Check=True):
+        # Without Check the assignment is known to be missing, as in a plan, and is created directly
+        key = roleAssignmentKey(PrincipalId, Scope, RoleName)
+        with self.condition:
+            if key in self.roleStages:
+                return
+            self.roleStages.add(key)
+        self.submit(Priority, self.roleStage, PrincipalId, RoleName, Scope, Check)
+
+    def roleStage(self, PrincipalId, RoleName, Scope, Check):
+        if Check:
+            error = ensureRoleAssignment(PrincipalId, RoleName, Scope)
+        else:
+            print(bcolors.OKBLUE + "Assigning role " + RoleName + " to " + PrincipalId + " on scope " + Scope + bcolors.ENDC)
+            error = createRoleAssignment(PrincipalId, RoleName, Scope)
+            if error is None:
+                recordRoleAssignment(PrincipalId, Scope, RoleName)
+                print(bcolors.OKBLUE + "Assigned " + RoleName + " role on scope " + Scope + " to " + PrincipalId + " successfully." + bcolors.ENDC)
+
+        if error is not None:
+            with self.condition:
+                self.roleErrors.append(error)
+
+    def enableIdentity(self, UserAssignedServiceIdentityId, UserAssignedPrincipalId, VirtualMachineResourceGroup, VirtualMachineName, Subscription, OnReady):
+        # OnReady(principalId) is called on the worker once the identity is ready, to queue the VM's roles
+        self.submit(IDENTITY_STAGE, self.identityStage, UserAssignedServiceIdentityId, UserAssignedPrincipalId, VirtualMachineResourceGroup, VirtualMachineName, Subscription, OnReady)
+
+    def identityStage(self, UserAssignedServiceIdentityId, UserAssignedPrincipalId, VirtualMachineResourceGroup, VirtualMachineName, Subscription, OnReady):
+        result = enableIdentityOnVM(UserAssignedServiceIdentityId, UserAssignedPrincipalId, VirtualMachineResourceGroup, VirtualMachineName, Subscription)
+        with self.condition:
+            self.identityResults.append(result)
+
+        if result.succeeded:
+            OnReady(result.principalId)
+
+    def run(self):
+        # Runs until every stage, including the ones queued by other stages, has finished
+        workers = [threading.Thread(target=self.work, name="pipeline-" + str(index), daemon=True) for index in range(self.maxParallel)]
+        for worker in workers:
+            worker.start()
+
+        with self.condition:
+            while self.pending > 0:
+                # Waiting with a timeout keeps Ctrl+C working
+                self.condition.wait(1)
+
+        for worker in workers:
+            self.queue.put((sys.maxsize, next(self.sequence), None, None))
+        for worker in workers:
+            worker.join()
+
+    def exitOnFailures(self):
+        printPropagationSummary(self.identityResults)
+
+        identityFailures = [result for result in self.identityResults if not result.succeeded]
+        for result in identityFailures:
+            print(bcolors.FAIL + result.virtualMachineName + ": " + result.error + bcolors.ENDC)
+        for error in self.roleErrors:
+            print(bcolors.FAIL + "Exception caught while assigning role: " + error + bcolors.ENDC)
+        for error in self.stageErrors:
+            print(bcolors.FAIL + "Script failed with unexpected error ... " + error + bcolors.ENDC)
+
+        if len(identityFailures) or len(self.roleErrors) or len(self.stageErrors):
+            print(bcolors.FAIL + str(len(identityFailures)) + " of " + str(len(self.identityResults)) + " identity enablements and " + str(len(self.roleErrors)) + " of " + str(len(self.roleStages)) + " role assignments failed." + bcolors.ENDC)
+            printRerunHint()
+            sys.exit(1)
@@ -0,0 +1,263 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import json
+import sys
+import time
+from collections import OrderedDict
+
+import helpers
+from azcli import AzCommandError
+from helpers import bcolors, printRerunHint, isRoleJournaled, getVmMetadata, VirtualMachineNotFoundError, getUserAssignedPrincipalId, prefetchPrincipals, isRoleAssigned, recordRoleAssignment, setSubscriptionContext, DEFAULT_MAX_PARALLEL
+from pipeline import PermissionPipeline, SHARED_STAGE
+
+PLAN_VERSION = 1
+
+# Scope placeholder in a RoleTemplate that stands for the virtual machine itself
+VM_SCOPE = "<virtual-machine>"
+
+class RoleTemplate:
+    # A role every VM principal needs on Scope, or a role for one fixed PrincipalId
+    def __init__(self, RoleName, Scope, PrincipalId=None):
+        self.roleName = RoleName
+        self.scope = Scope
+        self.principalId = PrincipalId
+
+class PermissionPlan:
+    def __init__(self, Subscription, UserAssignedServiceIdentityId=None):
+        self.subscription = Subscription
+        self.userAssignedServiceIdentityId = UserAssignedServiceIdentityId
+        # {"resourceGroup", "virtualMachineName"} per VM whose identity must be enabled
+        self.identityActions = []
+        # {"principalId", "resourceGroup", "virtualMachineName", "roleName", "scope"}, principalId is None
+        # when it is the system assigned principal of a VM in identityActions
+        self.roleActions = []
+        # {"resourceGroup", "virtualMachineName", "error"} per VM that could not be planned
+        self.failures = []
+
+    def toJson(self):
+        return OrderedDict([
+            ("version", PLAN_VERSION),
+            ("createdAt", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+            ("subscription", self.subscription),
+            ("userAssignedServiceIdentityId", self.userAssignedServiceIdentityId),
+            ("identityActions", self.identityActions),
+            ("roleActions", self.roleActions),
+            ("failures", self.failures),
+        ])
+
+    def save(self, Path):
+        with open(Path, mode='w') as planFile:
+            json.dump(self.toJson(), planFile, indent=2)
+
+    def appendTo(self, PlanFile):
+        # Plans of a manifest run are written one per line
+        PlanFile.write(json.dumps(self.toJson()) + "\n")
+
+    @staticmethod
+    def fromJson(Data):
+        if Data.get("version") != PLAN_VERSION:
+            raise ValueError("Unsupported plan version " + str(Data.get("version")))
+
+        plan = PermissionPlan(Data["subscription"], Data.get("userAssignedServiceIdentityId"))
+        plan.identityActions = Data["identityActions"]
+        plan.roleActions = Data["roleActions"]
+        plan.failures = Data.get("failures", [])
+        return plan
+
+    @staticmethod
+    def iterate(Path):
+        # Yields the plans in Path, either a single JSON document or one plan per line
+        with open(Path, mode='r') as planFile:
+            firstLine = planFile.readline()
+            try:
+                first = json.loads(firstLine)
+            except ValueError:
+                planFile.seek(0)
+                yield PermissionPlan.fromJson(json.load(planFile))
+                return
+
+            yield PermissionPlan.fromJson(first)
+            for line in planFile:
+                if line.strip():
+                    yield PermissionPlan.fromJson(json.loads(line))
+
+    def isEmpty(self):
+        return not len(self.identityActions) and not len(self.roleActions)
+
+    def printSummary(self):
+        for action in self.identityActions:
+            print(bcolors.OKBLUE + "+ enable " + ("user" if self.userAssignedServiceIdentityId else "system") + " assigned identity on virtual machine " + action["virtualMachineName"] + bcolors.ENDC)
+        for action in self.roleActions:
+            principal = action["principalId"] or "<identity of " + action["virtualMachineName"] + ">"
+            print(bcolors.OKBLUE + "+ assign " + action["roleName"] + " to " + principal + " on " + action["scope"] + bcolors.ENDC)
+        for failure in self.failures:
+            print(bcolors.FAIL + "! skip virtual machine " + failure["virtualMachineName"] + ": " + failure["error"] + bcolors.ENDC)
+        print(bcolors.OKGREEN + "Plan: " + str(len(self.identityActions)) + " identity enablements, " + str(len(self.roleActions)) + " role assignments to create" + bcolors.ENDC)
+        if len(self.failures):
+            print(bcolors.FAIL + str(len(self.failures)) + " virtual machines could not be planned" + bcolors.ENDC)
+
+def readVirtualMachines(VirtualMachineResourceGroup, VirtualMachineNames, Subscription, Failures):
+    # Returns (name, resource id, VmIdentity) per VM from the resource group listing. VMs missing
+    # from the listing are appended to Failures and left out, the others are still planned.
+    try:
+        virtualMachines = []
+        for virtualMachineName in OrderedDict.fromkeys(VirtualMachineNames):
+            try:
+                vm = getVmMetadata(Subscription, VirtualMachineResourceGroup, virtualMachineName)
+            except VirtualMachineNotFoundError as e:
+                print(bcolors.FAIL + str(e) + bcolors.ENDC)
+                Failures.append({"resourceGroup": VirtualMachineResourceGroup, "virtualMachineName": virtualMachineName, "error": str(e)})
+                continue
+            virtualMachines.append((virtualMachineName, vm.id, vm.identity))
+        return virtualMachines
+    except AzCommandError as e:
+        # The resource group listing itself failed
+        print(bcolors.FAIL + str(e) + bcolors.ENDC)
+        printRerunHint()
+        sys.exit(1)
+
+def buildPlan(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineNames, Subscription, RoleTemplates, MaxParallel=DEFAULT_MAX_PARALLEL, RecordConfirmed=False):
+    # Reads the current identities and role assignments in bulk and returns the PermissionPlan
+    # holding only the identity enablements and role assignments that are missing. With
+    # RecordConfirmed the identities and assignments found in place are written to the journal.
+    plan = PermissionPlan(Subscription, UserAssignedServiceIdentityId)
+    userAssignedPrincipalId = getUserAssignedPrincipalId(UserAssignedServiceIdentityId) if UserAssignedServiceIdentityId is not None else None
+
+    print(bcolors.OKBLUE + "Reading " + str(len(VirtualMachineNames)) + " virtual machines in resource group " + VirtualMachineResourceGroup + bcolors.ENDC)
+    virtualMachines = readVirtualMachines(VirtualMachineResourceGroup, VirtualMachineNames, Subscription, plan.failures)
+
+    vmPrincipals = []
+    for virtualMachineName, vmId, identity in virtualMachines:
+        if UserAssignedServiceIdentityId is not None:
+            enabled = identity.hasUserAssigned(UserAssignedServiceIdentityId)
+            principalId = userAssignedPrincipalId
+        else:
+            enabled = identity.hasSystemAssigned and identity.principalId is not None
+            principalId = identity.principalId if enabled else None
+
+        if not enabled:
+            plan.identityActions.append({"resourceGroup": VirtualMachineResourceGroup, "virtualMachineName": virtualMachineName})
+        elif RecordConfirmed and helpers.journal is not None:
+            helpers.journal.recordIdentity(Subscription, VirtualMachineResourceGroup, virtualMachineName, UserAssignedServiceIdentityId, principalId)
+        vmPrincipals.append((virtualMachineName, vmId, principalId))
+
+    required = OrderedDict()
+    for virtualMachineName, vmId, vmPrincipalId in vmPrincipals:
+        for template in RoleTemplates:
+            principalId = template.principalId or vmPrincipalId
+            scope = vmId if template.scope == VM_SCOPE else template.scope
+            key = (principalId or virtualMachineName, scope.lower(), template.roleName.lower())
+
+            # Assignments recorded in the journal by a previous run need no lookup
+            if key not in required and not (principalId is not None and isRoleJournaled(principalId, scope, template.roleName)):
+                required[key] = (principalId, virtualMachineName, template.roleName, scope)
+
+    # Principals whose identity is not enabled yet cannot hold any assignment, so they are not listed
+    knownPrincipals = OrderedDict.fromkeys(principalId for principalId, _, _, _ in required.values() if principalId)
+    print(bcolors.OKBLUE + "Reading role assignments of " + str(len(knownPrincipals)) + " principals" + bcolors.ENDC)
+    prefetchPrincipals(list(knownPrincipals), MaxParallel)
+
+    for principalId, virtualMachineName, roleName, scope in required.values():
+        if principalId is not None and isRoleAssigned(principalId, scope, roleName):
+            if RecordConfirmed:
+                recordRoleAssignment(principalId, scope, roleName)
+        else:
+            plan.roleActions.append({"principalId": principalId, "resourceGroup": VirtualMachineResourceGroup, "virtualMachineName": None if principalId else virtualMachineName, "roleName": roleName, "scope": scope})
+
+    return plan
+
+def applyPlan(Plan, MaxParallel=DEFAULT_MAX_PARALLEL):
+    # Runs the plan through a PermissionPipeline: role assignments of known principals start right
+    # away, the others as soon as the identity of their VM is ready
+    pipeline = PermissionPipeline(MaxParallel)
+    dependentActions = {}
+
+    for action in Plan.roleActions:
+        if action["principalId"] is not None:
+            pipeline.assignRole(action["principalId"], action["roleName"], action["scope"], SHARED_STAGE, Check=False)
+        else:
+            dependentActions.setdefault((action["resourceGroup"].lower(), action["virtualMachineName"].lower()), []).append(action)
+
+    if len(Plan.identityActions):
+        userAssignedPrincipalId = getUserAssignedPrincipalId(Plan.userAssignedServiceIdentityId) if Plan.userAssignedServiceIdentityId is not None else None
+
+        for action in Plan.identityActions:
+            def onReady(PrincipalId, Actions=dependentActions.get((action["resourceGroup"].lower(), action["virtualMachineName"].lower()), [])):
+                for roleAction in Actions:
+                    pipeline.assignRole(PrincipalId, roleAction["roleName"], roleAction["scope"], Check=False)
+            pipeline.enableIdentity(Plan.userAssignedServiceIdentityId, userAssignedPrincipalId, action["resourceGroup"], action["virtualMachineName"], Plan.subscription, onReady)
+
+    pipeline.run()
+    pipeline.exitOnFailures()
+
+def runPermissionPipeline(UserAssignedServiceIdentityId, VirtualMachineResourceGroup, VirtualMachineNames, Subscription, RoleTemplates, MaxParallel=DEFAULT_MAX_PARALLEL):
+    # Enables the identities and assigns the RoleTemplates VM by VM without computing a plan first.
+    # Roles of fixed principals, such as the Backup Management Service, run once and first.
+    pipeline = PermissionPipeline(MaxParallel)
+    userAssignedPrincipalId = getUserAssignedPrincipalId(UserAssignedServiceIdentityId) if UserAssignedServiceIdentityId is not None else None
+
+    for template in RoleTemplates:
+        if template.principalId is not None:
+            pipeline.assignRole(template.principalId, template.roleName, template.scope, SHARED_STAGE)
+
+    vmTemplates = [template for template in RoleTemplates if template.principalId is None]
+    for virtualMachineName in OrderedDict.fromkeys(VirtualMachineNames):
+        def onReady(PrincipalId, VirtualMachineName=virtualMachineName):
+            for template in vmTemplates:
+                scope = getVmMetadata(Subscription, VirtualMachineResourceGroup, VirtualMachineName).id if template.scope == VM_SCOPE else template.scope
+                pipeline.assignRole(PrincipalId, template.roleName, scope)
+        pipeline.enableIdentity(UserAssignedServiceIdentityId, userAssignedPrincipalId, VirtualMachineResourceGroup, virtualMachineName, Subscription, onReady)
+
+    pipeline.run()
+    pipeline.exitOnFailures()
+
+def addPlanArguments(Parser):
+    Parser.add_argument("--plan", metavar="PLAN_FILE", help="Only compute the identity enablements and role assignments that are missing and write them to PLAN_FILE, nothing is changed")
+    Parser.add_argument("--apply", metavar="PLAN_FILE", help="Apply a plan written earlier with --plan, the other arguments are taken from the plan")
+
+def exitOnPlanFailures(FailureCount):
+    # VMs that could not be planned fail the run once everything else is done
+    if FailureCount:
+        print(bcolors.FAIL + str(FailureCount) + " virtual machines were skipped, fix or remove them and run the script again" + bcolors.ENDC)
+        sys.exit(1)
+
+def writePlanFile(Path, Plan):
+    Plan.printSummary()
+    Plan.save(Path)
+    print(bcolors.OKGREEN + "Plan written to " + Path + bcolors.ENDC)
+    exitOnPlanFailures(len(Plan.failures))
+
+def applyPlanFile(Path, MaxParallel=DEFAULT_MAX_PARALLEL):
+    subscription = None
+
+    for plan in PermissionPlan.iterate(Path):
+        if subscription is None or plan.subscription.lower() != subscription.lower():
+            setSubscriptionContext(plan.subscription, Login=subscription is None)
+            subscription = plan.subscription
+
+        plan.printSummary()
+        applyPlan(plan, MaxParallel)
+        helpers.resetRoleAssignmentIndex()
+
+    print(bcolors.OKGREEN + "Plan " + Path + " applied" + bcolors.ENDC)
@@ -0,0 +1,154 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import email.utils
+import random
+import re
+import threading
+import time
+
+import tracing
+
+# HTTP status codes worth retrying, everything else (authorization, not found, bad request) is final
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# Error codes and status texts az prints for throttled or transient failures, as "(Code) message",
+# "Code: Code" or "status code 429". Only these tokens are matched, resource names in a message
+# can contain the same digits or words.
+def errorPattern(Codes, Statuses, Extra=()):
+    codes = "|".join(Codes)
+    statuses = "|".join(Statuses)
+    alternatives = [r"\((?:" + codes + r")\)", r"\bcode:\s*(?:" + codes + r")\b", r"\bstatus code:?\s*'?(?:" + statuses + r")\b"] + list(Extra)
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+THROTTLED_ERROR_PATTERN = errorPattern(["TooManyRequests", "SubscriptionRequestsThrottled", "TenantRequestsThrottled"], ["429", "Too Many Requests"])
+# Connection failures surface as the Python exception names in the az error output
+TRANSIENT_ERROR_PATTERN = errorPattern(["RetryableError", "ServiceUnavailable", "InternalServerError", "GatewayTimeout", "BadGateway"], ["500", "502", "503", "504", "Internal Server Error", "Bad Gateway", "Service Unavailable", "Gateway Timeout"], [r"\bConnectionResetError\b", r"\bConnectionAbortedError\b", r"\bNewConnectionError\b", r"\bReadTimeoutError\b", r"\bConnectTimeoutError\b", r"'Connection aborted\.'"])
+RETRY_AFTER_PATTERN = re.compile(r"retry[- ]after\D{0,3}(\d+)", re.IGNORECASE)
+
+# Return code of a request that failed before any response was received
+TRANSPORT_FAILURE = -1
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_REQUESTS_PER_SECOND = 20.0
+MAX_RETRY_AFTER = 300
+
+def parseRetryAfter(Value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if Value is None:
+        return None
+    try:
+        return max(0.0, float(Value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(Value)
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time()) if parsed else None
+
+class TokenBucket:
+    # Rate limiter shared by every worker thread. Callers reserve a token and sleep outside the
+    # lock until it is due, so waiting workers are served in order at the configured rate.
+    def __init__(self, Rate, Capacity=None, Clock=time.time, Sleep=time.sleep):
+        self.rate = float(Rate)
+        self.capacity = float(Capacity if Capacity is not None else max(1.0, Rate))
+        self.tokens = self.capacity
+        self.clock = Clock
+        self.sleep = Sleep
+        self.updated = Clock()
+        self.resumeAt = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.resumeAt - now, 0.0)
+
+        if wait > 0:
+            with tracing.span("rate limit wait", tracing.WAIT):
+                self.sleep(wait)
+
+    def pause(self, Seconds):
+        # After throttling every worker holds off, instead of each one hitting the limit again
+        with self.lock:
+            self.resumeAt = max(self.resumeAt, self.clock() + Seconds)
+
+class RetryPolicy:
+    def __init__(self, MaxRetries=DEFAULT_MAX_RETRIES, BaseDelay=1.0, MaxDelay=60.0, Limiter=None, Sleep=time.sleep):
+        self.maxRetries = MaxRetries
+        self.baseDelay = BaseDelay
+        self.maxDelay = MaxDelay
+        self.limiter = Limiter
+        self.sleep = Sleep
+
+    def classify(self, Result):
+        # Returns (retryable, throttled, retry after seconds or None) for a failed CommandResult
+        if Result.statusCode is not None:
+            throttled = Result.statusCode == 429
+            return Result.statusCode in RETRYABLE_STATUS_CODES, throttled, Result.retryAfter
+
+        if Result.returnCode == TRANSPORT_FAILURE:
+            return True, False, None
+
+        throttled = THROTTLED_ERROR_PATTERN.search(Result.stderr) is not None
+        transient = TRANSIENT_ERROR_PATTERN.search(Result.stderr) is not None
+        match = RETRY_AFTER_PATTERN.search(Result.stderr)
+        return throttled or transient, throttled, float(match.group(1)) if match else None
+
+    def backoff(self, Attempt):
+        delay = min(self.maxDelay, self.baseDelay * (2 ** Attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def run(self, Attempt):
+        # Calls Attempt, which returns a CommandResult, until it succeeds, fails with a
+        # non-retryable error or the retries are used up. Returns the last result.
+        retry = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+
+            result = Attempt()
+            if result.succeeded:
+                return result
+
+            retryable, throttled, retryAfter = self.classify(result)
+            if not retryable or retry >= self.maxRetries:
+                return result
+
+            delay = min(retryAfter, MAX_RETRY_AFTER) if retryAfter is not None else self.backoff(retry)
+            if throttled and self.limiter is not None:
+                self.limiter.pause(delay)
+
+            with tracing.span("retry wait", tracing.WAIT, throttled=throttled, attempt=retry + 1):
+                self.sleep(delay)
+            retry += 1
+
+# Policy shared by every az command and REST request, see configureRetryPolicy
+policy = RetryPolicy(Limiter=TokenBucket(DEFAULT_REQUESTS_PER_SECOND))
+
+def configureRetryPolicy(MaxRetries=DEFAULT_MAX_RETRIES, RequestsPerSecond=DEFAULT_REQUESTS_PER_SECOND):
+    global policy
+    policy = RetryPolicy(MaxRetries, Limiter=TokenBucket(RequestsPerSecond) if RequestsPerSecond and RequestsPerSecond > 0 else None)
+
+def getRetryPolicy():
+    return policy
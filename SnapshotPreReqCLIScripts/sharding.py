@@ -0,0 +1,226 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import tracing
+from azcli import runAz
+from helpers import bcolors, runParallel
+from planner import exitOnPlanFailures
+
+# The az CLI keeps the login and the current subscription in its configuration directory, so
+# processes sharing it switch each other's subscription with 'az account set'. A sharded run logs
+# in once, splits the manifest by subscription and runs the script once per subscription in a
+# worker process with a private copy of the configuration directory.
+
+DEFAULT_SHARD_DIRECTORY = "snapshotPermissionsShards"
+SHARD_REPORT_FILE = "report.json"
+
+# Options the parent sets itself for every worker
+SHARD_OPTIONS = ["--manifest", "--shards", "--shard-directory", "--plan", "--journal", "--trace", "--requests-per-second"]
+
+def azureConfigDirectory():
+    return os.environ.get("AZURE_CONFIG_DIR") or os.path.join(os.path.expanduser("~"), ".azure")
+
+def withoutOptions(Argv, Names):
+    # Argv without the options in Names and their values, given as '--name value' or '--name=value'
+    remaining = []
+    skipValue = False
+    for arg in Argv:
+        if skipValue:
+            skipValue = False
+            continue
+        name = arg.split("=", 1)[0]
+        if name in Names:
+            skipValue = "=" not in arg
+            continue
+        remaining.append(arg)
+    return remaining
+
+class Shard:
+    # The manifest rows of one subscription and the files of its worker
+    def __init__(self, Subscription, Directory):
+        self.subscription = Subscription
+        base = os.path.join(Directory, re.sub(r"[^A-Za-z0-9_.-]", "_", Subscription))
+        self.manifestPath = base + ".manifest.jsonl"
+        self.journalPath = base + ".journal.jsonl"
+        self.planPath = base + ".plan.jsonl"
+        self.tracePath = base + ".trace.jsonl"
+        self.logPath = base + ".log"
+        self.resultPath = base + ".result.json"
+        self.rows = 0
+        self.returnCode = None
+        self.seconds = None
+        # Totals written by the worker when it completed, None when it failed
+        self.result = None
+
+    def toJson(self):
+        return OrderedDict([
+            ("subscription", self.subscription),
+            ("rows", self.rows),
+            ("succeeded", self.result is not None),
+            ("returnCode", self.returnCode),
+            ("seconds", round(self.seconds, 3) if self.seconds is not None else None),
+            ("totals", self.result),
+            ("log", self.logPath),
+            ("journal", self.journalPath),
+        ])
+
+def splitManifest(Entries, Directory):
+    # Streams the manifest entries into one JSON lines manifest per subscription
+    shards = OrderedDict()
+    files = {}
+    try:
+        for entry in Entries:
+            key = entry.subscription.lower()
+            if key not in shards:
+                shards[key] = Shard(entry.subscription, Directory)
+                files[key] = open(shards[key].manifestPath, mode='w')
+            files[key].write(json.dumps(entry.toJson()) + "\n")
+            shards[key].rows += 1
+    finally:
+        for manifestFile in files.values():
+            manifestFile.close()
+    return list(shards.values())
+
+def copyConfigDirectory(Source):
+    # Private configuration directory holding the profile and token cache of the shared login.
+    # Logs, command indexes and extensions are not copied.
+    target = tempfile.mkdtemp(prefix="snapshotPermissionsAz-")
+    if os.path.isdir(Source):
+        for name in os.listdir(Source):
+            path = os.path.join(Source, name)
+            if os.path.isfile(path) and not name.endswith(".lock"):
+                shutil.copy2(path, os.path.join(target, name))
+    return target
+
+def workerEnvironment(ConfigDirectory, SourceDirectory):
+    environment = dict(os.environ)
+    environment["AZURE_CONFIG_DIR"] = ConfigDirectory
+    # Extensions are installed below the configuration directory unless AZURE_EXTENSION_DIR is set
+    environment.setdefault("AZURE_EXTENSION_DIR", os.path.join(SourceDirectory, "cliextensions"))
+    return environment
+
+def runShard(Shard, Args, SourceDirectory, Workers):
+    # Runs the script on the rows of one subscription, its output goes to the shard log. Each of the
+    # Workers processes running at the same time gets an equal part of --requests-per-second, so
+    # together they stay within the limit.
+    command = [sys.executable, os.path.abspath(sys.argv[0])] + withoutOptions(sys.argv[1:], SHARD_OPTIONS)
+    command += ["--manifest", Shard.manifestPath, "--journal", Shard.journalPath, "--shard-worker", Shard.resultPath]
+    command += ["--requests-per-second", repr(Args.requests_per_second / Workers)]
+    if Args.plan is not None:
+        command += ["--plan", Shard.planPath]
+    if Args.trace is not None:
+        command += ["--trace", Shard.tracePath]
+
+    if os.path.isfile(Shard.resultPath):
+        os.remove(Shard.resultPath)
+
+    configDirectory = copyConfigDirectory(SourceDirectory)
+    started = time.time()
+    try:
+        with tracing.span("shard", subscription=Shard.subscription) as span, open(Shard.logPath, mode='w') as logFile:
+            Shard.returnCode = subprocess.call(command, stdout=logFile, stderr=subprocess.STDOUT, env=workerEnvironment(configDirectory, SourceDirectory))
+            span.setOutcome("ok" if os.path.isfile(Shard.resultPath) else "failed")
+    finally:
+        # The copy holds access tokens
+        shutil.rmtree(configDirectory, ignore_errors=True)
+    Shard.seconds = time.time() - started
+
+    if os.path.isfile(Shard.resultPath):
+        with open(Shard.resultPath, mode='r') as resultFile:
+            Shard.result = json.load(resultFile)
+        print(bcolors.OKGREEN + "Subscription " + Shard.subscription + ": " + str(Shard.result["vms"]) + " virtual machines, " + str(Shard.result["identities"]) + " identity enablements and " + str(Shard.result["roles"]) + " role assignments in {:.1f}s".format(Shard.seconds) + bcolors.ENDC)
+        if Shard.result["failures"]:
+            print(bcolors.FAIL + "Subscription " + Shard.subscription + ": " + str(Shard.result["failures"]) + " virtual machines skipped, see " + Shard.logPath + bcolors.ENDC)
+    else:
+        print(bcolors.FAIL + "Subscription " + Shard.subscription + " failed, see " + Shard.logPath + bcolors.ENDC)
+    return Shard
+
+def mergePlans(Shards, Path):
+    # Shard plans hold one plan per line, so the merged plan is their concatenation
+    with open(Path, mode='w') as planFile:
+        for shard in Shards:
+            if shard.result is not None and os.path.isfile(shard.planPath):
+                with open(shard.planPath, mode='r') as shardPlanFile:
+                    shutil.copyfileobj(shardPlanFile, planFile)
+
+def writeShardReport(Shards, Args, Path, ReadFailures):
+    totals = OrderedDict((name, sum(shard.result[name] for shard in Shards if shard.result is not None)) for name in ["batches", "vms", "identities", "roles", "failures"])
+    # Invalid manifest rows never reach a shard
+    totals["failures"] += len(ReadFailures)
+    report = OrderedDict([
+        ("createdAt", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+        ("manifest", Args.manifest),
+        ("mode", "plan" if Args.plan is not None else "apply"),
+        ("succeeded", all(shard.result is not None for shard in Shards)),
+        ("totals", totals),
+        ("subscriptions", [shard.toJson() for shard in Shards]),
+        ("invalidRows", ReadFailures),
+    ])
+    with open(Path, mode='w') as reportFile:
+        json.dump(report, reportFile, indent=2)
+    return report
+
+def runShardedManifest(Args, Entries, ReadFailures):
+    # Runs the manifest Entries with up to Args.shards subscriptions processed at the same time.
+    # The shard manifests, journals, logs and the merged report are kept in Args.shard_directory,
+    # so a failed run re-run with --resume continues each subscription from its own journal.
+    # ReadFailures holds the invalid manifest rows skipped while Entries is read.
+    if not os.path.isdir(Args.shard_directory):
+        os.makedirs(Args.shard_directory)
+    shards = splitManifest(Entries, Args.shard_directory)
+    print(bcolors.OKBLUE + "Processing " + str(sum(shard.rows for shard in shards)) + " manifest rows in " + str(len(shards)) + " subscriptions with up to " + str(Args.shards) + " worker processes" + bcolors.ENDC)
+
+    # One login shared by every worker through its copy of the configuration directory
+    with tracing.span("login"):
+        runAz(["login"], Interactive=True)
+    sourceDirectory = azureConfigDirectory()
+
+    workers = min(Args.shards, len(shards))
+    runParallel(shards, lambda shard: runShard(shard, Args, sourceDirectory, workers), Args.shards)
+
+    if Args.plan is not None:
+        mergePlans(shards, Args.plan)
+    reportPath = os.path.join(Args.shard_directory, SHARD_REPORT_FILE)
+    report = writeShardReport(shards, Args, reportPath, ReadFailures)
+
+    totals = report["totals"]
+    failed = [shard for shard in shards if shard.result is None]
+    print(bcolors.OKGREEN + "Manifest " + Args.manifest + ": " + str(totals["vms"]) + " virtual machines in " + str(len(shards) - len(failed)) + " subscriptions, " + str(totals["identities"]) + " identity enablements and " + str(totals["roles"]) + " role assignments " + ("planned" if Args.plan is not None else "applied") + bcolors.ENDC)
+    print(bcolors.OKGREEN + "Report written to " + reportPath + bcolors.ENDC)
+
+    if len(failed):
+        print(bcolors.FAIL + str(len(failed)) + " of " + str(len(shards)) + " subscriptions failed, see their logs in " + Args.shard_directory + bcolors.ENDC)
+        print(bcolors.FAIL + "Please re-run the script after some time. Add --resume to skip the steps recorded in the subscription journals." + bcolors.ENDC)
+        sys.exit(1)
+
+    exitOnPlanFailures(totals["failures"])
@@ -0,0 +1,144 @@
+#
+# Copyright 2021 (c) Microsoft Corporation
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this script and associated documentation files (the "script"), to deal
+# in the script without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the scipt, and to permit persons to whom the script is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the script.
+
+# THE SCRIPT IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SCRIPT OR THE USE OR OTHER DEALINGS IN THE
+# SCRIPT
+
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Span categories
+OPERATION = "operation"
+CALL = "call"
+WAIT = "wait"
+
+class Span:
+    # One timed unit of work. The outcome is "ok" unless set otherwise or the block raises.
+    def __init__(self, Tracer, Operation, Category, Tags):
+        self.tracer = Tracer
+        self.operation = Operation
+        self.category = Category
+        self.tags = Tags
+        self.outcome = "ok"
+
+    def setOutcome(self, Outcome):
+        self.outcome = Outcome
+
+    def tag(self, **Tags):
+        self.tags.update(Tags)
+
+    def __enter__(self):
+        self.started = time.time()
+        self.startedCounter = time.perf_counter()
+        return self
+
+    def __exit__(self, Type, Value, Traceback):
+        if Type is not None and self.outcome == "ok":
+            self.outcome = "error"
+            self.tags["error"] = str(Value)
+        self.tracer.record(self, time.perf_counter() - self.startedCounter)
+        return False
+
+class NoSpan:
+    # Stands in for Span when tracing is disabled
+    def setOutcome(self, Outcome):
+        pass
+
+    def tag(self, **Tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, Type, Value, Traceback):
+        return False
+
+NO_SPAN = NoSpan()
+
+def percentile(SortedValues, Percent):
+    # Nearest-rank percentile of an ascending list
+    return SortedValues[max(0, int(math.ceil(Percent / 100.0 * len(SortedValues))) - 1)]
+
+class Tracer:
+    # Writes every span as one JSON line to Path while the run goes on, and on close a Chrome trace
+    # (chrome://tracing, https://ui.perfetto.dev) next to it. Spans of a thread nest by time, so an
+    # operation shows the az commands or HTTP requests and waits it was made of.
+    def __init__(self, Path):
+        self.path = Path
+        self.chromePath = os.path.splitext(Path)[0] + ".chrome.json"
+        self.lock = threading.Lock()
+        self.startedCounter = time.perf_counter()
+        self.events = []
+        self.durations = OrderedDict()
+        self.file = open(Path, mode='w')
+
+    def record(self, Span, Duration):
+        entry = OrderedDict([("operation", Span.operation), ("category", Span.category), ("start", round(Span.started, 6)), ("duration", round(Duration, 6)), ("outcome", Span.outcome), ("thread", threading.current_thread().name)])
+        entry.update(Span.tags)
+        line = json.dumps(entry)
+
+        with self.lock:
+            self.file.write(line + "\n")
+            self.events.append((Span.operation, Span.category, Span.startedCounter - self.startedCounter, Duration, threading.get_ident(), entry))
+            self.durations.setdefault((Span.category, Span.operation), []).append(Duration)
+
+    def writeChromeTrace(self):
+        pid = os.getpid()
+        events = []
+        for operation, category, offset, duration, threadId, entry in self.events:
+            args = dict((key, value) for key, value in entry.items() if key not in ("operation", "category", "start", "duration"))
+            events.append({"name": operation, "cat": category, "ph": "X", "ts": round(offset * 1e6, 1), "dur": round(duration * 1e6, 1), "pid": pid, "tid": threadId, "args": args})
+
+        with open(self.chromePath, mode='w') as traceFile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, traceFile)
+
+    def summary(self):
+        # (category, operation, count, total, p50, p95, max) per operation, the most expensive first
+        rows = []
+        for (category, operation), durations in self.durations.items():
+            durations = sorted(durations)
+            rows.append((category, operation, len(durations), sum(durations), percentile(durations, 50), percentile(durations, 95), durations[-1]))
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.writeChromeTrace()
+
+# Tracer of the run, None unless --trace is given
+tracer = None
+
+def configureTracer(Path):
+    global tracer
+    tracer = Tracer(Path) if Path else None
+    return tracer
+
+def getTracer():
+    return tracer
+
+def span(Operation, Category=OPERATION, **Tags):
+    # Context manager timing one unit of work, free when tracing is disabled
+    if tracer is None:
+        return NO_SPAN
+    return Span(tracer, Operation, Category, Tags)